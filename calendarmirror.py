@@ -0,0 +1,419 @@
+import datetime as dt
+import os
+import sys
+import threading
+import time
+
+import googleapiclient.errors as g_errors
+
+# 差分同期を行う間隔(秒)
+SYNC_INTERVAL = int(os.environ.get("CALENDAR_SYNC_INTERVAL", 60))
+# 変更通知を受け取れているときの定期的な同期の間隔(秒)
+PUSH_SYNC_INTERVAL = int(os.environ.get("CALENDAR_PUSH_SYNC_INTERVAL", 60 * 60))
+# 今週から何週間分を手元の複製から返すか
+MIRROR_WEEKS = int(os.environ.get("CALENDAR_MIRROR_WEEKS", 4))
+
+
+def mirror_error_out(text):
+    print(
+        "[{}]-CalendarMirror {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+def parse_event_time(value: dict, timezone: dt.timezone) -> dt.datetime:
+    """
+    EventのstartやendをTZ付きのdt.datetimeに変換する
+
+    :param dict value : Eventの"start"もしくは"end"
+    :param dt.timezone timezone : 終日のEventに使うtimezone
+    :return dt.datetime
+    """
+    if value.get("dateTime"):
+        return dt.datetime.fromisoformat(value["dateTime"].replace("Z", "+00:00"))
+    return dt.datetime.combine(
+        dt.date.fromisoformat(value["date"]), dt.time(), tzinfo=timezone
+    )
+
+
+def parse_range_time(value: str) -> dt.datetime:
+    """
+    get_events_in_dayに渡される範囲の文字列(UTCのZ表記)をdt.datetimeに変換する
+    """
+    return dt.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class CalendarMirror:
+    """
+    GoogleCalendarのEventを日付ごとに索引付けして手元に複製しておくクラス
+
+    初回に全件を取得し、以降はsyncTokenを使った差分同期で最新に保つ。
+    syncTokenが失効していた(410 GONE)ときは全件を取得し直す。
+    今週の月曜日からMIRROR_WEEKS週間分の範囲の読み込みは複製から返し、
+    複製の鮮度はsync_intervalで制限される。
+    channelsを渡すと、いずれかのworkerが変更を記録したカレンダーは次の読み込みの前に同期する。
+    変更通知のチャンネルが有効な間は、変更は記録で知れるので定期的な同期の間隔をpush_sync_intervalに延ばす。
+    """
+
+    def __init__(
+        self,
+        calendar,
+        calendar_ids: list,
+        timezone: dt.timezone,
+        sync_interval: int = SYNC_INTERVAL,
+        weeks: int = MIRROR_WEEKS,
+        channels=None,
+        push_sync_interval: int = PUSH_SYNC_INTERVAL,
+    ):
+        """
+        :param GoogleCalendar calendar : Eventの取得に使うGoogleCalendar
+        :param list calendar_ids : 複製するカレンダーのcalendar idのリスト
+        :param dt.timezone timezone : 日付で索引を作るときのtimezone
+        :param int sync_interval : 差分同期を行う間隔(秒)
+        :param int weeks : 複製から返す週の数
+        :param CalendarChannels channels : workerの間で変更の記録を共有するCalendarChannels。Noneなら使わない
+        :param int push_sync_interval : 変更通知を受け取れているときの差分同期の間隔(秒)
+        """
+        self.calendar = calendar
+        self.calendar_ids = list(calendar_ids)
+        self.timezone = timezone
+        self.sync_interval = sync_interval
+        self.weeks = weeks
+        self.channels = channels
+        self.push_sync_interval = push_sync_interval
+        # 複製の読み書き用と、同期処理を直列にするためのlock
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.events = {calendar_id: {} for calendar_id in self.calendar_ids}
+        self.days = {calendar_id: {} for calendar_id in self.calendar_ids}
+        self.sync_tokens = {}
+        self.synced_at = {}
+        # 最後の同期を始めた時刻(UNIX時間)。これ以降に記録された変更は複製に入っていないかもしれない
+        self.sync_started = {}
+        self.window_start = {}
+        self.thread = None
+        self.listeners = []
+
+    def calc_window(self) -> tuple:
+        """
+        複製から返す範囲(今週の月曜日の0時からweeks週間後まで)を返す
+
+        :return tuple : (始点, 終点)
+        """
+        today = dt.datetime.now().astimezone(self.timezone).date()
+        monday = dt.datetime.combine(
+            today - dt.timedelta(days=today.weekday()), dt.time(), tzinfo=self.timezone
+        )
+        return (monday, monday + dt.timedelta(weeks=self.weeks))
+
+    def covers(self, search_range: tuple) -> bool:
+        """
+        指定された範囲が複製から返せる範囲に収まっているかを返す
+
+        :param tuple search_range : 範囲(始点,終点)。UTCのZ表記の文字列
+        """
+        window_start, window_end = self.calc_window()
+        return (
+            window_start <= parse_range_time(search_range[0])
+            and parse_range_time(search_range[1]) <= window_end
+        )
+
+    def index_dates(self, event: dict) -> list:
+        """
+        Eventが掛かっている日付のリストを返す
+        """
+        start = parse_event_time(event["start"], self.timezone).astimezone(
+            self.timezone
+        )
+        end = parse_event_time(event["end"], self.timezone).astimezone(self.timezone)
+        return [
+            start.date() + dt.timedelta(days=count)
+            for count in range(max((end.date() - start.date()).days, 0) + 1)
+        ]
+
+    def remove_event(self, calendar_id: str, eventid: str) -> set:
+        """
+        複製からEventを取り除く。lockを取得してから呼ぶこと
+
+        :return set : 変更があった日付
+        """
+        old = self.events[calendar_id].pop(eventid, None)
+        if old is None:
+            return set()
+        dates = set(self.index_dates(old))
+        for date in dates:
+            self.days[calendar_id].get(date, set()).discard(eventid)
+        return dates
+
+    def apply_events(self, calendar_id: str, events: list) -> set:
+        """
+        取得したEventを複製に反映する。lockを取得してから呼ぶこと
+
+        差分の取得は範囲で絞れず、繰り返しのEventの変更では先の回まで返ってくるので、
+        複製から返す範囲の外のEventは捨てる。
+
+        :return set : 変更があった日付
+        """
+        window_start, window_end = self.calc_window()
+        changed = set()
+        for event in events:
+            eventid = event.get("id")
+            changed |= self.remove_event(calendar_id, eventid)
+            if event.get("status") == "cancelled":
+                continue
+            if not (
+                parse_event_time(event["start"], self.timezone) < window_end
+                and window_start < parse_event_time(event["end"], self.timezone)
+            ):
+                continue
+            self.events[calendar_id][eventid] = event
+            for date in self.index_dates(event):
+                self.days[calendar_id].setdefault(date, set()).add(eventid)
+                changed.add(date)
+        return changed
+
+    def full_sync(self, calendar_id: str) -> set:
+        """
+        複製から返す範囲の全てのEventを取得して複製を作り直す
+
+        :return set : 変更があった日付
+        """
+        started = time.time()
+        window_start, window_end = self.calc_window()
+        events, sync_token = self.calendar.list_events_for_sync(
+            calendar_id,
+            time_min=window_start.astimezone(dt.timezone.utc)
+            .isoformat()
+            .replace("+00:00", "Z"),
+            time_max=window_end.astimezone(dt.timezone.utc)
+            .isoformat()
+            .replace("+00:00", "Z"),
+        )
+        with self.lock:
+            changed = set(self.days[calendar_id].keys())
+            self.events[calendar_id] = {}
+            self.days[calendar_id] = {}
+            changed |= self.apply_events(calendar_id, events)
+            self.sync_tokens[calendar_id] = sync_token
+            self.window_start[calendar_id] = window_start
+            self.synced_at[calendar_id] = time.monotonic()
+            self.sync_started[calendar_id] = started
+        return changed
+
+    def incremental_sync(self, calendar_id: str) -> set:
+        """
+        前回の同期以降に変更されたEventだけを取得して複製に反映する
+
+        :return set : 変更があった日付
+        """
+        started = time.time()
+        events, sync_token = self.calendar.list_events_for_sync(
+            calendar_id, sync_token=self.sync_tokens[calendar_id]
+        )
+        with self.lock:
+            changed = self.apply_events(calendar_id, events)
+            self.sync_tokens[calendar_id] = sync_token
+            self.synced_at[calendar_id] = time.monotonic()
+            self.sync_started[calendar_id] = started
+        return changed
+
+    def get_sync_interval(self, calendar_id: str) -> int:
+        """
+        変更通知のチャンネルが有効ならpush_sync_interval、そうでなければsync_intervalを返す
+        """
+        if self.channels is not None and self.channels.is_watched(calendar_id):
+            return self.push_sync_interval
+        return self.sync_interval
+
+    def is_changed(self, calendar_id: str) -> bool:
+        """
+        最後の同期を始めた後に、いずれかのworkerが変更を記録したかを返す
+        """
+        if self.channels is None:
+            return False
+        return self.channels.changed_at(calendar_id) >= self.sync_started.get(
+            calendar_id, 0.0
+        )
+
+    def is_fresh(self, calendar_id: str, ratio: float = 1.0) -> bool:
+        """
+        最終同期から同期の間隔のratio倍が経っておらず、その後の変更も記録されていないかを返す
+        """
+        synced_at = self.synced_at.get(calendar_id)
+        return (
+            synced_at is not None
+            and time.monotonic() - synced_at
+            < self.get_sync_interval(calendar_id) * ratio
+            and not self.is_changed(calendar_id)
+        )
+
+    def add_listener(self, listener):
+        """
+        同期で変更があったときに呼ばれるcallbackを登録する
+
+        :param function listener : listener(calendar_id, dates)の形で呼ばれる
+        """
+        self.listeners.append(listener)
+
+    def notify(self, calendar_id: str, dates: set):
+        if not dates:
+            return
+        for listener in self.listeners:
+            try:
+                listener(calendar_id, dates)
+            except Exception as e:
+                mirror_error_out("listener failed: {}".format(e))
+
+    def sync(self, calendar_id: str, only_stale: bool = False) -> set:
+        """
+        カレンダーを同期し、変更があった日付をlistenerに通知する
+
+        :param str calendar_id : 同期するカレンダーのcalendar id
+        :param bool only_stale : Trueなら、同期待ちの間に他のスレッドが同期を済ませていれば何もしない
+        :return set : 変更があった日付
+        """
+        changed = self.sync_calendar(calendar_id, only_stale)
+        self.notify(calendar_id, changed)
+        return changed
+
+    def sync_calendar(self, calendar_id: str, only_stale: bool = False) -> set:
+        """
+        カレンダーを同期する。初回と週が変わったときは全件、それ以外は差分を取得する
+
+        :param str calendar_id : 同期するカレンダーのcalendar id
+        :param bool only_stale : Trueなら、同期待ちの間に他のスレッドが同期を済ませていれば何もしない
+        :return set : 変更があった日付
+        """
+        with self.sync_lock:
+            if only_stale and self.is_fresh(calendar_id):
+                return set()
+            if (
+                self.sync_tokens.get(calendar_id) is None
+                or self.window_start.get(calendar_id) != self.calc_window()[0]
+            ):
+                return self.full_sync(calendar_id)
+            try:
+                return self.incremental_sync(calendar_id)
+            except g_errors.HttpError as e:
+                if e.resp.status != 410:
+                    raise
+                # syncTokenが失効していれば全件を取得し直す
+                mirror_error_out(
+                    "sync token for {} is gone. resync".format(calendar_id)
+                )
+                return self.full_sync(calendar_id)
+
+    def sync_all(self, ratio: float = 0.0) -> dict:
+        """
+        全てのカレンダーを同期する
+
+        :param float ratio : 0より大きければ、is_fresh(calendar_id, ratio)のカレンダーは同期しない
+        :return dict : calendar idごとの変更があった日付
+        """
+        changed = {}
+        for calendar_id in self.calendar_ids:
+            if ratio > 0 and self.is_fresh(calendar_id, ratio):
+                continue
+            try:
+                changed[calendar_id] = self.sync(calendar_id)
+            except Exception as e:
+                mirror_error_out("failed to sync {}: {}".format(calendar_id, e))
+        return changed
+
+    def mark_stale(self, calendar_id: str = None):
+        """
+        次の読み込みの前に同期させる。自分で書き込んだ変更をすぐに読めるようにするため。
+        channelsがあれば、他のworkerにも同期させる
+
+        :param str calendar_id : 対象のカレンダー。Noneなら全て
+        """
+        targets = [calendar_id] if calendar_id else self.calendar_ids
+        with self.lock:
+            for target in targets:
+                self.synced_at.pop(target, None)
+        if self.channels is None:
+            return
+        for target in targets:
+            try:
+                self.channels.mark_changed(target)
+            except OSError as e:
+                mirror_error_out("failed to mark {} changed: {}".format(target, e))
+
+    def ensure_fresh(self, calendar_id: str) -> bool:
+        """
+        最終同期からsync_interval以上経っていれば同期する
+
+        :return bool : 複製から返してよい状態か
+        """
+        if self.is_fresh(calendar_id):
+            return True
+        try:
+            self.sync(calendar_id, only_stale=True)
+        except Exception as e:
+            mirror_error_out("failed to sync {}: {}".format(calendar_id, e))
+            return False
+        return True
+
+    def get_events_in_day(self, calendar: str, search_range: tuple) -> list:
+        """
+        GoogleCalendar.get_events_in_dayと同じ条件のEventを複製から返す
+
+        :param str calendar : 対象のカレンダーのcalendar id
+        :param tuple search_range : イベントを取得する範囲(始点,終点)
+        :return list : 開始時間順のEventのリスト。複製から返せないときはNone
+        """
+        if calendar not in self.events or not self.covers(search_range):
+            return None
+        if not self.ensure_fresh(calendar):
+            return None
+
+        range_start = parse_range_time(search_range[0])
+        range_end = parse_range_time(search_range[1])
+        first_date = range_start.astimezone(self.timezone).date()
+        last_date = range_end.astimezone(self.timezone).date()
+
+        with self.lock:
+            eventids = set()
+            for count in range((last_date - first_date).days + 1):
+                eventids |= self.days[calendar].get(
+                    first_date + dt.timedelta(days=count), set()
+                )
+            events = [self.events[calendar][eventid] for eventid in eventids]
+
+        # APIと同様に範囲と重なるEventだけを開始時間順に返す
+        events = [
+            event
+            for event in events
+            if parse_event_time(event["start"], self.timezone) < range_end
+            and range_start < parse_event_time(event["end"], self.timezone)
+        ]
+        return sorted(
+            events, key=lambda event: parse_event_time(event["start"], self.timezone)
+        )
+
+    def get_event(self, calendar: str, eventid: str) -> dict:
+        """
+        指定されたeventidのEventを複製から返す
+
+        :return dict : Event。複製になければNone
+        """
+        if calendar not in self.events or not self.ensure_fresh(calendar):
+            return None
+        with self.lock:
+            return self.events[calendar].get(eventid)
+
+    def run(self):
+        while True:
+            # 読み込み側が同期待ちにならないよう、鮮度が切れる前に同期する。
+            # 他のworkerが変更を記録していれば、sync_interval / 2のうちに取り込む
+            time.sleep(self.sync_interval / 2)
+            self.sync_all(ratio=0.5)
+
+    def start(self):
+        """
+        同期の間隔ごとに差分同期を行うスレッドを開始する
+        """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
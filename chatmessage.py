@@ -8,12 +8,13 @@ from ast import literal_eval
 from enum import Enum, auto
 from pprint import pprint
 
-import requests
-
-from settings import (IM_OPEN, SLACK_BOT_TOKEN, TEMP_CONVERSATION_SHEET,
-                      analyzer, header, sc)
+from conversationstore import make_conversation_store
+from settings import SLACK_BOT_TOKEN, TEMP_CONVERSATION_SHEET, analyzer, sc
 from workmanage import Work
 
+# 会話の途中の状態の保存先。シートへの書き写しは設定されたときだけ非同期で行う
+conversations = make_conversation_store(sc.sheet, TEMP_CONVERSATION_SHEET)
+
 
 class UseWordCombination(Enum):
     """
@@ -57,17 +58,18 @@ class ShiftNotFoundError(Exception):
 
 
 def get_temp_conversation(slackid: str) -> dict:
-    all_data = sc.sheet.get(TEMP_CONVERSATION_SHEET)
-    target_index = all_data[0].index(slackid)
-    temp_comversation = {
-        "append_date": all_data[1][target_index],
-        "action": all_data[2][target_index],
-        "dates": all_data[3][target_index],
-        "time": all_data[4][target_index],
-        "works": all_data[5][target_index],
-        "text": all_data[6][target_index],
-    }
-    return temp_comversation
+    """
+
+    会話の途中の状態を取り出す
+
+    Args:
+        slackid (str): 会話相手のslackid
+
+    Returns:
+        dict: 会話の状態。会話中でない(期限切れを含む)ときはNone
+
+    """
+    return conversations.get(slackid)
 
 
 def update_temp_conversation(
@@ -95,14 +97,11 @@ def update_temp_conversation(
         str(text),
     ]
 
-    all_data = sc.sheet.get(TEMP_CONVERSATION_SHEET)
-    target_index = all_data[0].index(slackid)
-
-    sc.sheet.update(
-        values,
-        TEMP_CONVERSATION_SHEET,
-        "B{index}:G{index}".format(index=target_index + 2),
-    )
+    # actionがなければ会話の終わりなので状態を消す
+    if action is None:
+        conversations.delete(slackid)
+        return
+    conversations.set(slackid, dict(zip(conversations.FIELDS, values)))
 
 
 def analyze_message(message: str):
@@ -727,7 +726,7 @@ def do_action(
 
     """
     if action is sc.Actions.SHOWSHIFT:
-        image = sc.generate_shiftimg_url(shift=sc.get_shift(date=date, fill_blank=True))
+        image = sc.prerender.get(date, True)
         print(image, file=sys.stderr)
         sc.post_message(
             "{}のシフトです".format(date.strftime("%Y/%m/%d")),
@@ -771,51 +770,11 @@ def get_user_dm_channel(slackid: str):
     Returns:
         str : ユーザーとのDM channelのid
     """
-    print(
-        json.loads(
-            requests.post(
-                IM_OPEN,
-                json=json.loads(
-                    json.dumps({"token": SLACK_BOT_TOKEN, "user": slackid})
-                ),
-                headers=header,
-            ).text
-        )
+    res = sc.slack.api(
+        "im.open", json.loads(json.dumps({"token": SLACK_BOT_TOKEN, "user": slackid}))
     )
-    return (
-        json.loads(
-            requests.post(
-                IM_OPEN,
-                json=json.loads(
-                    json.dumps({"token": SLACK_BOT_TOKEN, "user": slackid})
-                ),
-                headers=header,
-            ).text
-        )
-        .get("channel")
-        .get("id")
-    )
-
-
-def check_in_sequence(timestamp: str):
-    """
-
-    タイムスタンプから会話が進行中であるかを判定する
-
-    Args:
-        timestamp (str): temp_comversation.get("append_date")に記録された最終更新時間
-
-    Returns:
-        bool: 会話が進行中であるか
-    """
-    # 最終書き込み時刻を確認 比較対象datetime.isoformat() (ex:2021-03-01T00:00:00+09:00)
-    if re.compile(r"(\d){4}-(\d){2}-(\d){2}T(\d){2}:(\d){2}:(\d){2}").search(timestamp):
-        if dt.datetime.now().astimezone(sc.timezone) - dt.datetime.fromisoformat(
-            timestamp
-        ) < dt.timedelta(minutes=10):
-            return True
-
-    return False
+    print(res)
+    return res.get("channel").get("id")
 
 
 def start_chatmessage_process(message_data: dict):
@@ -851,9 +810,11 @@ def start_chatmessage_process(message_data: dict):
     giveup_flag = False
     is_sequence = False  # 連続した会話の途中であるフラグ
 
-    # 一時記憶の呼び出しと会話中の判定
+    # 一時記憶の呼び出しと会話中の判定。期限切れの会話は保存先から返されない
     temp_comversation = get_temp_conversation(user_slackid)
-    is_sequence = check_in_sequence(temp_comversation.get("append_date"))
+    is_sequence = temp_comversation is not None
+    if not is_sequence:
+        temp_comversation = {field: str(None) for field in conversations.FIELDS}
 
     # actionを判定
     try:
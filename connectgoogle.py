@@ -1,19 +1,34 @@
 from __future__ import print_function
 
+import atexit
 import datetime as dt
+import fcntl
+import io
 import json
 import os
-import re
+import queue
+import random
 import socket
 import sys
-from pprint import pprint
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import parse_qs, urlencode
 
 import googleapiclient.errors as g_errors
-from apiclient.http import MediaFileUpload
+import httplib2
+from apiclient.http import MediaFileUpload, MediaIoBaseUpload
+from deadline import bind_deadline, current_deadline, limit_timeout
+from google.auth.exceptions import TransportError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from workmanage import DrawShiftImg, Shift, Work, Worker, Worktime
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build, build_from_document
 
 socket.setdefaulttimeout(10)
 CLIENT_SECRET_JSON = json.loads(os.environ["CLIENT_SECRET_JSON"])["installed"]
@@ -29,6 +44,42 @@ TOKEN_URI = CLIENT_SECRET_JSON["token_uri"]
 SPREADSHEETID = os.environ["DATABASE_SHEET"]
 BEFORE_OPEN_TIME = 8
 AFTER_CLOSE_TIME = 19
+# 同梱しているGoogle APIのdiscovery documentの置き場所
+DISCOVERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "discovery")
+# カレンダーを並行して読むときのスレッド数の上限
+CALENDAR_FETCH_WORKERS = int(os.environ.get("CALENDAR_FETCH_WORKERS", 4))
+# カレンダーの変更通知(events.watch)の受け取り先と検証用のtoken
+GOOGLE_PUSH_ADDRESS = os.environ.get("GOOGLE_PUSH_ADDRESS")
+GOOGLE_PUSH_TOKEN = os.environ.get("GOOGLE_PUSH_TOKEN", "")
+# 通知チャンネルの有効期間(秒)と、期限の何秒前に更新するか
+GOOGLE_PUSH_TTL = int(os.environ.get("GOOGLE_PUSH_TTL", 7 * 24 * 60 * 60))
+GOOGLE_PUSH_RENEW_MARGIN = 60 * 60
+# 通知チャンネルと、いずれかのworkerが受け取った変更の記録の保存先。gunicornの各workerで共有する
+GOOGLE_PUSH_STATE = os.environ.get(
+    "GOOGLE_PUSH_STATE", os.path.join(tempfile.gettempdir(), "daiko-push-channels.json")
+)
+# チャンネルを管理するworkerがいなくなっていないか、他のworkerが確かめる間隔(秒)
+GOOGLE_PUSH_OWNER_INTERVAL = 60
+# Googleへのリクエストのリトライの上限回数と、最初の待ち時間/待ち時間の上限/全体の期限(秒)
+GOOGLE_RETRY_MAX_ATTEMPTS = int(os.environ.get("GOOGLE_RETRY_MAX_ATTEMPTS", 5))
+GOOGLE_RETRY_BASE_DELAY = float(os.environ.get("GOOGLE_RETRY_BASE_DELAY", 0.5))
+GOOGLE_RETRY_MAX_DELAY = float(os.environ.get("GOOGLE_RETRY_MAX_DELAY", 8))
+GOOGLE_RETRY_DEADLINE = float(os.environ.get("GOOGLE_RETRY_DEADLINE", 30))
+# カレンダーの読み込みを投げ直す(hedge)か。応答時間の何パーセンタイルを待ってから投げ直すか
+GOOGLE_HEDGE = os.environ.get("GOOGLE_HEDGE", "0") == "1"
+GOOGLE_HEDGE_PERCENTILE = float(os.environ.get("GOOGLE_HEDGE_PERCENTILE", 95))
+# 応答時間が集まるまでに使う待ち時間(秒)と、待ち時間の下限(秒)
+GOOGLE_HEDGE_INITIAL_DELAY = float(os.environ.get("GOOGLE_HEDGE_INITIAL_DELAY", 1))
+GOOGLE_HEDGE_MIN_DELAY = float(os.environ.get("GOOGLE_HEDGE_MIN_DELAY", 0.05))
+GOOGLE_HEDGE_WORKERS = int(os.environ.get("GOOGLE_HEDGE_WORKERS", 8))
+# gunicornの各workerで共有するアクセストークンの保存先と、期限の何秒前に更新するか
+GOOGLE_TOKEN_CACHE = os.environ.get(
+    "GOOGLE_TOKEN_CACHE", os.path.join(tempfile.gettempdir(), "daiko-google-token.json")
+)
+# Googleへのリクエストに使う認証済みhttpの数の上限と、空きを待つ時間の上限(秒)
+GOOGLE_HTTP_POOL_SIZE = int(os.environ.get("GOOGLE_HTTP_POOL_SIZE", 10))
+GOOGLE_HTTP_POOL_TIMEOUT = float(os.environ.get("GOOGLE_HTTP_POOL_TIMEOUT", 30))
+GOOGLE_TOKEN_REFRESH_MARGIN = int(os.environ.get("GOOGLE_TOKEN_REFRESH_MARGIN", 5 * 60))
 
 
 def gcon_error_out(text):
@@ -38,9 +89,445 @@ def gcon_error_out(text):
     )
 
 
-class ConnectGoogle:
-    def update_token(self):
-        creds = Credentials(
+class BatchWriteError(Exception):
+    """
+    バッチの一部の操作が失敗したときの例外
+
+    成功した操作は取り消しを試み、取り消せなかった操作をunrevertedに持つ。
+    """
+
+    def __init__(self, message: str, results: list, unreverted: list):
+        """
+        :param list results : GoogleCalendar.Batch.executeの結果
+        :param list unreverted : 成功したが取り消せなかった操作の番号のリスト
+        """
+        super().__init__(message)
+        self.results = results
+        self.unreverted = unreverted
+
+
+class RetryPolicy:
+    """
+    Googleへのリクエストを、失敗の種類に応じて間隔を空けながら有限回リトライするクラス
+
+    リトライするのはtimeoutや接続エラー、429/5xx、レート制限による403のみ。
+    待ち時間は指数的に伸ばした上限までのランダムな値(full jitter)にして、
+    多数のリクエストが同時にリトライしてGoogle側に負荷が集中しないようにする。
+    """
+
+    RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+    RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+    def __init__(
+        self,
+        max_attempts: int = GOOGLE_RETRY_MAX_ATTEMPTS,
+        base_delay: float = GOOGLE_RETRY_BASE_DELAY,
+        max_delay: float = GOOGLE_RETRY_MAX_DELAY,
+        deadline: float = GOOGLE_RETRY_DEADLINE,
+    ):
+        """
+        :param int max_attempts : 最初の試行を含めた試行回数の上限
+        :param float base_delay : 1回目のリトライまでの待ち時間の上限(秒)
+        :param float max_delay : 1回の待ち時間の上限(秒)
+        :param float deadline : 最初の試行から諦めるまでの時間(秒)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.giveups = 0
+
+    def is_retryable(self, error: Exception) -> bool:
+        """
+        リトライすれば成功しうる失敗かを返す
+        """
+        if isinstance(error, (socket.timeout, ConnectionError, TransportError)):
+            return True
+        if isinstance(error, g_errors.HttpError):
+            status = int(error.resp.status)
+            if status in self.RETRYABLE_STATUSES:
+                return True
+            if status == 403:
+                content = error.content or b""
+                if isinstance(content, bytes):
+                    content = content.decode(errors="ignore")
+                return any(reason in content for reason in self.RATE_LIMIT_REASONS)
+        return False
+
+    def calc_delay(self, attempt: int, error: Exception) -> float:
+        """
+        attempt回目の失敗の後に待つ時間を返す。Retry-Afterが返されていればそれ以上待つ
+        """
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+        if isinstance(error, g_errors.HttpError):
+            retry_after = error.resp.get("retry-after", "")
+            if retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+        return delay
+
+    def call(self, function, name: str = None, follow_deadline: bool = False):
+        """
+        functionを呼び出し、リトライ可能な失敗であれば間隔を空けて呼び直す
+
+        :param function function : 引数なしで呼び出す処理
+        :param str name : ログに出す処理の名前
+        :param bool follow_deadline : current_deadlineの残りの時間を過ぎたらリトライしない。読み込みにだけ使う
+        :return functionの返り値
+        :raises 最後の試行で発生した例外
+        """
+        name = name or getattr(function, "__qualname__", "request")
+        budget = limit_timeout(self.deadline) if follow_deadline else self.deadline
+        deadline = time.monotonic() + budget
+        attempt = 0
+        while True:
+            if follow_deadline and current_deadline() is not None:
+                current_deadline().check(name)
+            try:
+                return function()
+            except Exception as e:
+                attempt += 1
+                if not self.is_retryable(e):
+                    raise
+                delay = self.calc_delay(attempt, e)
+                if attempt >= self.max_attempts or time.monotonic() + delay > deadline:
+                    with self.lock:
+                        self.giveups += 1
+                    gcon_error_out(
+                        "give up {} after {} attempts: {!r}".format(name, attempt, e)
+                    )
+                    raise
+                with self.lock:
+                    self.retries += 1
+                gcon_error_out(
+                    "retry {} in {:.2f}s ({}/{}): {!r}".format(
+                        name, delay, attempt, self.max_attempts, e
+                    )
+                )
+                time.sleep(delay)
+
+    def execute(self, request, pool=None):
+        """
+        googleapiclientのHttpRequestをリトライ付きで実行する
+
+        :param HttpRequest request : 実行するリクエスト
+        :param HttpPool pool : 試行ごとにhttpを借りるHttpPool。Noneならserviceのhttpを使う
+        :return dict : APIからの返答
+        """
+        # 書き込みは途中で諦めると中途半端になるので、current_deadlineに関わらず最後まで試す
+        follow_deadline = getattr(request, "method", "GET") == "GET"
+        if pool is None:
+            return self.call(
+                request.execute, getattr(request, "methodId", None), follow_deadline
+            )
+        return self.call(
+            lambda: pool.execute(request),
+            getattr(request, "methodId", None),
+            follow_deadline,
+        )
+
+
+# 全てのGoogleへのリクエストで共有するリトライ設定
+GOOGLE_RETRY = RetryPolicy()
+
+
+class HttpPool:
+    """
+    認証済みのhttpを貸し出すクラス
+
+    httplib2はスレッドセーフでないので、リクエストごとにhttpを借りて返す。
+    返されたhttpは接続を保ったまま次のリクエストに使い回す。
+    """
+
+    def __init__(
+        self,
+        credentials: Credentials,
+        size: int = GOOGLE_HTTP_POOL_SIZE,
+        timeout: float = GOOGLE_HTTP_POOL_TIMEOUT,
+    ):
+        """
+        :param Credentials credentials : httpに使わせる認証情報
+        :param int size : 作るhttpの数の上限
+        :param float timeout : 空きを待つ時間の上限(秒)
+        """
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+        # 直前に返された、接続が生きていそうなhttpから貸し出す
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.checkouts = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def checkout(self):
+        """
+        httpを借りる。全て貸し出し中で上限に達していれば、返されるまで待つ
+
+        :return AuthorizedHttp : 借りたhttp
+        :raises TimeoutError : timeout秒待っても空かなかったとき
+        """
+        started = time.monotonic()
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_create = self.created < self.size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+            else:
+                # interactionの処理中なら、その残りの時間までしか待たない
+                timeout = limit_timeout(self.timeout)
+                try:
+                    http = self.idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(
+                        "no http is returned to the pool in {:.1f}s".format(timeout)
+                    )
+                waited = time.monotonic() - started
+                with self.lock:
+                    self.waited += 1
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+        with self.lock:
+            self.checkouts += 1
+        return http
+
+    def checkin(self, http):
+        self.idle.put(http)
+
+    @contextmanager
+    def connection(self):
+        http = self.checkout()
+        try:
+            yield http
+        finally:
+            self.checkin(http)
+
+    def execute(self, request):
+        """
+        借りたhttpでリクエストを実行する
+        """
+        with self.connection() as http:
+            return request.execute(http=http)
+
+    def stats(self) -> dict:
+        """
+        :return dict : 作ったhttpの数、貸し出し中の数、貸し出した回数、待たせた回数と待ち時間
+        """
+        with self.lock:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "in_use": self.created - self.idle.qsize(),
+                "checkouts": self.checkouts,
+                "waited": self.waited,
+                "wait_total": self.wait_total,
+                "wait_max": self.wait_max,
+                "wait_avg": self.wait_total / self.waited if self.waited else 0.0,
+            }
+
+
+class HedgePolicy:
+    """
+    読み込みが一定時間内に返ってこなければ同じ読み込みをもう1回投げ、先に返ってきた方を使うクラス
+
+    待ち時間は直近の応答時間のpercentileパーセンタイルとし、
+    遅い応答に引きずられる一部のリクエストの待ち時間を短くする。
+    冪等な読み込みにだけ使うこと。
+    """
+
+    # 待ち時間の計算に使う応答時間の数と、計算を始めるのに必要な数
+    WINDOW_SIZE = 200
+    MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        percentile: float = GOOGLE_HEDGE_PERCENTILE,
+        initial_delay: float = GOOGLE_HEDGE_INITIAL_DELAY,
+        min_delay: float = GOOGLE_HEDGE_MIN_DELAY,
+        max_workers: int = GOOGLE_HEDGE_WORKERS,
+    ):
+        """
+        :param float percentile : 投げ直すまで待つ応答時間のパーセンタイル
+        :param float initial_delay : 応答時間が集まるまでの待ち時間(秒)
+        :param float min_delay : 待ち時間の下限(秒)
+        :param int max_workers : 読み込みを行うスレッド数の上限
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        # 呼び出し側のスレッドプールと共有すると、並行読み込みの中から使ったときに詰まるので専用にする
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=self.WINDOW_SIZE)
+        self.calls = 0
+        self.fired = 0
+        self.won = 0
+
+    def calc_delay(self) -> float:
+        """
+        投げ直すまでの待ち時間を返す
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.MIN_SAMPLES:
+            return self.initial_delay
+        index = min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)
+        return max(latencies[index], self.min_delay)
+
+    def record(self, started: float, future):
+        if future.exception() is not None:
+            return
+        with self.lock:
+            self.latencies.append(time.monotonic() - started)
+
+    def submit(self, function):
+        started = time.monotonic()
+        future = self.executor.submit(function)
+        future.add_done_callback(lambda future: self.record(started, future))
+        return future
+
+    def call(self, function, name: str = None):
+        """
+        functionを呼び出し、待ち時間を過ぎても返ってこなければもう1回呼び出す
+
+        :param function function : 引数なしで呼び出す読み込み処理
+        :param str name : ログに出す処理の名前
+        :return 先に成功した方の返り値
+        :raises 両方が失敗したときは先に失敗した方の例外
+        """
+        with self.lock:
+            self.calls += 1
+        delay = self.calc_delay()
+        first = self.submit(function)
+        if wait([first], timeout=delay).done:
+            return first.result()
+
+        with self.lock:
+            self.fired += 1
+        gcon_error_out(
+            "hedge {} after {:.2f}s".format(
+                name or getattr(function, "__qualname__", "request"), delay
+            )
+        )
+        hedge = self.submit(function)
+        pending = {first, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self.lock:
+                            self.won += 1
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def stats(self) -> dict:
+        """
+        :return dict : 呼び出し回数、投げ直した回数、投げ直した方が先に返った回数と現在の待ち時間
+        """
+        with self.lock:
+            stats = {"calls": self.calls, "fired": self.fired, "won": self.won}
+        stats["delay"] = self.calc_delay()
+        return stats
+
+
+@lru_cache(maxsize=None)
+def load_discovery_document(api: str, version: str) -> dict:
+    """
+    同梱のdiscovery documentを読み込む。プロセス内では1度だけ読み込んで使い回す
+
+    :param str api : APIの名前 (calendar, sheets, drive)
+    :param str version : APIのバージョン
+    :return dict : discovery document。同梱されていなければNone
+    """
+    path = os.path.join(DISCOVERY_DIR, "{}.{}.json".format(api, version))
+    try:
+        with open(path) as document:
+            return json.load(document)
+    except OSError:
+        gcon_error_out("discovery document {} is not found".format(path))
+        return None
+
+
+def build_service(api: str, version: str, credentials: Credentials):
+    """
+    同梱のdiscovery documentからserviceを作る。なければ従来どおりGoogleから取得して作る
+    """
+    document = load_discovery_document(api, version)
+    if document is None:
+        return build(api, version, credentials=credentials)
+    return build_from_document(document, credentials=credentials)
+
+
+class LazyService:
+    """
+    最初に使われたときにserviceを作り、以降はそれに処理を任せるクラス
+
+    workerの起動時に使わないAPIのserviceまで作って待たされないようにする。
+    """
+
+    def __init__(self, api: str, version: str, credentials: Credentials):
+        """
+        :param str api : APIの名前 (calendar, sheets, drive)
+        :param str version : APIのバージョン
+        :param Credentials credentials : serviceに使わせる認証情報
+        """
+        self.api = api
+        self.version = version
+        self.credentials = credentials
+        self.lock = threading.Lock()
+        self.service = None
+
+    def get(self):
+        if self.service is None:
+            with self.lock:
+                if self.service is None:
+                    self.service = build_service(
+                        self.api, self.version, self.credentials
+                    )
+        return self.service
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class CredentialManager:
+    """
+    Googleのアクセストークンを、期限が切れる前にバックグラウンドで更新し続けるクラス
+
+    トークンと期限はファイルロック付きのキャッシュファイルに保存し、
+    gunicornの各workerは他のworkerが更新したトークンがまだ使えればそれを使う。
+    更新するのはロックを取れた1つのworkerだけになる。
+    リクエストを処理するスレッドでトークンの更新を待たされないよう、期限のrefresh_margin秒前に更新する。
+    """
+
+    def __init__(
+        self,
+        cache_path: str = GOOGLE_TOKEN_CACHE,
+        refresh_margin: int = GOOGLE_TOKEN_REFRESH_MARGIN,
+        retry: RetryPolicy = GOOGLE_RETRY,
+    ):
+        """
+        :param str cache_path : トークンを保存するファイルのパス
+        :param int refresh_margin : 期限の何秒前に更新するか
+        :param RetryPolicy retry : トークンの更新に使うリトライ設定
+        """
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.retry = retry
+        # 全てのserviceとhttpで同じCredentialsを使い、トークンはその場で差し替える
+        self.creds = Credentials(
             None,
             refresh_token=REFRESH_TOKEN,
             client_id=CLIENT_ID,
@@ -48,8 +535,88 @@ class ConnectGoogle:
             scopes=SCOPES,
             token_uri=TOKEN_URI,
         )
-        creds.refresh(Request())
-        return creds
+        self.timer = None
+
+    def read_cache(self) -> dict:
+        try:
+            with open(self.cache_path) as cache:
+                return json.load(cache)
+        except (OSError, ValueError):
+            return {}
+
+    def write_cache(self, token: str, expiry: float):
+        # 書きかけのファイルを他のworkerに読ませないよう、別のファイルに書いてから置き換える
+        temp_path = "{}.{}".format(self.cache_path, os.getpid())
+        with open(
+            os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w"
+        ) as cache:
+            json.dump({"token": token, "expiry": expiry}, cache)
+        os.replace(temp_path, self.cache_path)
+
+    def apply(self, token: str, expiry: float):
+        # google-authは期限をtzなしのUTCで扱う
+        self.creds.expiry = dt.datetime.fromtimestamp(expiry, dt.timezone.utc).replace(
+            tzinfo=None
+        )
+        self.creds.token = token
+
+    def refresh(self) -> float:
+        """
+        キャッシュのトークンがまだ使えればそれを使い、期限が近ければ更新してキャッシュに書き込む
+
+        :return float : トークンの期限(UNIX時間)
+        """
+        with open(self.cache_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                cache = self.read_cache()
+                if cache.get("expiry", 0) - time.time() > self.refresh_margin:
+                    self.apply(cache["token"], cache["expiry"])
+                    return cache["expiry"]
+
+                self.retry.call(lambda: self.creds.refresh(Request()), "refresh token")
+                expiry = self.creds.expiry.replace(tzinfo=dt.timezone.utc).timestamp()
+                self.write_cache(self.creds.token, expiry)
+                return expiry
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def schedule(self, delay: float):
+        self.timer = threading.Timer(delay, self.run)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def schedule_refresh(self, expiry: float):
+        # 全workerが同時に更新しに来ないよう、少しずらす
+        self.schedule(
+            max(expiry - time.time() - self.refresh_margin, 0) + random.uniform(0, 30)
+        )
+
+    def run(self):
+        try:
+            expiry = self.refresh()
+        except Exception as e:
+            gcon_error_out("failed to refresh token: {!r}".format(e))
+            # 失敗したら少し待って再挑戦する。それまでは期限内の古いトークンを使い続ける
+            self.schedule(60)
+            return
+        self.schedule_refresh(expiry)
+
+    def start(self) -> Credentials:
+        """
+        使えるトークンを用意し、以降期限前に更新し続けるタイマーを仕掛ける
+
+        :return Credentials : トークンが差し替えられ続けるCredentials
+        """
+        if self.timer is None:
+            self.schedule_refresh(self.refresh())
+        return self.creds
+
+
+class ConnectGoogle:
+    def update_token(self):
+        self.credential_manager = CredentialManager()
+        return self.credential_manager.start()
 
     def __init__(self, timezone: dt.timezone):
         self.timezone = timezone
@@ -59,22 +626,83 @@ class ConnectGoogle:
             print("Error: no or invalid token.", file=sys.stderr)
             return None
 
-        # service = build("calendar", "v3", credentials=creds)
+        # 全てのAPIで同じhttpの貸し出し元を使う
+        self.http_pool = HttpPool(self.creds)
         self.calendar = self.GoogleCalendar(
-            build("calendar", "v3", credentials=self.creds), self.timezone
+            LazyService("calendar", "v3", self.creds),
+            self.timezone,
+            pool=self.http_pool,
+            hedge=HedgePolicy() if GOOGLE_HEDGE else None,
         )
         self.sheet = self.GoogleSpreadSheet(
-            build("sheets", "v4", credentials=self.creds)
+            LazyService("sheets", "v4", self.creds), pool=self.http_pool
+        )
+        self.drive = self.GoogleDrive(
+            LazyService("drive", "v3", self.creds), pool=self.http_pool
         )
-        self.drive = self.GoogleDrive(build("drive", "v3", credentials=self.creds))
+        self.channels = None
+
+    def watch_calendars(self, calendar_ids: list):
+        """
+        指定されたカレンダーの変更通知チャンネルを管理するCalendarChannelsを作る
+
+        GOOGLE_PUSH_ADDRESSが設定されていれば、1つのworkerだけがチャンネルを登録し、
+        以降期限前に更新し続ける。設定されていなくても、受け取った通知の検証と
+        変更の記録には使える。
+
+        :param list calendar_ids : 変更を通知させるカレンダーのcalendar idのリスト
+        :return CalendarChannels : 作ったCalendarChannels
+        """
+        self.channels = self.CalendarChannels(
+            self.calendar, calendar_ids, GOOGLE_PUSH_ADDRESS, GOOGLE_PUSH_TOKEN
+        )
+        if GOOGLE_PUSH_ADDRESS:
+            self.channels.start()
+        return self.channels
 
     class GoogleCalendar:
-        def __init__(self, service, timezone: dt.timezone):
+        def __init__(
+            self,
+            service,
+            timezone: dt.timezone,
+            max_workers: int = CALENDAR_FETCH_WORKERS,
+            retry: RetryPolicy = GOOGLE_RETRY,
+            hedge: HedgePolicy = None,
+            pool: HttpPool = None,
+        ):
             self.service = service
             self.timezone = timezone
+            self.retry = retry
+            # Noneなら読み込みを投げ直さない
+            self.hedge = hedge
+            # httplib2はスレッドセーフでないので、リクエストごとにpoolからhttpを借りる
+            self.pool = pool
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def read(self, make_request, name: str = None):
+            """
+            読み込みのリクエストを実行する。hedgeがあれば遅いときに投げ直す
+
+            :param function make_request : 実行するHttpRequestを作る関数。投げ直すたびに呼ばれる
+            :param str name : ログに出す処理の名前
+            :return dict : APIからの返答
+            """
+
+            # hedgeは別のスレッドで読み込むので、このスレッドのDeadlineを引き継がせる
+            deadline = current_deadline()
+
+            def attempt():
+                with bind_deadline(deadline):
+                    return self.retry.execute(make_request(), pool=self.pool)
+
+            if self.hedge is None:
+                return attempt()
+            return self.hedge.call(attempt, name)
 
         def get_calenderID(self):
-            calendar_list = self.service.calendarList().list().execute()
+            calendar_list = self.retry.execute(
+                self.service.calendarList().list(), pool=self.pool
+            )
             # print("calender name : calender id")
             calid_list = {}
             for calendar_entry in calendar_list["items"]:
@@ -93,11 +721,56 @@ class ConnectGoogle:
                 "items": [{"id": calendar}],
             }
 
-            result = self.service.freebusy().query(body=body).execute()
+            result = self.retry.execute(
+                self.service.freebusy().query(body=body), pool=self.pool
+            )
             return result.get("calendars").get(calendar).get("busy")
 
         def delete_event(self, calendar: str, eventid):
-            self.service.events().delete(calendarId=calendar, eventId=eventid).execute()
+            self.retry.execute(
+                self.service.events().delete(calendarId=calendar, eventId=eventid),
+                pool=self.pool,
+            )
+
+        def make_event_body(
+            self,
+            summary: str,
+            start: dt.datetime,
+            end: dt.datetime,
+            description: str,
+            recurrence: str = None,
+        ) -> dict:
+            """
+            insertに送るEventのbodyを作る
+
+            :param str summary : イベントのタイトルにする文章
+            :param dt.datetime start : イベントの開始日時
+            :param dt.datetime end : イベントの終了日時
+            :param str description : イベントの詳細/メモ欄に書き込む文章
+            :param str recurrence : イベントの繰り返し設定
+            :return dict : Eventのbody
+            """
+            tzname = start.astimezone(self.timezone).tzname()
+            start = start.astimezone(self.timezone).isoformat()
+            end = end.astimezone(self.timezone).isoformat()
+            event = {
+                "summary": summary,
+                "end": {"dateTime": end, "timeZone": tzname},
+                "start": {"dateTime": start, "timeZone": tzname},
+                "description": description,
+            }
+
+            if recurrence:
+                event["recurrence"] = [recurrence]
+            return event
+
+        def new_batch(self):
+            """
+            書き込みをまとめて送信するためのBatchを作る
+
+            :return GoogleCalendar.Batch
+            """
+            return self.Batch(self)
 
         def insert_event(
             self,
@@ -126,31 +799,14 @@ class ConnectGoogle:
             Examples:
 
             Note:
-                timeout検出時は再帰的に自身を呼び出しリトライする
+                timeoutや429/5xxの検出時はself.retryに従ってリトライする
             """
-            tzname = start.astimezone(self.timezone).tzname()
-            start = start.astimezone(self.timezone).isoformat()
-            end = end.astimezone(self.timezone).isoformat()
-            event = {
-                "summary": summary,
-                "end": {"dateTime": end, "timeZone": tzname},
-                "start": {"dateTime": start, "timeZone": tzname},
-                "description": description,
-            }
-
-            if recurrence:
-                event["recurrence"] = [recurrence]
+            event = self.make_event_body(summary, start, end, description, recurrence)
 
-            try:
-                event = (
-                    self.service.events()
-                    .insert(calendarId=calendar, body=event)
-                    .execute()
-                )
-            except socket.timeout as e:
-                print(e)
-                return self.insert_event(calendar, summary, start, end, description)
-            return event
+            return self.retry.execute(
+                self.service.events().insert(calendarId=calendar, body=event),
+                pool=self.pool,
+            )
 
         def update_event(
             self,
@@ -163,42 +819,33 @@ class ConnectGoogle:
         ):
             start = start.astimezone(self.timezone).isoformat()
             end = end.astimezone(self.timezone).isoformat()
-            event = (
-                self.service.events()
-                .get(calendarId=calendar, eventId=eventid)
-                .execute()
+            event = self.retry.execute(
+                self.service.events().get(calendarId=calendar, eventId=eventid),
+                pool=self.pool,
             )
             event["summary"] = summary
             event["start"]["dateTime"] = start
             event["end"]["dateTime"] = end
             event["description"] = description
-            try:
-                updated_event = (
-                    self.service.events()
-                    .update(calendarId=calendar, eventId=eventid, body=event)
-                    .execute()
-                )
-            except socket.timeout as e:
-                print(e)
-                return self.update_event(
-                    calendar, eventid, summary, start, end, description
-                )
-            return updated_event
+            return self.retry.execute(
+                self.service.events().update(
+                    calendarId=calendar, eventId=eventid, body=event
+                ),
+                pool=self.pool,
+            )
 
         def get_event(self, calendar: str, eventid: str):
             print("call get_event")
             try:
-                target_schedule = (
-                    self.service.events()
-                    .get(calendarId=calendar, eventId=eventid)
-                    .execute()
+                target_schedule = self.read(
+                    lambda: self.service.events().get(
+                        calendarId=calendar, eventId=eventid
+                    ),
+                    "calendar.events.get",
                 )
             except g_errors.HttpError as e:
                 print(e)
                 target_schedule = None
-            except socket.timeout as e:
-                print(e)
-                return self.get_event(calendar, eventid)
             return target_schedule
 
         def get_events_in_day(self, calendar: str, search_range: tuple) -> list:
@@ -209,21 +856,16 @@ class ConnectGoogle:
 
             if self.service is None:
                 return None
-            try:
-                events = (
-                    self.service.events()
-                    .list(
-                        calendarId=calendar,
-                        timeMin=search_range[0],
-                        timeMax=search_range[1],
-                        singleEvents=True,
-                        orderBy="startTime",
-                    )
-                    .execute()
-                ).get("items", [])
-            except socket.timeout as e:
-                print(e)
-                return self.get_events_in_day(calendar, search_range)
+            events = self.read(
+                lambda: self.service.events().list(
+                    calendarId=calendar,
+                    timeMin=search_range[0],
+                    timeMax=search_range[1],
+                    singleEvents=True,
+                    orderBy="startTime",
+                ),
+                "calendar.events.list",
+            ).get("items", [])
 
             if not events:
                 print("No upcoming events found.")
@@ -231,47 +873,629 @@ class ConnectGoogle:
             else:
                 return events
 
+        def list_events_for_sync(
+            self,
+            calendar: str,
+            sync_token: str = None,
+            time_min: str = None,
+            time_max: str = None,
+        ) -> tuple:
+            """
+            カレンダーの複製を作るためにEventを全ページ分取得する
+
+            sync_tokenがあれば前回の同期以降に変更されたEventのみを、
+            なければtime_minからtime_maxまでの全てのEventを取得する。
+            syncTokenとは範囲を同時に指定できないので、差分の取得は範囲で絞れない。
+
+            :param str calendar : 対象のカレンダーのcalendar id
+            :param str sync_token : 前回の同期で得たsyncToken
+            :param str time_min : 全件取得時の範囲の始点
+            :param str time_max : 全件取得時の範囲の終点。繰り返しのEventを先まで展開しないよう指定する
+            :return tuple : (Eventのリスト, 次回の同期に使うsyncToken)
+            :raises HttpError : syncTokenが失効していれば410(GONE)
+            """
+            events = []
+            page_token = None
+            while True:
+                request = self.service.events().list(
+                    calendarId=calendar,
+                    singleEvents=True,
+                    maxResults=2500,
+                    pageToken=page_token,
+                    syncToken=sync_token,
+                    timeMin=None if sync_token else time_min,
+                    timeMax=None if sync_token else time_max,
+                )
+                response = self.retry.execute(request, pool=self.pool)
+                events += response.get("items", [])
+                page_token = response.get("nextPageToken")
+                if page_token is None:
+                    return events, response.get("nextSyncToken")
+
+        def watch_events(
+            self, calendar: str, channel_id: str, address: str, token: str, ttl: int
+        ) -> dict:
+            """
+            カレンダーのEventの変更をaddressに通知させるチャンネルを登録する
+
+            :param str calendar : 対象のカレンダーのcalendar id
+            :param str channel_id : 登録するチャンネルのid
+            :param str address : 通知を受け取るhttpsのurl
+            :param str token : 通知のX-Goog-Channel-Tokenヘッダに付けられる文字列
+            :param int ttl : チャンネルの有効期間(秒)
+            :return dict : 登録されたチャンネルの情報(resourceId, expirationなど)
+            """
+            body = {
+                "id": channel_id,
+                "type": "web_hook",
+                "address": address,
+                "token": token,
+                "params": {"ttl": str(ttl)},
+            }
+            return self.retry.execute(
+                self.service.events().watch(calendarId=calendar, body=body),
+                pool=self.pool,
+            )
+
+        def stop_channel(self, channel_id: str, resource_id: str):
+            """
+            登録済みの通知チャンネルを停止する
+            """
+            self.retry.execute(
+                self.service.channels().stop(
+                    body={"id": channel_id, "resourceId": resource_id}
+                ),
+                pool=self.pool,
+            )
+
+        def get_events_concurrently(self, calendars: list, search_range: tuple) -> list:
+            """
+            複数のカレンダーの指定された範囲のEventを並行して取得する
+
+            :param list calendars : 対象のカレンダーのcalendar idのリスト
+            :param tuple search_range : イベントを取得する範囲(始点,終点)
+            :return list : calendarsと同じ順に並べた、各カレンダーのEventのリスト
+            """
+            futures = [
+                self.executor.submit(self.get_events_in_day, calendar, search_range)
+                for calendar in calendars
+            ]
+            return [future.result() for future in futures]
+
+        def get_event_concurrently(self, calendars: list, eventid: str) -> list:
+            """
+            複数のカレンダーから指定されたeventidのEventを並行して取得する
+
+            :param list calendars : 対象のカレンダーのcalendar idのリスト
+            :param str eventid : 取得するEventのeventid
+            :return list : calendarsと同じ順に並べた、各カレンダーでの取得結果
+            """
+            futures = [
+                self.executor.submit(self.get_event, calendar, eventid)
+                for calendar in calendars
+            ]
+            return [future.result() for future in futures]
+
+        class Batch:
+            """
+            GoogleCalendarへの書き込みを1回のバッチリクエストにまとめて送信する
+
+            insert_event/update_event/delete_eventはGoogleCalendarと同じ引数で受け付け、
+            executeを呼ぶまでは送信しない。
+            バッチ内の各操作の実行順は保証されないので、互いに依存しない変更だけを積むこと。
+            リトライ時は、まだ成功していない操作だけを新しいバッチにまとめて送り直す。
+            一部の操作だけが失敗したときは、rollbackで成功した操作を取り消せる。
+            """
+
+            def __init__(self, calendar):
+                """
+                :param GoogleCalendar calendar : 書き込み先のGoogleCalendar
+                """
+                self.calendar = calendar
+                self.operations = []
+                self.requests = []
+                self.undos = []
+                self.results = []
+
+            def add(self, operation: str, request, undo=None):
+                """
+                バッチに操作を追加する
+
+                :param str operation : 操作の種類
+                :param HttpRequest request : 追加するリクエスト
+                :param function undo : undo(response)の形で呼ばれ、成功した操作を取り消す。
+                    Noneなら取り消せない
+                """
+                self.operations.append(operation)
+                self.requests.append(request)
+                self.undos.append(undo)
+
+            def receive(self, request_id: str, response, exception):
+                """
+                バッチの各操作の結果を受け取るcallback
+                """
+                index = int(request_id)
+                self.results[index] = {
+                    "operation": self.operations[index],
+                    "response": response,
+                    "exception": exception,
+                }
+
+            def insert_event(
+                self,
+                calendar: str,
+                summary: str,
+                start: dt.datetime,
+                end: dt.datetime,
+                description: str,
+                recurrence: str = None,
+            ):
+                event = self.calendar.make_event_body(
+                    summary, start, end, description, recurrence
+                )
+                self.add(
+                    "insert",
+                    self.calendar.service.events().insert(
+                        calendarId=calendar, body=event
+                    ),
+                    undo=lambda response: self.calendar.delete_event(
+                        calendar, response["id"]
+                    ),
+                )
+
+            def update_event(
+                self,
+                calendar: str,
+                eventid: str,
+                summary: str,
+                start: dt.datetime,
+                end: dt.datetime,
+                description: str,
+                original: dict = None,
+            ):
+                """
+                :param dict original : 取り消すときに戻す{"summary", "start", "end", "description"}
+                """
+                # getしてからupdateする代わりに、GoogleCalendar.update_eventが変える項目だけをpatchで送る
+                event = {
+                    "summary": summary,
+                    "start": {
+                        "dateTime": start.astimezone(self.calendar.timezone).isoformat()
+                    },
+                    "end": {
+                        "dateTime": end.astimezone(self.calendar.timezone).isoformat()
+                    },
+                    "description": description,
+                }
+                self.add(
+                    "update",
+                    self.calendar.service.events().patch(
+                        calendarId=calendar, eventId=eventid, body=event
+                    ),
+                    undo=(
+                        None
+                        if original is None
+                        else lambda response: self.calendar.update_event(
+                            calendar, eventid, **original
+                        )
+                    ),
+                )
+
+            def delete_event(self, calendar: str, eventid, original: dict = None):
+                """
+                :param dict original : 取り消すときに作り直す{"summary", "start", "end", "description"}。
+                    eventidと繰り返しの設定は元に戻らない
+                """
+                self.add(
+                    "delete",
+                    self.calendar.service.events().delete(
+                        calendarId=calendar, eventId=eventid
+                    ),
+                    undo=(
+                        None
+                        if original is None
+                        else lambda response: self.calendar.insert_event(
+                            calendar, **original
+                        )
+                    ),
+                )
+
+            def execute(self) -> list:
+                """
+                積まれた操作をまとめて送信する
+
+                :return list : 追加した順に並べた各操作の結果。
+                               {"operation": str, "response": dict, "exception": HttpError}
+                """
+                if not self.operations:
+                    return []
+
+                self.results = [None] * len(self.operations)
+                try:
+                    self.calendar.retry.call(self.send, "GoogleCalendar.Batch.execute")
+                except Exception as e:
+                    if not self.calendar.retry.is_retryable(e):
+                        raise
+                    for index, operation in enumerate(self.operations):
+                        if self.results[index] is None:
+                            self.results[index] = {
+                                "operation": operation,
+                                "response": None,
+                                "exception": e,
+                            }
+                return self.results
+
+            def rollback(self) -> list:
+                """
+                成功した操作を後ろから取り消す。一部の操作が失敗して書き込みが中途半端になったときに使う
+
+                :return list : 成功したが取り消せなかった操作の番号のリスト
+                """
+                unreverted = []
+                for index in reversed(range(len(self.operations))):
+                    result = self.results[index]
+                    if result is None or result["exception"] is not None:
+                        continue
+                    undo = self.undos[index]
+                    try:
+                        if undo is None:
+                            raise ValueError("no way to undo")
+                        undo(result["response"])
+                    except Exception as e:
+                        gcon_error_out(
+                            "failed to roll back {} #{}: {!r}".format(
+                                result["operation"], index, e
+                            )
+                        )
+                        unreverted.append(index)
+                return unreverted
+
+            def send(self):
+                """
+                未送信もしくはリトライ可能な失敗をした操作をまとめて送信する
+
+                :raises 送信自体の失敗、もしくは最初のリトライ可能な操作の失敗
+                """
+                retry = self.calendar.retry
+                pending = [
+                    index
+                    for index, result in enumerate(self.results)
+                    if result is None or retry.is_retryable(result["exception"])
+                ]
+                request = self.calendar.service.new_batch_http_request(
+                    callback=self.receive
+                )
+                for index in pending:
+                    request.add(self.requests[index], request_id=str(index))
+                if self.calendar.pool is None:
+                    request.execute()
+                else:
+                    self.calendar.pool.execute(request)
+                for index in pending:
+                    result = self.results[index]
+                    if result is not None and retry.is_retryable(result["exception"]):
+                        raise result["exception"]
+
+    class CalendarChannels:
+        """
+        カレンダーの変更通知(events.watch)チャンネルを登録/更新するクラス
+
+        チャンネルのtokenには検証用の文字列とcalendar idを埋め込んでおき、
+        通知を受け取ったプロセスがチャンネルを登録したプロセスでなくても
+        対象のカレンダーを判別できるようにする。
+        通知はどれか1つのworkerにしか届かないので、チャンネルの登録はファイルロックを取れた
+        1つのworkerだけが行い、チャンネルと受け取った変更はstate_pathのファイルで全workerに共有する。
+        チャンネルを管理するworkerは終了時にチャンネルを停止し、他のworkerが引き継ぐ。
+        """
+
+        def __init__(
+            self,
+            calendar,
+            calendar_ids: list,
+            address: str,
+            secret: str,
+            ttl: int = GOOGLE_PUSH_TTL,
+            renew_margin: int = GOOGLE_PUSH_RENEW_MARGIN,
+            state_path: str = GOOGLE_PUSH_STATE,
+        ):
+            """
+            :param GoogleCalendar calendar : チャンネルの登録に使うGoogleCalendar
+            :param list calendar_ids : 変更を通知させるカレンダーのcalendar idのリスト
+            :param str address : 通知を受け取るhttpsのurl
+            :param str secret : 通知の検証に使う文字列
+            :param int ttl : チャンネルの有効期間(秒)
+            :param int renew_margin : 期限の何秒前にチャンネルを更新するか
+            :param str state_path : チャンネルと変更の記録を保存するファイルのパス
+            """
+            self.calendar = calendar
+            self.calendar_ids = list(calendar_ids)
+            self.address = address
+            self.secret = secret
+            self.ttl = ttl
+            self.renew_margin = renew_margin
+            self.state_path = state_path
+            self.lock = threading.Lock()
+            self.timers = {}
+            # チャンネルを管理する権利のファイルロック。取れていなければNone
+            self.owner = None
+            # (ファイルの版, 読み込んだ内容)。記録は複製の読み込みごとに見るので、変わったときだけ読み直す
+            self.cache = (None, {})
+
+        def make_token(self, calendar_id: str) -> str:
+            return urlencode({"secret": self.secret, "calendar": calendar_id})
+
+        def parse_token(self, token: str) -> str:
+            """
+            通知のtokenを検証し、対象のcalendar idを返す
+
+            :param str token : X-Goog-Channel-Tokenヘッダの値
+            :return str : 対象のcalendar id。検証に失敗すればNone
+            """
+            values = parse_qs(token or "")
+            if not self.secret or values.get("secret", [""])[0] != self.secret:
+                return None
+            calendar_id = values.get("calendar", [None])[0]
+            return calendar_id if calendar_id in self.calendar_ids else None
+
+        def read_state(self) -> dict:
+            """
+            :return dict : {"channels": {calendar id: {"id", "resource_id", "address", "expiration"}},
+                "changed": {calendar id: 最後に変更を受け取った時刻(UNIX時間)}}
+            """
+            try:
+                stat = os.stat(self.state_path)
+            except OSError:
+                return {"channels": {}, "changed": {}}
+            # 記録は置き換えで更新するので、inodeも見れば更新時刻の粒度が粗くても変化がわかる
+            version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            with self.lock:
+                if self.cache[0] == version:
+                    return self.cache[1]
+            try:
+                with open(self.state_path) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                state = {}
+            state = {
+                "channels": state.get("channels", {}),
+                "changed": state.get("changed", {}),
+            }
+            with self.lock:
+                self.cache = (version, state)
+            return state
+
+        def update_state(self, update):
+            """
+            ファイルロックを取って記録を読み、update(state)で書き換えて保存する
+            """
+            with open(self.state_path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    state = self.read_state()
+                    state = {
+                        "channels": dict(state["channels"]),
+                        "changed": dict(state["changed"]),
+                    }
+                    update(state)
+                    # 書きかけのファイルを他のworkerに読ませないよう、別のファイルに書いてから置き換える
+                    temp_path = "{}.{}".format(self.state_path, os.getpid())
+                    with open(temp_path, "w") as state_file:
+                        json.dump(state, state_file)
+                    os.replace(temp_path, self.state_path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        def is_watched(self, calendar_id: str) -> bool:
+            """
+            いずれかのworkerが、カレンダーの期限内のチャンネルを管理しているかを返す
+            """
+            channel = self.read_state()["channels"].get(calendar_id)
+            return channel is not None and channel["expiration"] > time.time()
+
+        def changed_at(self, calendar_id: str) -> float:
+            """
+            :return float : いずれかのworkerが最後にカレンダーの変更を受け取った時刻(UNIX時間)。なければ0
+            """
+            return self.read_state()["changed"].get(calendar_id, 0.0)
+
+        def mark_changed(self, calendar_id: str):
+            """
+            カレンダーが変更されたことを全workerに知らせる
+            """
+
+            def update(state):
+                state["changed"][calendar_id] = time.time()
+
+            self.update_state(update)
+
+        def start(self):
+            """
+            チャンネルを管理する権利を取れれば管理を始める。取れなければ、取れるまで定期的に試す
+            """
+            if self.take_ownership():
+                return
+            timer = threading.Timer(GOOGLE_PUSH_OWNER_INTERVAL, self.start)
+            timer.daemon = True
+            timer.start()
+
+        def take_ownership(self) -> bool:
+            """
+            チャンネルを管理する権利を取り、前の持ち主が残した期限内のチャンネルは引き継ぐ
+
+            :return bool : 権利を取れたか
+            """
+            owner = open(self.state_path + ".owner", "a")
+            try:
+                fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                owner.close()
+                return False
+            self.owner = owner
+            atexit.register(self.stop_all)
+
+            channels = self.read_state()["channels"]
+            for calendar_id in self.calendar_ids:
+                channel = channels.get(calendar_id)
+                if (
+                    channel is not None
+                    and channel.get("address") == self.address
+                    and channel["expiration"] - time.time() > self.renew_margin
+                ):
+                    self.schedule_renewal(calendar_id, channel["expiration"])
+                else:
+                    self.renew(calendar_id)
+                # 持ち主がいなかった間の変更を取りこぼさないよう、全workerに同期させる
+                self.mark_changed(calendar_id)
+            return True
+
+        def register(self, calendar_id: str) -> dict:
+            """
+            チャンネルを登録し、期限前に更新するタイマーを仕掛ける。古いチャンネルがあれば停止する
+
+            :param str calendar_id : 対象のカレンダーのcalendar id
+            :return dict : 登録したチャンネルの情報
+            """
+            response = self.calendar.watch_events(
+                calendar_id,
+                str(uuid.uuid4()),
+                self.address,
+                self.make_token(calendar_id),
+                self.ttl,
+            )
+            channel = {
+                "id": response.get("id"),
+                "resource_id": response.get("resourceId"),
+                "address": self.address,
+                # expirationはUNIX時間のミリ秒
+                "expiration": int(response.get("expiration", 0)) / 1000
+                or time.time() + self.ttl,
+            }
+            old = self.read_state()["channels"].get(calendar_id)
+
+            def update(state):
+                state["channels"][calendar_id] = channel
+
+            self.update_state(update)
+            if old is not None:
+                self.stop(old)
+            self.schedule_renewal(calendar_id, channel["expiration"])
+            return channel
+
+        def stop(self, channel: dict):
+            try:
+                self.calendar.stop_channel(channel["id"], channel["resource_id"])
+            except Exception as e:
+                gcon_error_out("failed to stop channel {}: {}".format(channel["id"], e))
+
+        def stop_all(self):
+            """
+            管理しているチャンネルを全て停止し、他のworkerが引き継げるよう権利を手放す
+            """
+            if self.owner is None:
+                return
+            with self.lock:
+                for timer in self.timers.values():
+                    timer.cancel()
+                self.timers = {}
+            channels = {}
+
+            def update(state):
+                for calendar_id in self.calendar_ids:
+                    channel = state["channels"].pop(calendar_id, None)
+                    if channel is not None:
+                        channels[calendar_id] = channel
+
+            self.update_state(update)
+            for channel in channels.values():
+                self.stop(channel)
+            fcntl.flock(self.owner, fcntl.LOCK_UN)
+            self.owner.close()
+            self.owner = None
+
+        def schedule_renewal(self, calendar_id: str, expiration: float):
+            delay = max(expiration - time.time() - self.renew_margin, 0)
+            timer = threading.Timer(delay, self.renew, args=(calendar_id,))
+            timer.daemon = True
+            with self.lock:
+                if calendar_id in self.timers:
+                    self.timers[calendar_id].cancel()
+                self.timers[calendar_id] = timer
+            timer.start()
+
+        def renew(self, calendar_id: str):
+            try:
+                self.register(calendar_id)
+            except Exception as e:
+                gcon_error_out(
+                    "failed to renew channel for {}: {}".format(calendar_id, e)
+                )
+                # 失敗したら少し待って再挑戦する
+                self.schedule_renewal(
+                    calendar_id, time.time() + self.renew_margin + 5 * 60
+                )
+
     class GoogleSpreadSheet:
         LOG_SHEET_NAME = "use-logs"
         USERID_SHEET_NAME = "name-id"
 
-        def __init__(self, service):
+        def __init__(
+            self,
+            service,
+            retry: RetryPolicy = GOOGLE_RETRY,
+            pool: HttpPool = None,
+        ):
             self.service = service
+            self.retry = retry
+            self.pool = pool
+            # sheetName -> sheetId. シートの構成はほぼ変わらないので1度だけ取得して使い回す
+            self.sheet_ids = None
+            self.sheet_ids_lock = threading.Lock()
 
-        def get_sheets_dict(self, toId=True):
+        def get_sheets_dict(self, toId=True, refresh=False):
             """
             make dict of sheetName ↔ sheetId
 
             :param bool toId : if toId is True, key of return dict is "sheetName"
+            :param bool refresh : if refresh is True, reload the structure of spreadsheet
             :return dict : sheetName ↔ sheetId
             """
-            try:
-                response = (
-                    self.service.spreadsheets()
-                    .get(spreadsheetId=SPREADSHEETID)
-                    .execute()
-                )
-            except socket.timeout:
-                return self.get_sheets_dict(toId)
-            sheets = {}
-            for prop in response.get("sheets"):
-                if toId:
-                    sheets.update(
-                        {
-                            prop.get("properties")
-                            .get("title"): prop.get("properties")
-                            .get("sheetId")
-                        }
+            with self.sheet_ids_lock:
+                if refresh or self.sheet_ids is None:
+                    response = self.retry.execute(
+                        self.service.spreadsheets().get(
+                            spreadsheetId=SPREADSHEETID, fields="sheets.properties"
+                        ),
+                        pool=self.pool,
                     )
-                else:
-                    sheets.update(
-                        {
-                            prop.get("properties")
-                            .get("sheetId"): prop.get("properties")
-                            .get("title")
-                        }
-                    )
-            return sheets
+                    self.sheet_ids = {
+                        prop.get("properties")
+                        .get("title"): prop.get("properties")
+                        .get("sheetId")
+                        for prop in response.get("sheets")
+                    }
+                sheets = dict(self.sheet_ids)
+            if toId:
+                return sheets
+            return {sheetId: sheetName for sheetName, sheetId in sheets.items()}
+
+        def invalidate_sheets_dict(self):
+            """
+            discard cached structure of spreadsheet. call this after adding/removing sheets
+            """
+            with self.sheet_ids_lock:
+                self.sheet_ids = None
+
+        def get_sheet_id(self, sheetName: str) -> int:
+            """
+            get sheetId of sheetName. reload the structure if sheetName is not cached
+
+            :param str sheetName : name of target sheet.
+            :return int : sheetId
+            """
+            sheets = self.get_sheets_dict()
+            if sheetName not in sheets:
+                sheets = self.get_sheets_dict(refresh=True)
+            return sheets[sheetName]
 
         def get(self, sheetName: str):
             """
@@ -280,30 +1504,38 @@ class ConnectGoogle:
             :param str sheetName : name of target sheet.
             :return list : list of data in sheet.
             """
-            sheetId = self.get_sheets_dict()[sheetName]
-            request_doby = {
-                "dataFilters": [
-                    {
-                        "gridRange": {
-                            "startColumnIndex": 0,
-                            "startRowIndex": 1,
-                            "sheetId": sheetId,
+            # キャッシュしたsheetIdが古ければ(シートが作り直されたなど)構成を取得し直して1度だけ読み直す
+            for retried in (False, True):
+                request_doby = {
+                    "dataFilters": [
+                        {
+                            "gridRange": {
+                                "startColumnIndex": 0,
+                                "startRowIndex": 1,
+                                "sheetId": self.get_sheet_id(sheetName),
+                            }
                         }
-                    }
-                ],
-                "majorDimension": "COLUMNS",
-            }
-            request = (
-                self.service.spreadsheets()
-                .values()
-                .batchGetByDataFilter(spreadsheetId=SPREADSHEETID, body=request_doby)
-            )
+                    ],
+                    "majorDimension": "COLUMNS",
+                }
+                request = (
+                    self.service.spreadsheets()
+                    .values()
+                    .batchGetByDataFilter(
+                        spreadsheetId=SPREADSHEETID, body=request_doby
+                    )
+                )
 
-            try:
-                response = request.execute()
-            except socket.timeout:
-                gcon_error_out("catch timeout in GoogleSpreadSheet.get(). retry")
-                return self.get(sheetName)
+                try:
+                    response = self.retry.execute(request, pool=self.pool)
+                except g_errors.HttpError as e:
+                    if retried or int(e.resp.status) != 400:
+                        raise
+                    self.invalidate_sheets_dict()
+                    continue
+                if response.get("valueRanges") or retried:
+                    break
+                self.invalidate_sheets_dict()
 
             return response.get("valueRanges")[0].get("valueRange").get("values")
 
@@ -313,25 +1545,27 @@ class ConnectGoogle:
             :param list data : to append data.
             :param str sheetName : name of target sheet.
             """
-            body = {"values": [data]}
-            try:
-                response = (
-                    self.service.spreadsheets()
-                    .values()
-                    .append(
-                        spreadsheetId=SPREADSHEETID,
-                        range=sheetName,
-                        valueInputOption="RAW",
-                        insertDataOption="INSERT_ROWS",
-                        body=body,
-                    )
-                    .execute()
-                )
-            except socket.timeout:
-                gcon_error_out("catch timeout in GoogleSpreadSheet.append(). retry...")
-                return self.append(sheetName)
+            return self.append_rows([data], sheetName)
 
-            return response
+        def append_rows(self, rows: list, sheetName: str) -> object:
+            """
+            append multiple rows to sheet at once
+            :param list rows : list of data to append.
+            :param str sheetName : name of target sheet.
+            """
+            body = {"values": rows}
+            return self.retry.execute(
+                self.service.spreadsheets()
+                .values()
+                .append(
+                    spreadsheetId=SPREADSHEETID,
+                    range=sheetName,
+                    valueInputOption="RAW",
+                    insertDataOption="INSERT_ROWS",
+                    body=body,
+                ),
+                pool=self.pool,
+            )
 
         def update(self, data: list, sheetName: str, date_range: str) -> object:
             """
@@ -340,22 +1574,17 @@ class ConnectGoogle:
             :param str sheetName : name of target sheet.
             """
             body = {"values": [data]}
-            try:
-                response = (
-                    self.service.spreadsheets()
-                    .values()
-                    .update(
-                        spreadsheetId=SPREADSHEETID,
-                        valueInputOption="USER_ENTERED",
-                        range="{}!{}".format(sheetName, date_range),
-                        body=body,
-                    )
-                    .execute()
-                )
-            except socket.timeout:
-                gcon_error_out("catch timeout in GoogleSpreadSheet.update(). retry...")
-                return self.append(sheetName)
-            return response
+            return self.retry.execute(
+                self.service.spreadsheets()
+                .values()
+                .update(
+                    spreadsheetId=SPREADSHEETID,
+                    valueInputOption="USER_ENTERED",
+                    range="{}!{}".format(sheetName, date_range),
+                    body=body,
+                ),
+                pool=self.pool,
+            )
 
         def get_slackId2name_dict(self, toName=True) -> dict:
             """
@@ -378,16 +1607,26 @@ class ConnectGoogle:
         # URLHEADER = "https://drive.google.com/file/d/{}"
         URLHEADER = "https://drive.google.com/uc?id={}"
 
-        def __init__(self, service):
+        def __init__(
+            self,
+            service,
+            retry: RetryPolicy = GOOGLE_RETRY,
+            pool: HttpPool = None,
+        ):
             self.service = service
+            self.retry = retry
+            self.pool = pool
 
-        def upload(self, filename: str, filepath: str, filetype: str) -> str:
+        def upload(
+            self, filename: str, filepath: str, filetype: str, data: bytes = None
+        ) -> str:
             """
             upload to GoogleDrive
 
             :param str filename
-            :param str filepath
+            :param str filepath : ignored if data is given
             :param str filetytpe : mimetype of target file
+            :param bytes data : content of file. upload from memory without filepath
             :return str fileid : fileid for GoogleDrive
             """
             file_metadata = {
@@ -395,18 +1634,16 @@ class ConnectGoogle:
                 "mimetype": filetype,
                 "parents": ["1WM6yJVBgoqU9azui7d_EhGuFp5KDIjAN"],
             }
-            media_body = MediaFileUpload(filepath, mimetype=filetype)
-            try:
-                file = (
-                    self.service.files()
-                    .create(body=file_metadata, media_body=media_body, fields="id")
-                    .execute()
-                )
-            except socket.timeout:
-                gcon_error_out("catch timeout in GoogleDrive().upload. retry...")
-                return self.upload(
-                    filename=filename, filepath=filepath, filetype=filetype
-                )
+            if data is not None:
+                media_body = MediaIoBaseUpload(io.BytesIO(data), mimetype=filetype)
+            else:
+                media_body = MediaFileUpload(filepath, mimetype=filetype)
+            file = self.retry.execute(
+                self.service.files().create(
+                    body=file_metadata, media_body=media_body, fields="id"
+                ),
+                pool=self.pool,
+            )
             return file.get("id")
 
         def share(self, fileid: str) -> dict:
@@ -417,15 +1654,18 @@ class ConnectGoogle:
             :return dict changed_permission : created Permission
             """
             ONLY_KNOWN_URL_PERMISSION = {"role": "reader", "type": "anyone"}
-            changed_permission = (
-                self.service.permissions()
-                .create(fileId=fileid, body=ONLY_KNOWN_URL_PERMISSION)
-                .execute()
+            changed_permission = self.retry.execute(
+                self.service.permissions().create(
+                    fileId=fileid, body=ONLY_KNOWN_URL_PERMISSION
+                ),
+                pool=self.pool,
             )
             return changed_permission
 
-        def upload4share(self, filename: str, filepath: str, filetype: str) -> dict:
-            fileid = self.upload(filename, filepath, filetype)
+        def upload4share(
+            self, filename: str, filepath: str, filetype: str, data: bytes = None
+        ) -> dict:
+            fileid = self.upload(filename, filepath, filetype, data)
             new_permission = self.share(fileid)
             return self.URLHEADER.format(fileid)
 
@@ -0,0 +1,250 @@
+import datetime as dt
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+# 会話の状態の保存先 (memory / sqlite) と、会話が続いているとみなす時間(秒)
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "sqlite")
+CONVERSATION_TTL = int(os.environ.get("CONVERSATION_TTL", 10 * 60))
+# sqliteを使うときのファイルのパス。gunicornの各workerで共有する
+CONVERSATION_DB = os.environ.get(
+    "CONVERSATION_DB", os.path.join(tempfile.gettempdir(), "daiko-conversations.db")
+)
+# "temp-conversation"シートにも書き写すか
+CONVERSATION_SHEET_MIRROR = os.environ.get("CONVERSATION_SHEET_MIRROR", "0") == "1"
+
+
+def conversation_error_out(text):
+    print(
+        "[{}]-ConversationStore {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class ConversationStore(ABC):
+    """
+    チャット形式の会話の途中の状態をslackidごとに保存するクラス
+
+    状態は最後に保存してからttl秒で期限切れになり、期限切れの状態は返さない。
+    write_behindがあれば、保存した状態を非同期でシートにも書き写す。
+    実際の保存先はMemoryConversationStore/SQLiteConversationStoreが実装する。
+    """
+
+    # 状態の項目。"temp-conversation"シートのB列からG列の並び
+    FIELDS = ("append_date", "action", "dates", "time", "works", "text")
+
+    def __init__(self, ttl: int = CONVERSATION_TTL, write_behind=None):
+        """
+        :param int ttl : 状態を保持する時間(秒)
+        :param SheetWriteBehind write_behind : シートへの書き写し。Noneなら書き写さない
+        """
+        self.ttl = ttl
+        self.write_behind = write_behind
+
+    def get(self, slackid: str) -> dict:
+        """
+        :param str slackid : 会話相手のslackid
+        :return dict : 会話の状態。なければ、もしくは期限切れならNone
+        """
+        return self.load(slackid, time.time())
+
+    def set(self, slackid: str, state: dict):
+        """
+        会話の状態を保存し、期限を延ばす
+
+        :param str slackid : 会話相手のslackid
+        :param dict state : FIELDSをキーにした会話の状態
+        """
+        state = {field: state.get(field) for field in self.FIELDS}
+        self.save(slackid, state, time.time() + self.ttl)
+        if self.write_behind is not None:
+            self.write_behind.write(slackid, [state[field] for field in self.FIELDS])
+
+    def delete(self, slackid: str):
+        """
+        会話が終わったので状態を消す
+        """
+        self.remove(slackid)
+        if self.write_behind is not None:
+            self.write_behind.write(slackid, [str(None)] * len(self.FIELDS))
+
+    @abstractmethod
+    def load(self, slackid: str, now: float) -> dict:
+        """
+        nowの時点で期限切れでない状態を返す。なければNone
+        """
+
+    @abstractmethod
+    def save(self, slackid: str, state: dict, expires_at: float):
+        """
+        状態をexpires_atまで保存する
+        """
+
+    @abstractmethod
+    def remove(self, slackid: str):
+        """
+        状態を消す
+        """
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    会話の状態をプロセスのメモリに保存する。workerが1つのときに使う
+    """
+
+    def __init__(self, ttl: int = CONVERSATION_TTL, write_behind=None):
+        super().__init__(ttl, write_behind)
+        self.lock = threading.Lock()
+        # slackid -> (状態, 期限)
+        self.states = {}
+
+    def load(self, slackid: str, now: float) -> dict:
+        with self.lock:
+            state, expires_at = self.states.get(slackid, (None, 0))
+            if expires_at <= now:
+                self.states.pop(slackid, None)
+                return None
+            return dict(state)
+
+    def save(self, slackid: str, state: dict, expires_at: float):
+        with self.lock:
+            self.states[slackid] = (dict(state), expires_at)
+            # 期限切れの状態が溜まらないよう、書き込みのついでに掃除する
+            now = time.time()
+            for expired in [
+                key for key, value in self.states.items() if value[1] <= now
+            ]:
+                del self.states[expired]
+
+    def remove(self, slackid: str):
+        with self.lock:
+            self.states.pop(slackid, None)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    会話の状態をSQLiteのファイルに保存する。gunicornの複数のworkerで状態を共有できる
+    """
+
+    def __init__(
+        self,
+        path: str = CONVERSATION_DB,
+        ttl: int = CONVERSATION_TTL,
+        write_behind=None,
+    ):
+        """
+        :param str path : SQLiteのファイルのパス
+        """
+        super().__init__(ttl, write_behind)
+        self.path = path
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS conversations (slackid TEXT PRIMARY KEY,"
+                    " state TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+        finally:
+            connection.close()
+
+    def connect(self):
+        # 接続はスレッドをまたいで使えないので、操作ごとに開く
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self, slackid: str, now: float) -> dict:
+        connection = self.connect()
+        try:
+            row = connection.execute(
+                "SELECT state FROM conversations WHERE slackid = ? AND expires_at > ?",
+                (slackid, now),
+            ).fetchone()
+        finally:
+            connection.close()
+        return json.loads(row[0]) if row else None
+
+    def save(self, slackid: str, state: dict, expires_at: float):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                    (slackid, json.dumps(state, ensure_ascii=False), expires_at),
+                )
+                connection.execute(
+                    "DELETE FROM conversations WHERE expires_at <= ?", (time.time(),)
+                )
+        finally:
+            connection.close()
+
+    def remove(self, slackid: str):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "DELETE FROM conversations WHERE slackid = ?", (slackid,)
+                )
+        finally:
+            connection.close()
+
+
+class SheetWriteBehind:
+    """
+    会話の状態を"temp-conversation"シートに非同期で書き写すクラス
+
+    書き写しは1本のスレッドで順に行い、会話の応答は待たせない。
+    """
+
+    def __init__(self, sheet, sheet_name: str):
+        """
+        :param GoogleSpreadSheet sheet : 書き写し先のGoogleSpreadSheet
+        :param str sheet_name : 書き写し先のシート名
+        """
+        self.sheet = sheet
+        self.sheet_name = sheet_name
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def write(self, slackid: str, values: list):
+        self.executor.submit(self.update, slackid, values)
+
+    def update(self, slackid: str, values: list):
+        try:
+            all_data = self.sheet.get(self.sheet_name)
+            target_index = all_data[0].index(slackid)
+            self.sheet.update(
+                values,
+                self.sheet_name,
+                "B{index}:G{index}".format(index=target_index + 2),
+            )
+        except Exception as e:
+            conversation_error_out(
+                "failed to mirror conversation of {}: {!r}".format(slackid, e)
+            )
+
+
+def make_conversation_store(sheet=None, sheet_name: str = None) -> ConversationStore:
+    """
+    CONVERSATION_STOREの設定に応じたConversationStoreを作る
+
+    :param GoogleSpreadSheet sheet : CONVERSATION_SHEET_MIRRORが有効なときの書き写し先
+    :param str sheet_name : 書き写し先のシート名
+    :return ConversationStore
+    """
+    write_behind = None
+    if CONVERSATION_SHEET_MIRROR and sheet is not None:
+        write_behind = SheetWriteBehind(sheet, sheet_name)
+    if CONVERSATION_STORE == "sqlite":
+        return SQLiteConversationStore(write_behind=write_behind)
+    if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        # 他のworkerに届いたリクエストとは状態を共有できない
+        conversation_error_out(
+            "CONVERSATION_STORE=memory is not shared by {} workers".format(
+                os.environ["WEB_CONCURRENCY"]
+            )
+        )
+    return MemoryConversationStore(write_behind=write_behind)
@@ -5,8 +5,6 @@ import sys
 from enum import Enum, auto
 from pprint import pprint
 
-import requests
-
 from settings import sc
 from workmanage import Shift, Work
 
@@ -248,6 +246,16 @@ def parse_shift2strlist(shift_list: list, need_name: bool):
     return return_str
 
 
+def make_echo_msg(responce_data) -> dict:
+    """
+    /dを受け付けたときに返す、入力されたコマンドを表示するメッセージを作る
+
+    :param object responce_data : slack slash commandが返すレスポンスデータ
+    :return dict : 投稿する文章を含んだdict
+    """
+    return make_msg("".join(["/d ", responce_data["text"]]))
+
+
 def ready_to_responce(responce_data):
     """
     slackからのレスポンスデータを受け取り/dの一連の対応を実行する。threadで別スレッド実行することを想定している。
@@ -257,12 +265,22 @@ def ready_to_responce(responce_data):
     args = "{}".format(responce_data["text"]).split(" ")
     slackid = responce_data["user_id"]
     response_url = responce_data["response_url"]
-    res = requests.post(
-        responce_data["response_url"],
-        json=json.loads(json.dumps(make_msg("".join(["/d ", responce_data["text"]])))),
-    )
+    # 入力されたコマンドの表示はmake_echo_msgで受け付けたときに返しているので、ここでは結果だけを送る。
+    # やり直しのたびに同じ表示を送らないため
     return_block = check_args(args, slackid)
-    res = requests.post(response_url, json=json.loads(json.dumps(return_block)))
+    res = sc.slack.respond(response_url, json.loads(json.dumps(return_block)))
+
+
+def is_retryable(responce_data) -> bool:
+    """
+    /dの処理が失敗したときに、初めからやり直してよいかを返す。
+    req、conはカレンダーに書き込むので、やり直すと2回書き込むことがある
+
+    :param object responce_data : slack slash commandが返すレスポンスデータ
+    :return bool : カレンダーに書き込まないコマンドならTrue
+    """
+    args = "{}".format(responce_data["text"]).split(" ")
+    return args[0] not in ["req", "con"]
 
 
 def check_args(args: list, slackId: str):
@@ -537,16 +555,11 @@ def cui_img(args: list, slackid: str):
 
     # 日付をもとに画像を作る
     try:
-        if args[index] in ("-w", "-W"):
-            shift = sc.get_week_shift(
-                base_date=date, grouping_by_week=True, fill_blank=True
-            )
-        else:
-            shift = sc.get_shift(date=date, fill_blank=True)
+        is_day = args[index] not in ("-w", "-W")
     except IndexError:
-        shift = sc.get_shift(date=date, fill_blank=True)
+        is_day = True
 
-    uploaded_file = sc.generate_shiftimg_url(shift=shift)
+    uploaded_file = sc.prerender.get(date, is_day)
     print("ok,upload success.")
 
     sc.record_use(slackid, sc.UseWay.COMM, sc.Actions.SHOWSHIFT)
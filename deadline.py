@@ -0,0 +1,130 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# スレッドごとの、いま処理している仕事のDeadline
+_current = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """
+    Deadlineの時間を使い切ったので、それ以上待たずに諦めるときの例外
+    """
+
+    pass
+
+
+class Deadline:
+    """
+    1つの仕事に使える時間と、各段階が使った時間を記録するクラス
+
+    activateしたスレッドでは、current_deadlineで取り出して描画やGoogleへのリクエストの
+    待ち時間をremainingまでに抑える。
+    """
+
+    def __init__(self, budget: float, start: float = None):
+        """
+        :param float budget : 使ってよい時間(秒)
+        :param float start : 計測の起点(time.monotonic)。Noneなら今
+        """
+        self.budget = budget
+        self.start = time.monotonic() if start is None else start
+        self.lock = threading.Lock()
+        # [(段階の名前, 使った時間)]
+        self.stages = []
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def remaining(self) -> float:
+        """
+        :return float : 残りの時間(秒)。超えていれば0
+        """
+        return max(self.budget - self.elapsed(), 0.0)
+
+    def expired(self) -> bool:
+        return self.elapsed() >= self.budget
+
+    def check(self, name: str = "work"):
+        """
+        :raises DeadlineExceeded : 時間を使い切っていたとき
+        """
+        if self.expired():
+            raise DeadlineExceeded(
+                "{} is over the deadline of {:.1f}s".format(name, self.budget)
+            )
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        with文の中の処理を段階nameとして計測する
+        """
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.add_stage(name, time.monotonic() - start)
+
+    def add_stage(self, name: str, used: float):
+        with self.lock:
+            self.stages.append((name, used))
+
+    @contextmanager
+    def activate(self):
+        """
+        with文の中では、このスレッドのcurrent_deadlineをこのDeadlineにする
+        """
+        with bind_deadline(self):
+            yield self
+
+    def report(self) -> str:
+        """
+        :return str : 全体と各段階の所要時間と、使ってよい時間に対する割合
+        """
+        with self.lock:
+            stages = list(self.stages)
+        return "total {:.2f}s/{:.1f}s ({})".format(
+            self.elapsed(),
+            self.budget,
+            ", ".join(
+                "{} {:.2f}s {:.0%}".format(name, used, used / self.budget)
+                for name, used in stages
+            ),
+        )
+
+
+@contextmanager
+def bind_deadline(deadline: Deadline):
+    """
+    with文の中では、このスレッドのcurrent_deadlineをdeadlineにする。別のスレッドに仕事を渡すときに使う
+
+    :param Deadline deadline : 引き継ぐDeadline。Noneなら何もしない
+    """
+    previous = getattr(_current, "deadline", None)
+    _current.deadline = deadline if deadline is not None else previous
+    try:
+        yield deadline
+    finally:
+        _current.deadline = previous
+
+
+def current_deadline() -> Deadline:
+    """
+    :return Deadline : このスレッドで処理している仕事のDeadline。なければNone
+    """
+    return getattr(_current, "deadline", None)
+
+
+def limit_timeout(timeout: float) -> float:
+    """
+    timeoutを、このスレッドのDeadlineの残りの時間までに抑える
+
+    :param float timeout : 本来の待ち時間(秒)。Noneなら無制限
+    :return float : 待ってよい時間(秒)
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return timeout
+    if timeout is None:
+        return deadline.remaining()
+    return min(timeout, deadline.remaining())
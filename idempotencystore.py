@@ -0,0 +1,247 @@
+import datetime as dt
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# 処理済みのリクエストの保存先 (memory / sqlite) と、覚えておく時間(秒)
+IDEMPOTENCY_STORE = os.environ.get("IDEMPOTENCY_STORE", "sqlite")
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 10 * 60))
+# memoryのときに覚えておく件数の上限
+IDEMPOTENCY_SIZE = int(os.environ.get("IDEMPOTENCY_SIZE", 1024))
+# sqliteを使うときのファイルのパス。gunicornの各workerで共有する
+IDEMPOTENCY_DB = os.environ.get(
+    "IDEMPOTENCY_DB", os.path.join(tempfile.gettempdir(), "daiko-idempotency.db")
+)
+# 処理中のリクエストを覚えておく時間(秒)。処理中にworkerが落ちても、これを過ぎれば処理し直せる
+IDEMPOTENCY_PENDING_TTL = 30
+
+
+def idempotency_error_out(text):
+    print(
+        "[{}]-IdempotencyStore {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class IdempotencyStore(ABC):
+    """
+    Slackからのリクエストをキーごとに1度だけ処理するため、処理中・処理済みのキーと応答を覚えておくクラス
+
+    beginでキーを確保できたリクエストだけを処理し、completeで応答を保存する。
+    同じキーのリクエストがもう一度届いたら、保存した応答を返すか、処理中なら何もせずに返す。
+    キーはttl秒で期限切れになる。実際の保存先はMemoryIdempotencyStore/SQLiteIdempotencyStoreが実装する。
+    """
+
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL):
+        """
+        :param int ttl : 処理済みのキーと応答を覚えておく時間(秒)
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    def begin(self, key: str) -> tuple:
+        """
+        キーを処理中として確保する
+
+        :param str key : リクエストのキー
+        :return tuple : (初めてのキーか, 処理済みなら保存した応答。処理中ならNone)
+        """
+        now = time.time()
+        first, response = self.claim(key, now, now + IDEMPOTENCY_PENDING_TTL)
+        if not first:
+            with self.lock:
+                self.duplicates += 1
+            idempotency_error_out(
+                "duplicate {} ({})".format(
+                    key, "in progress" if response is None else "replay response"
+                )
+            )
+        return first, response
+
+    def complete(self, key: str, response: dict):
+        """
+        処理が終わったので応答を保存する
+
+        :param str key : リクエストのキー
+        :param dict response : {"status": ステータスコード, "body": 本文, "mimetype": 形式}
+        """
+        self.save(key, response, time.time() + self.ttl)
+
+    def release(self, key: str):
+        """
+        処理に失敗したのでキーを手放し、再送されたリクエストを処理できるようにする
+        """
+        self.remove(key)
+
+    @abstractmethod
+    def claim(self, key: str, now: float, expires_at: float) -> tuple:
+        """
+        nowの時点で期限切れでなければ覚えている内容を返し、なければexpires_atまで処理中として覚える
+
+        :return tuple : beginと同じ
+        """
+
+    @abstractmethod
+    def save(self, key: str, response: dict, expires_at: float):
+        """
+        キーの応答をexpires_atまで覚える
+        """
+
+    @abstractmethod
+    def remove(self, key: str):
+        """
+        キーを忘れる
+        """
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"duplicates": self.duplicates}
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """
+    キーをプロセスのメモリに覚えておく。workerが1つのときに使う
+    """
+
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL, size: int = IDEMPOTENCY_SIZE):
+        """
+        :param int size : 覚えておく件数の上限。溢れたら古いものから忘れる
+        """
+        super().__init__(ttl)
+        self.size = size
+        # キー -> (応答。処理中ならNone, 期限)。後ろほど新しい
+        self.entries = OrderedDict()
+
+    def claim(self, key: str, now: float, expires_at: float) -> tuple:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                return False, entry[0]
+            self.entries.pop(key, None)
+            self.entries[key] = (None, expires_at)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return True, None
+
+    def save(self, key: str, response: dict, expires_at: float):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (dict(response), expires_at)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def remove(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """
+    キーをSQLiteのファイルに覚えておく。再送が別のworkerに届いても重複を見つけられる
+    """
+
+    def __init__(self, path: str = IDEMPOTENCY_DB, ttl: int = IDEMPOTENCY_TTL):
+        """
+        :param str path : SQLiteのファイルのパス
+        """
+        super().__init__(ttl)
+        self.path = path
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY,"
+                    " response TEXT, expires_at REAL NOT NULL)"
+                )
+        finally:
+            connection.close()
+
+    def connect(self):
+        # 接続はスレッドをまたいで使えないので、操作ごとに開く
+        return sqlite3.connect(self.path, timeout=10)
+
+    def claim(self, key: str, now: float, expires_at: float) -> tuple:
+        connection = self.connect()
+        try:
+            with connection:
+                # 期限切れのキーが溜まらないよう、確保のついでに掃除する
+                connection.execute(
+                    "DELETE FROM idempotency WHERE expires_at <= ?", (now,)
+                )
+                inserted = connection.execute(
+                    "INSERT OR IGNORE INTO idempotency VALUES (?, NULL, ?)",
+                    (key, expires_at),
+                ).rowcount
+                if inserted:
+                    return True, None
+                row = connection.execute(
+                    "SELECT response FROM idempotency WHERE key = ?", (key,)
+                ).fetchone()
+        finally:
+            connection.close()
+        return False, json.loads(row[0]) if row and row[0] else None
+
+    def save(self, key: str, response: dict, expires_at: float):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?)",
+                    (key, json.dumps(response, ensure_ascii=False), expires_at),
+                )
+        finally:
+            connection.close()
+
+    def remove(self, key: str):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+        finally:
+            connection.close()
+
+
+def make_idempotency_key(kind: str, data: dict) -> str:
+    """
+    Slackからのリクエストを見分けるキーを作る
+
+    Event APIはevent_id、slash commandとinteractive messageはtrigger_id、
+    trigger_idのないもの(dialog_submissionなど)はaction_tsを使う。
+
+    :param str kind : "event"、"command"、"interaction"のどれか
+    :param dict data : リクエストの内容
+    :return str : キー。見分けられないリクエストならNone
+    """
+    actions = data.get("actions") or [{}]
+    for value in (
+        data.get("event_id"),
+        data.get("trigger_id"),
+        data.get("action_ts"),
+        actions[0].get("action_ts"),
+    ):
+        if value:
+            return "{}:{}".format(kind, value)
+    return None
+
+
+def make_idempotency_store() -> IdempotencyStore:
+    """
+    IDEMPOTENCY_STOREの設定に応じたIdempotencyStoreを作る
+    """
+    if IDEMPOTENCY_STORE == "sqlite":
+        return SQLiteIdempotencyStore()
+    if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        # 他のworkerに届いたリクエストとは状態を共有できない
+        idempotency_error_out(
+            "IDEMPOTENCY_STORE=memory is not shared by {} workers".format(
+                os.environ["WEB_CONCURRENCY"]
+            )
+        )
+    return MemoryIdempotencyStore()
@@ -0,0 +1,211 @@
+import datetime as dt
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import requests
+
+from deadline import Deadline
+from slackclient import SlackClient, SlackRateLimitError
+
+# interactionを処理するスレッドの数
+INTERACTION_WORKERS = int(os.environ.get("INTERACTION_WORKERS", 4))
+# 1つのinteractionに使ってよい時間(秒)。超えたらエラーのメッセージを送り、結果は捨てる
+INTERACTION_DEADLINE = float(os.environ.get("INTERACTION_DEADLINE", 15))
+# 処理がこの秒数で終わらなければ、考え中のメッセージを先に送る
+INTERACTION_PROGRESS_AFTER = float(os.environ.get("INTERACTION_PROGRESS_AFTER", 1))
+
+# 処理が長引いたときに先に送るメッセージ
+PROGRESS_MESSAGE = {
+    "response_type": "ephemeral",
+    "blocks": [
+        {
+            "type": "section",
+            "text": {"type": "mrkdwn", "text": "now thinking... :thinking_face: "},
+        }
+    ],
+}
+
+
+def dispatcher_error_out(text):
+    print(
+        "[{}]-InteractionDispatcher {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class InteractionDispatcher:
+    """
+    slackのinteractionをすぐにackし、処理はスレッドプールで行ってresponse_urlに結果を送るクラス
+
+    slackは3秒以内に応答がないと失敗扱いにするので、HTTPの応答は処理を待たずに返す。
+    処理がprogress_after秒で終わらなければ、考え中のメッセージを先に送っておく。
+    deadline秒で終わらなければ、処理を待たずにエラーのメッセージを送り、遅れて出た結果は捨てる。
+    ただしカレンダーに書き込むhandlerは、エラーを送った後に書き込みが済むことがあるので、
+    時間切れにせず必ず本当の結果を送る。
+    各interactionの全体と段階ごとの所要時間はDeadlineに記録し、ログに出す。
+    """
+
+    def __init__(
+        self,
+        workers: int = INTERACTION_WORKERS,
+        deadline: float = INTERACTION_DEADLINE,
+        progress_after: float = INTERACTION_PROGRESS_AFTER,
+        error_message: dict = None,
+        slack: SlackClient = None,
+    ):
+        """
+        :param int workers : 処理するスレッドの数
+        :param float deadline : 1つのinteractionに使ってよい時間(秒)。待っていた時間も含む
+        :param float progress_after : 考え中のメッセージを送るまでの時間(秒)
+        :param dict error_message : handlerが失敗したときと時間切れのときに送るメッセージ
+        :param SlackClient slack : response_urlに送るのに使うSlackClient
+        """
+        self.deadline = deadline
+        self.progress_after = progress_after
+        self.error_message = error_message
+        self.slack = slack if slack is not None else SlackClient()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.handled = 0
+        self.overruns = 0
+        self.failures = 0
+        self.timeouts = 0
+        # 段階の名前 -> [回数, 合計の時間]
+        self.stage_totals = {}
+
+    def dispatch(self, name: str, response_url: str, handler, *args, writes=False):
+        """
+        handlerの実行を予約してすぐに返る
+
+        :param str name : ログに出すinteractionの名前
+        :param str response_url : 考え中のメッセージと結果を送るurl
+        :param function handler : handler(deadline, *args)の形で呼ばれ、送るメッセージを返す
+        :param bool writes : handlerがカレンダーに書き込むか。Trueなら始めた後は時間切れにしない
+        """
+        deadline = Deadline(self.deadline)
+        self.executor.submit(
+            self.run, name, response_url, handler, deadline, args, writes
+        )
+
+    def post(self, response_url: str, message: dict):
+        try:
+            self.slack.respond(response_url, message)
+        except (requests.RequestException, SlackRateLimitError) as e:
+            dispatcher_error_out("failed to post to response_url: {!r}".format(e))
+
+    def run(
+        self,
+        name: str,
+        response_url: str,
+        handler,
+        deadline: Deadline,
+        args,
+        writes: bool = False,
+    ):
+        # スレッドが空くのを待っていた時間
+        deadline.add_stage("queue", deadline.elapsed())
+        # 結果かエラーのメッセージを送ったか。
+        # 考え中のメッセージと時間切れのエラーが結果と入れ違わないよう、post_lockの中で見る
+        finished = False
+        post_lock = threading.Lock()
+
+        def send_progress():
+            with post_lock:
+                if finished:
+                    return
+                with deadline.stage("progress"):
+                    self.post(response_url, PROGRESS_MESSAGE)
+
+        def give_up():
+            nonlocal finished
+            with post_lock:
+                if finished:
+                    return
+                finished = True
+                with self.lock:
+                    self.timeouts += 1
+                dispatcher_error_out("{} is over the deadline".format(name))
+                if self.error_message is not None:
+                    self.post(response_url, self.error_message)
+
+        if deadline.expired():
+            # 待っている間に時間を使い切ったので、処理せずにエラーを送る。まだ何も書き込んでいない
+            give_up()
+            self.record(name, deadline)
+            return
+
+        timers = [
+            threading.Timer(
+                max(self.progress_after - deadline.elapsed(), 0), send_progress
+            )
+        ]
+        if not writes:
+            # 時間を使い切ったら、handlerを待たずにエラーを送る
+            timers.append(threading.Timer(deadline.remaining(), give_up))
+        for timer in timers:
+            timer.daemon = True
+            timer.start()
+
+        message = None
+        try:
+            # handlerから呼ばれる描画やGoogleへのリクエストは、current_deadlineで残りの時間を知る。
+            # 書き込むhandlerは、書き込んだ後の読み込みが時間切れで失敗しないようdeadlineを渡さない
+            with deadline.stage("handle"), (
+                deadline.activate() if not writes else nullcontext()
+            ):
+                message = handler(deadline, *args)
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+            dispatcher_error_out("{} failed: {!r}".format(name, e))
+            message = self.error_message
+        finally:
+            for timer in timers:
+                timer.cancel()
+
+        with post_lock:
+            if finished:
+                dispatcher_error_out(
+                    "{} finished too late, drop the result".format(name)
+                )
+            else:
+                finished = True
+                if message is not None:
+                    with deadline.stage("respond"):
+                        self.post(response_url, message)
+        self.record(name, deadline)
+
+    def record(self, name: str, deadline: Deadline):
+        overrun = deadline.expired()
+        with self.lock:
+            self.handled += 1
+            if overrun:
+                self.overruns += 1
+            for stage, used in deadline.stages:
+                count, total = self.stage_totals.get(stage, (0, 0.0))
+                self.stage_totals[stage] = (count + 1, total + used)
+        dispatcher_error_out(
+            "{}{}: {}".format(
+                name, " (over deadline)" if overrun else "", deadline.report()
+            )
+        )
+
+    def stats(self) -> dict:
+        """
+        :return dict : 処理した数、時間を超えた数、失敗した数、
+            時間切れでエラーを送った数、段階ごとの平均の時間(秒)
+        """
+        with self.lock:
+            return {
+                "handled": self.handled,
+                "overruns": self.overruns,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "stages": {
+                    stage: total / count
+                    for stage, (count, total) in self.stage_totals.items()
+                },
+            }
@@ -297,13 +297,8 @@ def get_shift_image(slackid, value):
         print("ok, type is button")
 
     return_block = copy.deepcopy(show_shift)
-    if is_day:
-        shift = sc.get_shift(date=date, fill_blank=True)
-    else:
-        shift = sc.get_week_shift(
-            base_date=date, grouping_by_week=True, fill_blank=True
-        )
-    uploaded_file = sc.generate_shiftimg_url(shift=shift)
+    # 日と週の両方の画像を描画しておき、切り替えられたら描画済みの方を返す
+    uploaded_file = sc.prerender.get(date, is_day)
     print("ok,upload success.")
     return_block["blocks"][0]["image_url"] = "{}".format(uploaded_file["url"])
     return_block["blocks"][0]["title"]["text"] = "{}".format(uploaded_file["filename"])
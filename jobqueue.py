@@ -0,0 +1,478 @@
+import datetime as dt
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# ジョブを保存するSQLiteのファイルのパス。gunicornの各workerで共有する
+JOB_QUEUE_DB = os.environ.get(
+    "JOB_QUEUE_DB", os.path.join(tempfile.gettempdir(), "daiko-jobs.db")
+)
+# ジョブを処理するスレッドの数(プロセスごと)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+# 待っているジョブと処理中のジョブを合わせて何件まで受け付けるか
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", 200))
+# 最初の試行を含めた試行回数の上限
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+# 1回目のリトライまでの待ち時間の上限(秒)と、1回の待ち時間の上限(秒)
+JOB_RETRY_BASE_DELAY = float(os.environ.get("JOB_RETRY_BASE_DELAY", 2))
+JOB_RETRY_MAX_DELAY = float(os.environ.get("JOB_RETRY_MAX_DELAY", 60))
+# 処理中のジョブが何秒で終わらなければ、workerが落ちたとみなして他のworkerに渡すか
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get("JOB_VISIBILITY_TIMEOUT", 120))
+# 終わったジョブを何秒残しておくか
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", 24 * 60 * 60))
+# ジョブがないときに、他のプロセスが入れたジョブを見に行く間隔(秒)
+JOB_POLL_INTERVAL = 1
+
+
+def job_error_out(text):
+    print(
+        "[{}]-JobQueue {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class JobQueueFullError(Exception):
+    """
+    待っているジョブがJOB_QUEUE_LIMIT件を超えたときの例外
+    """
+
+    pass
+
+
+class JobQueue:
+    """
+    ジョブをSQLiteのファイルに保存し、決まった数のスレッドで処理するクラス
+
+    ジョブは処理が終わるまでファイルに残るので、gunicornがworkerを入れ替えても失われない。
+    処理中のジョブは期限をvisibility_timeout秒先に延ばし続けて他のスレッドやプロセスに渡さず、
+    期限が切れたら、処理していたworkerが落ちたとみなして他のworkerが引き取る。
+    登録時のretryableがTrueを返すジョブは、失敗するか引き取られたら
+    間隔を指数的に伸ばしながらmax_attempts回まで試す。
+    そうでないジョブは書き込みを2回行わないよう、handlerを始めたら処理し直さない。
+    諦めたジョブは登録時のon_give_upを呼ぶ。
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(
+        self,
+        path: str = JOB_QUEUE_DB,
+        workers: int = JOB_WORKERS,
+        limit: int = JOB_QUEUE_LIMIT,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        base_delay: float = JOB_RETRY_BASE_DELAY,
+        max_delay: float = JOB_RETRY_MAX_DELAY,
+        visibility_timeout: float = JOB_VISIBILITY_TIMEOUT,
+        retention: float = JOB_RETENTION,
+    ):
+        """
+        :param str path : SQLiteのファイルのパス
+        :param int workers : ジョブを処理するスレッドの数
+        :param int limit : 待っているジョブと処理中のジョブを合わせた件数の上限
+        :param int max_attempts : 最初の試行を含めた試行回数の上限
+        :param float base_delay : 1回目のリトライまでの待ち時間の上限(秒)
+        :param float max_delay : 1回の待ち時間の上限(秒)
+        :param float visibility_timeout : 処理中のジョブを他に渡さない時間(秒)
+        :param float retention : 終わったジョブを残しておく時間(秒)
+        """
+        self.path = path
+        self.workers = workers
+        self.limit = limit
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.visibility_timeout = visibility_timeout
+        self.retention = retention
+        # 種類 -> (handler, on_give_up, retryable)
+        self.handlers = {}
+        self.threads = []
+        # このプロセスで処理中のジョブのid -> 試行回数。期限を延ばすのに使う
+        self.running = {}
+        # ジョブが入ったことを待っているスレッドに知らせる
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.rejected = 0
+        self.lost = 0
+        self.wait_total = 0.0
+        connection = self.connect()
+        try:
+            # 読み込みと書き込みが互いを待たないようにする
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " kind TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL,"
+                    " attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL,"
+                    " lease_until REAL, created_at REAL NOT NULL,"
+                    " updated_at REAL NOT NULL, last_error TEXT)"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS jobs_status"
+                    " ON jobs (status, available_at)"
+                )
+        finally:
+            connection.close()
+
+    def connect(self):
+        # 接続はスレッドをまたいで使えないので、操作ごとに開く
+        return sqlite3.connect(self.path, timeout=10)
+
+    def register(self, kind: str, handler, on_give_up=None, retryable=None):
+        """
+        ジョブの種類と、それを処理する関数を登録する
+
+        :param str kind : ジョブの種類
+        :param function handler : handler(payload)の形で呼ばれる。例外を投げたら失敗
+        :param function on_give_up : ジョブを諦めたとき、on_give_up(payload, error)の形で呼ばれる
+        :param function retryable : retryable(payload)の形で呼ばれ、Trueなら処理し直してよい。
+            書き込みを伴うジョブはFalseを返すこと。Noneなら全て処理し直さない
+        """
+        self.handlers[kind] = (handler, on_give_up, retryable)
+
+    def start(self):
+        """
+        ジョブを処理するスレッドを起動する
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work, name="JobQueue-{}".format(index), daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+            thread = threading.Thread(
+                target=self.heartbeat, name="JobQueue-heartbeat", daemon=True
+            )
+            thread.start()
+
+    def enqueue(self, kind: str, payload: dict) -> int:
+        """
+        ジョブをファイルに保存する。処理は待たない
+
+        :param str kind : ジョブの種類
+        :param dict payload : handlerに渡すデータ。jsonにできるもの
+        :return int : ジョブのid
+        :raises JobQueueFullError : 待っているジョブがlimit件を超えているとき
+        """
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                pending = connection.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)",
+                    (self.QUEUED, self.RUNNING),
+                ).fetchone()[0]
+                if pending >= self.limit:
+                    with self.lock:
+                        self.rejected += 1
+                    raise JobQueueFullError(
+                        "{} jobs are waiting, reject {}".format(pending, kind)
+                    )
+                job_id = connection.execute(
+                    "INSERT INTO jobs (kind, payload, status, available_at, created_at,"
+                    " updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        kind,
+                        json.dumps(payload, ensure_ascii=False),
+                        self.QUEUED,
+                        now,
+                        now,
+                        now,
+                    ),
+                ).lastrowid
+                # 終わったジョブが溜まらないよう、書き込みのついでに掃除する
+                connection.execute(
+                    "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at <= ?",
+                    (self.DONE, self.FAILED, now - self.retention),
+                )
+        finally:
+            connection.close()
+        self.wakeup.set()
+        return job_id
+
+    def claim(self) -> tuple:
+        """
+        処理できるジョブを1件取り出し、visibility_timeout秒の間は他に渡さないようにする
+
+        :return tuple : (id, 種類, payload, 試行回数, 待っていた時間,
+            期限切れの処理中のジョブを引き取ったか)。なければNone
+        """
+        now = time.time()
+        connection = self.connect()
+        try:
+            # 複数のプロセスが同じジョブを取り出さないよう、読む前に書き込みのlockを取る
+            connection.isolation_level = None
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT id, kind, payload, attempts, available_at, status FROM jobs"
+                    " WHERE (status = ? AND available_at <= ?)"
+                    " OR (status = ? AND lease_until <= ?)"
+                    " ORDER BY available_at, id LIMIT 1",
+                    (self.QUEUED, now, self.RUNNING, now),
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1,"
+                        " lease_until = ?, updated_at = ? WHERE id = ?",
+                        (self.RUNNING, now + self.visibility_timeout, now, row[0]),
+                    )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        job_id, kind, payload, attempts, available_at, status = row
+        return (
+            job_id,
+            kind,
+            json.loads(payload),
+            attempts + 1,
+            now - available_at,
+            status == self.RUNNING,
+        )
+
+    def finish(self, job_id: int, attempt: int, status: str, **columns) -> bool:
+        """
+        ジョブの状態を更新する。期限が切れて他に渡っていたら何もしない
+
+        :return bool : 更新できたか
+        """
+        columns.update(status=status, updated_at=time.time(), lease_until=None)
+        connection = self.connect()
+        try:
+            with connection:
+                updated = connection.execute(
+                    "UPDATE jobs SET {} WHERE id = ? AND status = ? AND attempts = ?".format(
+                        ", ".join("{} = ?".format(column) for column in columns)
+                    ),
+                    list(columns.values()) + [job_id, self.RUNNING, attempt],
+                ).rowcount
+        finally:
+            connection.close()
+        if not updated:
+            with self.lock:
+                self.lost += 1
+            job_error_out(
+                "job#{} was taken over by another worker, drop its {}".format(
+                    job_id, status
+                )
+            )
+        return bool(updated)
+
+    def calc_delay(self, attempt: int) -> float:
+        """
+        attempt回目の失敗の後に待つ時間を返す
+        """
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+
+    def give_up(self, job_id: int, kind: str, payload: dict, attempt: int, error):
+        if not self.finish(job_id, attempt, self.FAILED, last_error=repr(error)):
+            return
+        with self.lock:
+            self.failed += 1
+        job_error_out(
+            "give up {}#{} after {} attempts: {!r}".format(kind, job_id, attempt, error)
+        )
+        on_give_up = self.handlers.get(kind, (None, None, None))[1]
+        if on_give_up is None:
+            return
+        try:
+            on_give_up(payload, error)
+        except Exception as give_up_error:
+            job_error_out(
+                "on_give_up of {}#{} failed: {!r}".format(kind, job_id, give_up_error)
+            )
+
+    def run(self, job_id: int, kind: str, payload: dict, attempt: int, reclaimed: bool):
+        handler, _, retryable = self.handlers.get(kind, (None, None, None))
+        can_retry = handler is not None and retryable is not None and retryable(payload)
+        if reclaimed and not can_retry:
+            # 処理していたworkerが落ちた。書き込みが済んだかわからないので処理し直さない
+            self.give_up(
+                job_id,
+                kind,
+                payload,
+                attempt,
+                TimeoutError("the worker stopped while running the job"),
+            )
+            return
+
+        error = None
+        with self.lock:
+            self.running[job_id] = attempt
+        try:
+            if handler is None:
+                raise KeyError("no handler for {}".format(kind))
+            if attempt > self.max_attempts:
+                # 処理中にworkerが落ちて引き取られることが続いた
+                raise TimeoutError("the worker stopped while running the job")
+            handler(payload)
+        except Exception as e:
+            error = e
+        finally:
+            with self.lock:
+                self.running.pop(job_id, None)
+
+        if error is None:
+            if self.finish(job_id, attempt, self.DONE):
+                with self.lock:
+                    self.completed += 1
+            return
+        if not can_retry or attempt >= self.max_attempts:
+            self.give_up(job_id, kind, payload, attempt, error)
+            return
+        delay = self.calc_delay(attempt)
+        if self.finish(
+            job_id,
+            attempt,
+            self.QUEUED,
+            available_at=time.time() + delay,
+            last_error=repr(error),
+        ):
+            with self.lock:
+                self.retried += 1
+            job_error_out(
+                "retry {}#{} in {:.2f}s ({}/{}): {!r}".format(
+                    kind, job_id, delay, attempt, self.max_attempts, error
+                )
+            )
+
+    def heartbeat(self):
+        """
+        このプロセスで処理中のジョブの期限を延ばし続けるスレッドの本体
+        """
+        while True:
+            time.sleep(self.visibility_timeout / 3)
+            with self.lock:
+                running = list(self.running.items())
+            if not running:
+                continue
+            connection = self.connect()
+            try:
+                with connection:
+                    connection.executemany(
+                        "UPDATE jobs SET lease_until = ?"
+                        " WHERE id = ? AND status = ? AND attempts = ?",
+                        [
+                            (
+                                time.time() + self.visibility_timeout,
+                                job_id,
+                                self.RUNNING,
+                                attempt,
+                            )
+                            for job_id, attempt in running
+                        ],
+                    )
+            except sqlite3.Error as e:
+                job_error_out("failed to extend leases: {!r}".format(e))
+            finally:
+                connection.close()
+
+    def work(self):
+        """
+        ジョブを処理するスレッドの本体
+        """
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.Error as e:
+                job_error_out("failed to claim a job: {!r}".format(e))
+                job = None
+            if job is None:
+                # 他のプロセスが入れたジョブやリトライを待つ時間があるので、ときどき見に行く
+                self.wakeup.wait(JOB_POLL_INTERVAL)
+                self.wakeup.clear()
+                continue
+            job_id, kind, payload, attempt, waited, reclaimed = job
+            with self.lock:
+                self.wait_total += max(waited, 0.0)
+            self.run(job_id, kind, payload, attempt, reclaimed)
+
+    def list_jobs(self, limit: int = 50) -> list:
+        """
+        :param int limit : 返す件数
+        :return list : 新しい順のジョブ。payloadは含めない
+        """
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                "SELECT id, kind, status, attempts, available_at, created_at,"
+                " updated_at, last_error FROM jobs ORDER BY id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        finally:
+            connection.close()
+        return [
+            {
+                "id": job_id,
+                "kind": kind,
+                "status": status,
+                "attempts": attempts,
+                "available_at": dt.datetime.fromtimestamp(available_at).isoformat(),
+                "created_at": dt.datetime.fromtimestamp(created_at).isoformat(),
+                "updated_at": dt.datetime.fromtimestamp(updated_at).isoformat(),
+                "last_error": last_error,
+            }
+            for (
+                job_id,
+                kind,
+                status,
+                attempts,
+                available_at,
+                created_at,
+                updated_at,
+                last_error,
+            ) in rows
+        ]
+
+    def stats(self) -> dict:
+        """
+        :return dict : 状態ごとのジョブの件数、最も古い待っているジョブの待ち時間(秒)と、
+            このプロセスで処理中の件数、処理した件数、リトライした件数、諦めた件数、断った件数、
+            期限が切れて他に渡っていたので結果を捨てた件数、平均の待ち時間(秒)
+        """
+        connection = self.connect()
+        try:
+            counts = dict(
+                connection.execute(
+                    "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+                ).fetchall()
+            )
+            oldest = connection.execute(
+                "SELECT MIN(available_at) FROM jobs WHERE status = ?", (self.QUEUED,)
+            ).fetchone()[0]
+        finally:
+            connection.close()
+        with self.lock:
+            handled = self.completed + self.retried + self.failed + self.lost
+            return {
+                "jobs": counts,
+                "oldest_queued": max(time.time() - oldest, 0.0) if oldest else 0.0,
+                "workers": len(self.threads),
+                "running": len(self.running),
+                "completed": self.completed,
+                "retried": self.retried,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "lost": self.lost,
+                "wait_avg": self.wait_total / handled if handled else 0.0,
+            }
@@ -3,23 +3,34 @@ import json
 import logging
 import os
 import sys
-import threading
 import time
 from ast import literal_eval
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from logging import StreamHandler
 from pprint import pformat, pprint
 
 import requests
 # from chatmessage import start_chatmessage_process
-from cuimessage import make_msg, ready_to_responce
+from cuimessage import is_retryable, make_echo_msg, make_msg, ready_to_responce
 from flask import Flask, jsonify, redirect, render_template, request, url_for
 from flask_httpauth import HTTPDigestAuth
+from idempotencystore import make_idempotency_key, make_idempotency_store
+from interactiondispatcher import InteractionDispatcher
 from interactivemessages import csv_to_dict, get_block
+from jobqueue import JobQueue, JobQueueFullError
+from renderexecutor import RenderBusyError
 from settings import *
-from settings import ADD_TOKEN, header, sc
+from settings import ADD_TOKEN, sc
+from shiftimgcache import SHIFT_IMAGE_MIMETYPES
 from shiftregistrationapi import parse_formdata
+from slackclient import SLACK_TRIGGER_WAIT, SlackRateLimitError
 
 app = Flask(__name__)
+dispatcher = InteractionDispatcher(error_message=get_block("error"), slack=sc.slack)
+# /dの処理はファイルに保存してから決まった数のスレッドで行う
+jobs = JobQueue()
+# Slackから再送されたリクエストを見分けるため、処理済みのリクエストの応答を覚えておく
+idempotency = make_idempotency_store()
 app.config["SECRET_KEY"] = "qwertyuiop"
 app.debug = True
 # file_handler = StreamHandler()
@@ -44,13 +55,13 @@ def show_entries():
 
 @app.route("/get-users")
 def get_users_dict():
-    return jsonify(sc.sheet.get_slackId2name_dict())
+    return jsonify(sc.members.get_slackId2name_dict())
 
 
 @app.route("/reg-form")
 @auth.login_required
 def show_registry_page():
-    name_dict = sc.sheet.get_slackId2name_dict()
+    name_dict = sc.members.get_slackId2name_dict()
     pprint(name_dict, stream=sys.stderr)
     return render_template(
         "regist.html", members=zip(name_dict.keys(), name_dict.values()), title="www"
@@ -77,18 +88,79 @@ def api_for_slack():
 
     if request.data.decode():
         # request.dataがあるのはfrom Event API
-        return event_api(json.loads(request.data.decode()))
+        data = json.loads(request.data.decode())
+        return deduplicate(make_idempotency_key("event", data), event_api, data)
     elif request.form.get("payload"):
         # request.form["payload"]があるのは interactive message
-        return interactive_message(json.loads(request.form.get("payload")))
+        data = json.loads(request.form.get("payload"))
+        return deduplicate(
+            make_idempotency_key("interaction", data), interactive_message, data
+        )
     elif request.form.get("command"):
         # request.form["command"]があるのは slash command
-        return command(request.form)
+        return deduplicate(
+            make_idempotency_key("command", request.form), command, request.form
+        )
 
     # 該当がなければ空を返す
     return ""
 
 
+def deduplicate(key: str, handler, data: dict):
+    """
+
+    同じキーのリクエストは1度だけhandlerで処理する
+
+    処理が遅いとSlackはX-Slack-Retry-Numを付けて同じリクエストを再送してくる。
+    再送されたリクエストは、最初のリクエストの処理が終わっていればその応答を返し、
+    処理中であれば何もせずに返す。
+
+
+    Args:
+        key (str): make_idempotency_keyで作ったキー。Noneなら毎回処理する
+        handler (function): リクエストを処理する関数
+        data (dict): slackからのリクエストの内容
+
+    Returns:
+        Response : handlerの応答か、覚えておいた応答
+
+    """
+    if key is None:
+        return handler(data)
+
+    first, cached = idempotency.begin(key)
+    if not first:
+        app.logger.warning(
+            "ignore {} (retry {}, {})".format(
+                key,
+                request.headers.get("X-Slack-Retry-Num"),
+                request.headers.get("X-Slack-Retry-Reason"),
+            )
+        )
+        if cached is None:
+            # 最初のリクエストを処理中なので、これ以上再送しないよう伝える
+            return "", 200, {"X-Slack-No-Retry": "1"}
+        return app.response_class(
+            cached["body"], status=cached["status"], mimetype=cached["mimetype"]
+        )
+
+    try:
+        response = app.make_response(handler(data))
+    except Exception:
+        # 再送されたときに処理し直せるようにする
+        idempotency.release(key)
+        raise
+    idempotency.complete(
+        key,
+        {
+            "status": response.status_code,
+            "body": response.get_data(as_text=True),
+            "mimetype": response.mimetype,
+        },
+    )
+    return response
+
+
 def command(data: dict):
     """
 
@@ -102,7 +174,9 @@ def command(data: dict):
         str : slackからのリクエストに応じた応答文字列
 
     Note:
-        * "/d"で呼び出されたときは空文字を返す。実際のレスポンスは別スレッドにて行う。
+        * "/d"で呼び出されたときは入力されたコマンドを表示するメッセージを返す。
+          実際のレスポンスはjobsのスレッドにて行う。
+          受け付けられる数を超えていれば、混み合っている旨のメッセージを返す。
         * "/daiko"で呼び出されたときはメニューUIのjsonを返す。
     """
 
@@ -111,10 +185,18 @@ def command(data: dict):
         return ""
 
     if data.get("command") == "/d":
-        thread = threading.Thread(target=ready_to_responce, args=(data,))
-        thread.start()
+        # tokenは保存しない
+        payload = {key: value for key, value in data.items() if key != "token"}
+        try:
+            jobs.enqueue("/d", payload)
+        except JobQueueFullError as e:
+            app.logger.warning(str(e))
+            return jsonify(
+                make_msg("混み合っています。しばらくしてからもう一度試してください")
+            )
 
-        return ""
+        # 入力されたコマンドの表示は、ジョブを何度やり直しても1度だけになるようここで返す
+        return jsonify(make_echo_msg(data))
     elif data.get("command") == "/daiko":
         return_dict = get_block("select_action", slack_id=data["user_id"])
         return jsonify(return_dict)
@@ -122,6 +204,26 @@ def command(data: dict):
     return ""
 
 
+def give_up_command(data: dict, error: Exception):
+    """
+
+    "/d"の処理を諦めたときに、エラーのメッセージを送る
+
+
+    Args:
+        data (dict): 保存しておいたslackからのリクエストの内容
+        error (Exception): 最後の試行で発生した例外
+
+    """
+    sc.slack.respond(data["response_url"], get_block("error"))
+
+
+jobs.register(
+    "/d", ready_to_responce, on_give_up=give_up_command, retryable=is_retryable
+)
+jobs.start()
+
+
 def validate_requesttimes(responce_data: dict, state: dict) -> list:
 
     base_start = dt.datetime.strptime(str(state["start"]), "%H:%M")
@@ -194,10 +296,10 @@ def interactive_message(data: dict):
         if data["callback_id"] in ("Request", "Contract"):
             error_list = validate_requesttimes(responce_data, state)
         elif data["callback_id"] == "Addname":
-            use_db.add(data["user"]["id"], responce_data["name"])
+            sc.members.add(data["user"]["id"], responce_data["name"])
             return_block = get_block("select_action", value=responce_data["name"])
-            res = requests.post(
-                data["response_url"], json=json.loads(json.dumps(return_block))
+            res = sc.slack.respond(
+                data["response_url"], json.loads(json.dumps(return_block))
             )
             print(res.text)
             return ""
@@ -225,41 +327,97 @@ def interactive_message(data: dict):
                 "contract_dialog_ok", target=responce_data, value=new_value
             )
 
-        res = requests.post(
-            data["response_url"], json=json.loads(json.dumps(return_block))
+        res = sc.slack.respond(
+            data["response_url"], json.loads(json.dumps(return_block))
         )
         print(res.text)
         return ""
 
     elif data["type"] == "dialog_cancellation":
         return_block = get_block("cancel")
-        res = requests.post(
-            data["response_url"], json=json.loads(json.dumps(return_block))
+        res = sc.slack.respond(
+            data["response_url"], json.loads(json.dumps(return_block))
         )
         print(res.text)
         return jsonify({"status": "ok"})
     elif data["type"] == "block_actions":
+        if data["actions"][0].get("block_id") == "select_shift":
+            # trigger_idは3秒で期限が切れるので、dispatcherのキューに入れずにここでdialogを開く
+            open_dialog(data)
+            return jsonify({"status": "ok"})
+        # 3秒以内にackを返すため、処理はdispatcherに任せて結果はresponse_urlに送る
+        block_id = data["actions"][0].get("block_id")
+        dispatcher.dispatch(
+            "block_actions:{}".format(block_id),
+            data["response_url"],
+            block_actions,
+            data,
+            # 代行依頼/代行の確定はカレンダーに書き込むので、時間切れで失敗を伝えない
+            writes=block_id in ("confirm_request", "confirm_contract"),
+        )
+        return jsonify({"status": "ok"})
+
+    if not return_block:
+        return_block = get_block("error")
+
+    res = sc.slack.respond(data["response_url"], json.loads(json.dumps(return_block)))
+    return jsonify({"status": "ok"})
+
+
+def open_dialog(data: dict):
+    """
+
+    シフトが選ばれたので、代行依頼/請負の申請のdialogを開く
+
+
+    Args:
+        data (dict): slackからのリクエストの内容
+
+    Note:
+        * dialogを開けなかったときは、response_urlにエラーのメッセージを送る。
+
+    """
+    responce_action = data["actions"][0]
+    return_block = get_block(
+        responce_action["block_id"],
+        eventid=responce_action["selected_option"]["value"],
+        value=responce_action["action_id"],
+    )
+    return_block["trigger_id"] = data["trigger_id"]
 
-        # block_actionsへの返答には一旦考え中メッセージを返す
-        loading_message = {
-            "response_type": "ephemeral",
-            "blocks": [
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": "now thinking... :thinking_face: ",
-                    },
-                }
-            ],
-        }
-        res = requests.post(
-            json.loads(request.form["payload"])["response_url"],
-            json=json.loads(json.dumps(loading_message)),
+    try:
+        res = sc.slack.api(
+            "dialog.open",
+            json.loads(json.dumps(return_block)),
+            rate_wait=SLACK_TRIGGER_WAIT,
+        )
+    except (requests.RequestException, SlackRateLimitError, ValueError) as e:
+        res = {"ok": False, "error": repr(e)}
+    print(res)
+    if not res.get("ok"):
+        dispatcher.dispatch(
+            "dialog.open", data["response_url"], lambda deadline: get_block("error")
         )
 
-        responce_action = data["actions"][0]
 
+def block_actions(deadline, data: dict) -> dict:
+    """
+
+    block要素を含むメッセージが送出したデータを処理する。InteractionDispatcherのスレッドで呼ばれる
+
+
+    Args:
+        deadline (Deadline): このinteractionに使える時間と、各段階の所要時間の記録
+        data (dict): slackからのリクエストの内容
+
+    Returns:
+        dict : response_urlに送るメッセージ
+
+    """
+    return_block = None
+    responce_action = data["actions"][0]
+
+    with deadline.stage("get_block"):
         if responce_action["block_id"] == "select_date":
             return_block = get_block(
                 (
@@ -270,21 +428,6 @@ def interactive_message(data: dict):
                 date=responce_action["selected_date"],
                 slack_id=data["user"]["id"],
             )
-        elif responce_action["block_id"] == "select_shift":
-
-            return_block = get_block(
-                responce_action["block_id"],
-                eventid=responce_action["selected_option"]["value"],
-                value=responce_action["action_id"],
-            )
-            return_block["trigger_id"] = data["trigger_id"]
-
-            res = requests.post(
-                "https://slack.com/api/dialog.open",
-                json=json.loads(json.dumps(return_block)),
-                headers=header,
-            )
-            print(res.text)
         elif responce_action["block_id"] in ["confirm_request", "confirm_contract"]:
             return_block = get_block(
                 responce_action["block_id"],
@@ -311,9 +454,7 @@ def interactive_message(data: dict):
 
     if not return_block:
         return_block = get_block("error")
-
-    res = requests.post(data["response_url"], json=json.loads(json.dumps(return_block)))
-    return jsonify({"status": "ok"})
+    return json.loads(json.dumps(return_block))
 
 
 def event_api(data: dict):
@@ -345,6 +486,71 @@ def event_api(data: dict):
     return ""
 
 
+@app.route("/google-push", methods=["POST"])
+def google_push():
+    """
+
+    GoogleCalendarの変更通知(events.watch)を受け取り、シフトの複製を更新する
+
+    Returns:
+        str : 空文字。通知が検証できなければ403
+
+    """
+    changed = sc.receive_calendar_notice(
+        request.headers.get("X-Goog-Channel-Token"),
+        request.headers.get("X-Goog-Resource-State"),
+    )
+    if changed is None:
+        return "", 403
+
+    app.logger.info(
+        "calendar changed: {}".format(sorted(date.isoformat() for date in changed))
+    )
+    return ""
+
+
+@app.route("/shift-img/<key>.<extension>")
+def shift_img(key, extension):
+    """
+    generate_shiftimg_urlで描画したシフトの画像を配信する
+
+    画像はシフトの内容から決まるキーで引くので、キーをそのままETagに使い、長くキャッシュさせる。
+    保存した画像が消えていれば、urlに載せたシフトの内容から描き直す
+
+    Returns:
+        Response : 画像。If-None-Matchが一致すれば304、画像がなければ404、描画が混んでいれば503
+
+    """
+    if extension not in SHIFT_IMAGE_MIMETYPES:
+        return "", 404
+    try:
+        image = sc.load_shiftimg(key, extension, request.args.get("s"))
+    except (RenderBusyError, FutureTimeoutError):
+        return "", 503, {"Retry-After": "5"}
+    if image is None:
+        return "", 404
+
+    response = app.response_class(image, mimetype=SHIFT_IMAGE_MIMETYPES[extension])
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = 7 * 24 * 60 * 60
+    return response.make_conditional(request)
+
+
+@app.route("/jobs")
+@auth.login_required
+def show_jobs():
+    """
+
+    "/d"の処理を待っているジョブの状況を返す
+
+    Returns:
+        Response : jobsの統計と、新しい順のジョブの一覧のjson
+
+    """
+    return jsonify({"stats": jobs.stats(), "jobs": jobs.list_jobs()})
+
+
 @app.route("/shiftimg-test", methods=["GET", "POST"])
 def img_test():
     print(request.form["user_id"])
@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+
+# メンバー一覧を読み直す間隔(秒)
+MEMBER_DIRECTORY_TTL = int(os.environ.get("MEMBER_DIRECTORY_TTL", 10 * 60))
+# 知らないslackid/名前を引かれたときに読み直す最短の間隔(秒)
+MEMBER_DIRECTORY_MIN_RELOAD = 30
+
+
+class MemberDirectory:
+    """
+    メンバー一覧のシート("name-id")を読み込んで、slackidと名前を相互に引けるようにしておくクラス
+
+    シートはttl秒ごと、もしくはinvalidateされた後の最初の参照時に読み直す。
+    知らないslackid/名前を引かれたときは、シートに直接追記されたかもしれないので1度だけ読み直す。
+    """
+
+    def __init__(self, sheet, ttl: int = MEMBER_DIRECTORY_TTL):
+        """
+        :param GoogleSpreadSheet sheet : メンバー一覧を読み書きするGoogleSpreadSheet
+        :param int ttl : 読み直す間隔(秒)
+        """
+        self.sheet = sheet
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.id2name = {}
+        self.name2id = {}
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def is_fresh(self) -> bool:
+        return (
+            self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+        )
+
+    def load(self):
+        """
+        シートを読み込んで索引を作り直す。lockを取得してから呼ぶこと
+        """
+        values_list = self.sheet.get(self.sheet.USERID_SHEET_NAME) or [[], []]
+        self.id2name = dict(zip(values_list[0], values_list[1]))
+        self.name2id = dict(zip(values_list[1], values_list[0]))
+        self.loaded_at = time.monotonic()
+
+    def lookup(self, index: str, key: str) -> str:
+        """
+        索引からkeyを引く。古ければ、もしくは見つからなければ読み直す
+
+        :param str index : 使う索引 ("id2name" もしくは "name2id")
+        :param str key : 引くslackidもしくは名前
+        :return str : 見つかった名前もしくはslackid
+        :raises KeyError : 読み直しても見つからないとき
+        """
+        with self.lock:
+            if self.is_fresh() and key in getattr(self, index):
+                self.hits += 1
+                return getattr(self, index)[key]
+            self.misses += 1
+            if (
+                not self.is_fresh()
+                or time.monotonic() - self.loaded_at > MEMBER_DIRECTORY_MIN_RELOAD
+            ):
+                self.load()
+            return getattr(self, index)[key]
+
+    def slackid2name(self, slackid: str) -> str:
+        return self.lookup("id2name", slackid)
+
+    def name2slackid(self, name: str) -> str:
+        return self.lookup("name2id", name)
+
+    def get_slackId2name_dict(self, toName=True) -> dict:
+        """
+        GoogleSpreadSheet.get_slackId2name_dictと同じ形の辞書を返す
+
+        :param bool toName : Trueならslackid -> 名前、Falseなら名前 -> slackid
+        :return dict : 索引の複製
+        """
+        with self.lock:
+            if self.is_fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.load()
+            return dict(self.id2name if toName else self.name2id)
+
+    def add(self, slackid: str, name: str):
+        """
+        メンバーをシートに追記し、次の参照時に読み直させる
+
+        :param str slackid : 追加するメンバーのslackid
+        :param str name : 追加するメンバーのシフト表上の名前
+        """
+        self.sheet.append([slackid, name], self.sheet.USERID_SHEET_NAME)
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def stats(self) -> dict:
+        """
+        :return dict : 索引から返せた回数、読み直しが必要だった回数、登録人数
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "members": len(self.id2name),
+            }
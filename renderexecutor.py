@@ -0,0 +1,228 @@
+import datetime as dt
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from deadline import limit_timeout
+from workmanage import DrawShiftImg, Work, load_font
+
+# シフト画像を描画するプロセスの数。0ならリクエストのスレッドでそのまま描画する
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2))
+# 描画待ちと描画中を合わせて何枚まで受け付けるか
+RENDER_QUEUE_DEPTH = int(os.environ.get("RENDER_QUEUE_DEPTH", 8))
+# 受け付けを待つ時間と、描画を待つ時間(秒)
+RENDER_TIMEOUT = float(os.environ.get("RENDER_TIMEOUT", 20))
+# DrawShiftImgが使うフォントの大きさ。描画用のプロセスの起動時に読み込んでおく
+RENDER_FONT_SIZES = (15, 25, 35, 100)
+
+
+def render_error_out(text):
+    print(
+        "[{}]-RenderExecutor {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class RenderBusyError(Exception):
+    """
+    描画待ちの画像がRENDER_QUEUE_DEPTH枚を超えたままRENDER_TIMEOUT秒経ったときの例外
+    """
+
+    pass
+
+
+def dump_shift(shift: list) -> list:
+    """
+    シフトを別のプロセスに渡せる形にする
+
+    :param list shift : 1日分のWorkのリストか、日ごとのWorkのリストのリスト
+    :return list : Work.to_dictの結果を同じ形に並べたもの
+    """
+    return [
+        [work.to_dict() for work in day] if isinstance(day, list) else day.to_dict()
+        for day in shift
+    ]
+
+
+def load_shift(data: list) -> list:
+    """
+    dump_shiftの結果からシフトを作り直す
+    """
+    return [
+        (
+            [Work.from_dict(work) for work in day]
+            if isinstance(day, list)
+            else Work.from_dict(day)
+        )
+        for day in data
+    ]
+
+
+def warm_up(font: str):
+    """
+    描画用のプロセスの起動時に呼ばれ、フォントを読み込んでおく
+    """
+    for size in RENDER_FONT_SIZES:
+        load_font(font, size)
+
+
+def render_shift(data: list, font: str, image_format: str) -> dict:
+    """
+    描画用のプロセスで、シフト画像を描画してエンコードする
+
+    :param list data : dump_shiftの結果
+    :param str font : フォントファイルのパス
+    :param str image_format : エンコード形式
+    :return dict : DrawShiftImg.encodeの結果
+    """
+    return DrawShiftImg(load_shift(data), font).encode(image_format)
+
+
+class RenderExecutor:
+    """
+    シフト画像の描画を別のプロセスで行うクラス
+
+    Pillowの描画はGILを握るので、リクエストを処理するスレッドでは行わずにプロセスに任せる。
+    受け付ける枚数はqueue_depthまでで、溢れたらtimeout秒まで空きを待つ。
+    時間切れで待つのをやめた描画も、終わるまではqueue_depthに数える。
+    プロセスはstartか最初の描画のときに起動し、フォントを読み込ませておく。
+    """
+
+    def __init__(
+        self,
+        font: str,
+        workers: int = RENDER_WORKERS,
+        queue_depth: int = RENDER_QUEUE_DEPTH,
+        timeout: float = RENDER_TIMEOUT,
+    ):
+        """
+        :param str font : フォントファイルのパス
+        :param int workers : 描画用のプロセスの数。0なら呼び出したスレッドで描画する
+        :param int queue_depth : 描画待ちと描画中を合わせた枚数の上限
+        :param float timeout : 受け付けを待つ時間と、描画を待つ時間(秒)
+        """
+        self.font = font
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(queue_depth)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.rendered = 0
+        self.busy = 0
+        self.timeouts = 0
+        self.render_total = 0
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # 親プロセスには認証の更新や利用記録の書き込みのスレッドがいるので、
+                # forkせずにspawnで起動する
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=warm_up,
+                    initargs=(self.font,),
+                )
+                # プロセスは仕事が来たときに起動されるので、先に全部起動させておく
+                for _ in range(self.workers):
+                    self.executor.submit(warm_up, self.font)
+            return self.executor
+
+    def start(self):
+        """
+        最初の描画を待たせないよう、描画用のプロセスを先に起動しておく
+        """
+        if self.workers > 0:
+            self.get_executor()
+
+    def reset(self, executor: ProcessPoolExecutor):
+        """
+        描画用のプロセスが落ちたので、次に使うときに作り直させる
+        """
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def render(self, shift: list, image_format: str) -> dict:
+        """
+        シフト画像を描画してエンコードする
+
+        :param list shift : 1日分のWorkのリストか、日ごとのWorkのリストのリスト
+        :param str image_format : エンコード形式
+        :return dict : DrawShiftImg.encodeの結果
+        :raises RenderBusyError : 受け付けを待ってもqueue_depthに空きがなかったとき
+        :raises concurrent.futures.TimeoutError : 描画がtimeout秒で終わらなかったとき
+            current_deadlineがあれば、どちらもその残りの時間までしか待たない
+        """
+        if self.workers <= 0:
+            return DrawShiftImg(shift, self.font).encode(image_format)
+
+        start = time.monotonic()
+        # interactionの処理中なら、その残りの時間までしか待たない
+        timeout = limit_timeout(self.timeout)
+        if not self.slots.acquire(timeout=timeout):
+            with self.lock:
+                self.busy += 1
+            raise RenderBusyError(
+                "render queue is full for {:.1f} seconds".format(timeout)
+            )
+        try:
+            data = dump_shift(shift)
+            executor = self.get_executor()
+            try:
+                future = executor.submit(render_shift, data, self.font, image_format)
+            except BrokenProcessPool:
+                self.reset(executor)
+                executor = self.get_executor()
+                future = executor.submit(render_shift, data, self.font, image_format)
+        except BaseException:
+            self.slots.release()
+            raise
+        # 待つのをやめても始まった描画は止められないので、枠は描画が終わったときに返す
+        future.add_done_callback(lambda _: self.slots.release())
+
+        try:
+            encoded = future.result(timeout=limit_timeout(self.timeout))
+        except FutureTimeoutError:
+            future.cancel()
+            with self.lock:
+                self.timeouts += 1
+            render_error_out(
+                "render timed out after {:.1f}s".format(time.monotonic() - start)
+            )
+            raise
+        except BrokenProcessPool:
+            render_error_out("render process died, restart workers")
+            self.reset(executor)
+            raise
+
+        with self.lock:
+            self.rendered += 1
+            self.render_total += time.monotonic() - start
+        return encoded
+
+    def stats(self) -> dict:
+        """
+        :return dict : 描画した枚数、受け付けなかった枚数、時間切れの枚数、平均の所要時間(秒)
+        """
+        with self.lock:
+            return {
+                "rendered": self.rendered,
+                "busy": self.busy,
+                "timeouts": self.timeouts,
+                "render_avg": (
+                    self.render_total / self.rendered if self.rendered else 0.0
+                ),
+            }
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,87 @@
+import datetime as dt
+import os
+import sys
+import time
+
+# DrawShiftImgで1枚描画する時間を、フォント・文字の寸法・背景の層のキャッシュがない場合
+# (毎回読み込み・描画し直す)とキャッシュが効いている場合とで比べる
+# あわせて、エンコード形式ごとの大きさとエンコードにかかる時間を表示する
+# usage: python bench_render.py [<repeat>]
+#   repeat : 計測の繰り返し回数 既定は20
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import workmanage
+from workmanage import DrawShiftImg, Work, encode_image
+
+FONT = os.path.join(ROOT, ".fonts", "mplus-1m-regular.ttf")
+JST = dt.timezone(dt.timedelta(hours=9), name="Asia/Tokyo")
+NAMES = ["松田", "新宮", "熊田", "山本", "佐々木", "田中", "高橋"]
+
+repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+
+def make_day(day: dt.date, members: int) -> list:
+    works = []
+    for index, name in enumerate(NAMES[:members]):
+        start = dt.datetime(day.year, day.month, day.day, 9 + index % 6, 0, tzinfo=JST)
+        works.append(
+            Work(
+                staff_name=name,
+                start=start,
+                end=start + dt.timedelta(hours=3, minutes=30),
+                requested=index == 2,
+                eventid="event{}".format(index),
+                slackid="U{:04}".format(index),
+            )
+        )
+    return works
+
+
+monday = dt.date(2020, 1, 6)
+WEEK = [make_day(monday + dt.timedelta(days=day), 5 + day % 3) for day in range(5)]
+DAY = make_day(monday, len(NAMES))
+
+
+def clear_caches():
+    workmanage.load_font.cache_clear()
+    workmanage.text_size.cache_clear()
+    workmanage.rotated_text.cache_clear()
+    DrawShiftImg.layer_cache.clear()
+
+
+def measure(name, shift, cold):
+    times = []
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        start = time.perf_counter()
+        DrawShiftImg(shift, FONT).make_shiftimage()
+        times.append(time.perf_counter() - start)
+    print(
+        "{:<24} min {:8.2f}ms  avg {:8.2f}ms".format(
+            name, min(times) * 1000, sum(times) / len(times) * 1000
+        )
+    )
+
+
+measure("week (no cache)", WEEK, cold=True)
+measure("week (cached)", WEEK, cold=False)
+measure("day (no cache)", DAY, cold=True)
+measure("day (cached)", DAY, cold=False)
+print("text_size", workmanage.text_size.cache_info())
+
+
+for name, shift in (("week", WEEK), ("day", DAY)):
+    image = DrawShiftImg(shift, FONT).make_shiftimage()
+    for image_format in ("jpeg", "png", "webp"):
+        start = time.perf_counter()
+        encoded = encode_image(image, image_format)
+        print(
+            "{:<24} {:8} bytes  {:8.2f}ms".format(
+                "{} ({})".format(name, image_format),
+                encoded["size"],
+                (time.perf_counter() - start) * 1000,
+            )
+        )
@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import time
+
+# ConnectGoogleのserviceを作る時間を、Googleからdiscovery documentを取得する場合と
+# 同梱のdiscovery documentを使う場合とで比べる
+# usage: python bench_startup.py [--remote] [<repeat>]
+#   --remote : Googleからdiscovery documentを取得する場合も計測する(要ネットワーク)
+#   repeat   : 計測の繰り返し回数 既定は5
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# connectgoogleの読み込みに必要な設定。計測では認証しないのでダミーでよい
+os.environ.setdefault(
+    "CLIENT_SECRET_JSON",
+    json.dumps({"installed": {"client_id": "", "client_secret": "", "token_uri": ""}}),
+)
+os.environ.setdefault("REFRESH_TOKEN", "")
+os.environ.setdefault("DATABASE_SHEET", "")
+
+import requests
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build_from_document
+
+import connectgoogle
+
+APIS = [("calendar", "v3"), ("sheets", "v4"), ("drive", "v3")]
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{}/{}/rest"
+
+args = [arg for arg in sys.argv[1:] if arg != "--remote"]
+repeat = int(args[0]) if args else 5
+credentials = AnonymousCredentials()
+
+
+def measure(name, function):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    print(
+        "{:<32} min {:8.2f}ms  avg {:8.2f}ms".format(
+            name, min(times) * 1000, sum(times) / len(times) * 1000
+        )
+    )
+
+
+def build_remote():
+    for api, version in APIS:
+        build_from_document(
+            requests.get(DISCOVERY_URL.format(api, version)).text,
+            credentials=credentials,
+        )
+
+
+def build_bundled_cold():
+    connectgoogle.load_discovery_document.cache_clear()
+    for api, version in APIS:
+        connectgoogle.build_service(api, version, credentials)
+
+
+def build_bundled_warm():
+    for api, version in APIS:
+        connectgoogle.build_service(api, version, credentials)
+
+
+def build_lazy():
+    # ConnectGoogle.__init__と同じく、使われるまでは作らない
+    for api, version in APIS:
+        connectgoogle.LazyService(api, version, credentials)
+
+
+def build_lazy_first_use():
+    connectgoogle.load_discovery_document.cache_clear()
+    connectgoogle.LazyService("calendar", "v3", credentials).events()
+
+
+if "--remote" in sys.argv:
+    measure("remote discovery", build_remote)
+measure("bundled discovery (cold)", build_bundled_cold)
+measure("bundled discovery (memoized)", build_bundled_warm)
+measure("lazy construction", build_lazy)
+measure("lazy first calendar use (cold)", build_lazy_first_use)
@@ -0,0 +1,36 @@
+import os
+import sys
+import uuid
+from urllib.parse import urlencode
+
+import requests
+
+# GoogleCalendarの変更通知(events.watch)を真似たリクエストを/google-pushへ送る
+# usage: python send_fake_push.py <calendar id> [<url>] [<resource state>]
+#   url            : 既定は http://localhost:5000/google-push
+#   resource state : sync / exists / not_exists  既定は exists
+# 通知の検証にはアプリと同じGOOGLE_PUSH_TOKENを使う
+
+if len(sys.argv) < 2:
+    print("usage: python send_fake_push.py <calendar id> [<url>] [<resource state>]")
+    sys.exit(1)
+
+calendar_id = sys.argv[1]
+url = sys.argv[2] if len(sys.argv) > 2 else "http://localhost:5000/google-push"
+resource_state = sys.argv[3] if len(sys.argv) > 3 else "exists"
+
+headers = {
+    "X-Goog-Channel-ID": str(uuid.uuid4()),
+    "X-Goog-Channel-Token": urlencode(
+        {"secret": os.environ.get("GOOGLE_PUSH_TOKEN", ""), "calendar": calendar_id}
+    ),
+    "X-Goog-Message-Number": "1",
+    "X-Goog-Resource-ID": "fake-resource",
+    "X-Goog-Resource-State": resource_state,
+    "X-Goog-Resource-URI": "https://www.googleapis.com/calendar/v3/calendars/{}/events".format(
+        calendar_id
+    ),
+}
+
+res = requests.post(url, headers=headers)
+print(res.status_code, res.text)
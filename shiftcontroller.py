@@ -1,27 +1,44 @@
 import datetime as dt
 import json
 import os
+import sys
 from enum import Enum, auto
 from pprint import pprint
+from urllib.parse import urlencode
 
 import requests
 
-from connectgoogle import ConnectGoogle
-from workmanage import DrawShiftImg, Work, Worker
+from calendarmirror import CalendarMirror
+from connectgoogle import BatchWriteError, ConnectGoogle
+from memberdirectory import MemberDirectory
+from renderexecutor import RenderExecutor
+from shiftimgcache import (
+    SHIFT_DATA_MAX_LENGTH,
+    SHIFT_IMAGE_BASE_URL,
+    SHIFT_IMAGE_EXTENSION,
+    SHIFT_IMAGE_FORMAT,
+    ShiftImageCache,
+    ShiftImageStore,
+    decode_shift,
+    encode_shift,
+    get_extension,
+    make_shift_key,
+)
+from shiftprerender import ShiftImagePrerenderer
+from slackclient import SlackClient, SlackRateLimitError, slack_error_out
+from uselogwriter import UseLogWriter
+from workmanage import Work
 
 FONT = "./.fonts/mplus-1m-regular.ttf"
 SLACK_BOT_TOKEN = os.environ["SLACK_BOT_TOKEN"]
 NOTICE_CHANNEL = os.environ["NOTICE_CHANNEL"]
-header = {
-    "Content-type": "application/json",
-    "Authorization": "Bearer " + SLACK_BOT_TOKEN,
-}
-CHAT_POSTMESSAGE = "https://slack.com/api/chat.postMessage"
 BEFORE_OPEN_TIME = 8
 AFTER_CLOSE_TIME = 19
 CALENDARID_SHIFT = os.environ["CALENDARID_SHIFT"]
 CALENDARID_DAIKO = os.environ["CALENDARID_DAIKO"]
 CALENDARID_OPEN = os.environ["CALENDARID_OPEN"]
+# SHIFT/DAIKOカレンダーの手元の複製を使うか
+USE_CALENDAR_MIRROR = os.environ.get("USE_CALENDAR_MIRROR", "1") == "1"
 
 
 class ShiftController:
@@ -71,7 +88,31 @@ class ShiftController:
         self.calendar = self.gcon.calendar
         self.drive = self.gcon.drive
         self.sheet = self.gcon.sheet
+        self.members = MemberDirectory(self.sheet)
+        self.slack = SlackClient(SLACK_BOT_TOKEN)
+        self.image_cache = ShiftImageCache()
+        self.image_store = ShiftImageStore() if SHIFT_IMAGE_BASE_URL else None
+        self.renderer = RenderExecutor(FONT)
+        self.renderer.start()
+        self.use_log = UseLogWriter(
+            self.sheet, self.sheet.LOG_SHEET_NAME, convert=self.make_use_log_row
+        )
+        self.use_log.start()
         self.shift = None
+        self.mirror = None
+        if USE_CALENDAR_MIRROR:
+            # 通知を受け取ったworkerが変更を記録し、全workerの複製がそれを見て同期する
+            channels = self.gcon.watch_calendars([CALENDARID_SHIFT, CALENDARID_DAIKO])
+            self.mirror = CalendarMirror(
+                self.calendar,
+                [CALENDARID_SHIFT, CALENDARID_DAIKO],
+                self.timezone,
+                channels=channels,
+            )
+            self.mirror.start()
+        self.prerender = ShiftImagePrerenderer(self)
+        if self.mirror is not None:
+            self.mirror.add_listener(self.prerender.on_calendar_changed)
 
     def post_message(
         self,
@@ -90,18 +131,20 @@ class ShiftController:
             post_body.update({"thread_ts": ts})
         if attachments:
             post_body.update({"attachments": attachments})
-        res = requests.post(
-            CHAT_POSTMESSAGE, json=json.loads(json.dumps(post_body)), headers=header
-        )
-        res = json.loads(res.text)
+        try:
+            res = self.slack.api("chat.postMessage", json.loads(json.dumps(post_body)))
+        except (requests.RequestException, SlackRateLimitError, ValueError) as e:
+            # 通知はカレンダーへの書き込みの後に送るので、失敗しても書き込みは失敗にしない
+            slack_error_out("failed to post a message to {}: {!r}".format(channel, e))
+            return False
         print(res)
         return res["ok"]
 
     def slackid2name(self, slackId: str):
-        return self.sheet.get_slackId2name_dict()[slackId]
+        return self.members.slackid2name(slackId)
 
     def name2slackid(self, name: str):
-        return self.sheet.get_slackId2name_dict(toName=True)[name]
+        return self.members.name2slackid(name)
 
     def convert_utc_format(self, target: dt.datetime):
         return_value = (
@@ -174,6 +217,78 @@ class ShiftController:
         else:
             return None
 
+    def receive_calendar_notice(self, token: str, resource_state: str) -> set:
+        """
+        GoogleCalendarからの変更通知を受け取り、対象のカレンダーの複製を差分同期する。
+        通知はどれか1つのworkerにしか届かないので、変更を記録して他のworkerにも同期させる
+
+        :param str token : X-Goog-Channel-Tokenヘッダの値
+        :param str resource_state : X-Goog-Resource-Stateヘッダの値
+        :return set : 変更があった日付。通知が検証できなければNone
+        """
+        if self.mirror is None or self.gcon.channels is None:
+            return None
+        calendar_id = self.gcon.channels.parse_token(token)
+        if calendar_id is None:
+            return None
+        if resource_state == "sync":
+            # チャンネル登録直後の確認の通知
+            return set()
+        self.gcon.channels.mark_changed(calendar_id)
+        return self.mirror.sync(calendar_id)
+
+    def fetch_events(self, calendars: list, search_range: tuple) -> list:
+        """
+        複数のカレンダーの指定された範囲のEventを取得する
+
+        手元の複製から返せるものは複製から、それ以外はGoogleCalendarに並行して問い合わせる
+
+        :param list calendars : 対象のカレンダーのcalendar idのリスト
+        :param tuple search_range : イベントを取得する範囲(始点,終点)
+        :return list : calendarsと同じ順に並べた、各カレンダーのEventのリスト
+        """
+        results = [None] * len(calendars)
+        if self.mirror is not None and self.mirror.covers(search_range):
+            results = [
+                self.mirror.get_events_in_day(calendar, search_range)
+                for calendar in calendars
+            ]
+
+        missing = [
+            calendar for calendar, result in zip(calendars, results) if result is None
+        ]
+        if missing:
+            fetched = dict(
+                zip(
+                    missing,
+                    self.calendar.get_events_concurrently(missing, search_range),
+                )
+            )
+            results = [
+                fetched[calendar] if result is None else result
+                for calendar, result in zip(calendars, results)
+            ]
+        return results
+
+    def fetch_event(self, calendars: list, eventid: str) -> list:
+        """
+        複数のカレンダーから指定されたeventidのEventを取得する
+
+        いずれかのカレンダーの手元の複製に見つかればそれを使い、
+        なければGoogleCalendarに並行して問い合わせる
+
+        :param list calendars : 対象のカレンダーのcalendar idのリスト
+        :param str eventid : 取得するEventのeventid
+        :return list : calendarsと同じ順に並べた、各カレンダーでの取得結果
+        """
+        if self.mirror is not None:
+            results = [
+                self.mirror.get_event(calendar, eventid) for calendar in calendars
+            ]
+            if any(result is not None for result in results):
+                return results
+        return self.calendar.get_event_concurrently(calendars, eventid)
+
     def get_shift(
         self,
         date: dt.datetime = None,
@@ -195,15 +310,13 @@ class ShiftController:
 
         if eventid is not None:
             print("have eventid")
-            print("request to DAIKO")
-            target = self.calendar.get_event(CALENDARID_DAIKO, eventid)
-            if target is not None and target.get("status") != "cancelled":
-                return self.convert_event_to_work(target)
-
-            print("request to SHIFT")
-            target = self.calendar.get_event(CALENDARID_SHIFT, eventid)
-            if target is not None and target.get("status") != "cancelled":
-                return self.convert_event_to_work(target)
+            # DAIKOとSHIFTに並行して問い合わせ、DAIKO -> SHIFTの順に有効なものを採用する
+            print("request to DAIKO and SHIFT")
+            for target in self.fetch_event(
+                [CALENDARID_DAIKO, CALENDARID_SHIFT], eventid
+            ):
+                if target is not None and target.get("status") != "cancelled":
+                    return self.convert_event_to_work(target)
 
             raise ValueError("Ths shift had eventid is none")
 
@@ -212,48 +325,148 @@ class ShiftController:
 
         opening_range = self.calc_opening_hours(date, is_UTC=True)
 
-        events = []
-
+        calendars = []
         if not only_requested:
-            # 代行依頼のみの指定がなければ有効なシフトを取得し全体にappend
-            events += self.calendar.get_events_in_day(CALENDARID_SHIFT, opening_range)
-
+            # 代行依頼のみの指定がなければ有効なシフトを取得する
+            calendars.append(CALENDARID_SHIFT)
         if not only_active:
-            # 有効なシフトのみの指定がなければ代行依頼を取得し全体にappend
-            events += self.calendar.get_events_in_day(CALENDARID_DAIKO, opening_range)
+            # 有効なシフトのみの指定がなければ代行依頼を取得する
+            calendars.append(CALENDARID_DAIKO)
+
+        # 両カレンダーを並行して取得し、SHIFT -> DAIKOの順に結合する
+        events = []
+        for calendar_events in self.fetch_events(calendars, opening_range):
+            events += calendar_events or []
 
         works = self.convert_event_to_work(events)
         del events
 
+        return self.narrow_down_works(
+            works, date, slackid=slackid, fill_blank=fill_blank
+        )
+
+    def make_blank_works(self, date: dt.datetime) -> list:
+        """
+        シフトが空の日の画像を描画するための、空白を埋めるブランクのWorkのリストを返す
+
+        :param dt.datetime date : ブランクを作る日付
+        :return list : ブランクのWorkのリスト
+        """
+        open_hour, close_hour = self.calc_opening_hours(date)
+        return [
+            Work(
+                staff_name="該当なし",
+                start=open_hour,
+                end=close_hour,
+                requested=True,
+                eventid="thisisblank",
+                slackid="thisisblack",
+            ),
+            Work(
+                staff_name=" ",
+                start=open_hour,
+                end=close_hour,
+                requested=True,
+                eventid="thisisblank",
+                slackid="thisisempty",
+            ),
+        ]
+
+    def narrow_down_works(
+        self,
+        works: list,
+        date: dt.datetime,
+        slackid=None,
+        fill_blank: bool = False,
+    ) -> list:
+        """
+        1日分のWorkのリストにブランクの補完と担当者での絞り込みを行う
+
+        :param list works : 対象の日のWorkのリスト
+        :param dt.datetime date : 対象の日付
+        :param str slackid : 絞り込むシフトの担当者
+        :param bool fill_blank : シフトが空のときにブランクのシフトを挿入する
+        :return list : 絞り込んだWorkのリスト
+        """
         # シフトが空でfill_blankフラグが立っていれば空白を埋めるブランクのシフトを挿入する
         if len(works) == 0 and fill_blank:
-            open_hour, close_hour = self.calc_opening_hours(date)
-            works.append(
-                Work(
-                    staff_name="該当なし",
-                    start=open_hour,
-                    end=close_hour,
-                    requested=True,
-                    eventid="thisisblank",
-                    slackid="thisisblack",
-                )
-            )
-            works.append(
-                Work(
-                    staff_name=" ",
-                    start=open_hour,
-                    end=close_hour,
-                    requested=True,
-                    eventid="thisisblank",
-                    slackid="thisisempty",
-                )
-            )
+            works = self.make_blank_works(date)
 
         if slackid is not None:
             return [work for work in works if work.slackid == slackid]
         else:
             return works
 
+    def get_range_shift(
+        self,
+        start: dt.datetime,
+        end: dt.datetime,
+        slackid=None,
+        only_requested: bool = False,
+        only_active: bool = False,
+        grouping_by_week: bool = False,
+        fill_blank: bool = False,
+    ):
+        """
+        指定された期間の各日について条件にあったWorkのリストを返す
+
+        GoogleCalendarへの問い合わせは期間全体に対してカレンダーごとに1回だけ行い、
+        日ごとへの振り分けは取得後に行う。各日の条件はget_shiftと同じ。
+
+        :param dt.datetime start : 期間の初日
+        :param dt.datetime end : 期間の最終日
+        :param str slackid : 絞り込むシフトの担当者
+        :param bool only_requested : 代行依頼のみに絞り込む
+        :param bool only_active : 実シフトのみに絞り込む
+        :param bool grouping_by_week : シフトを日ごとに別のリストにするか
+        :param bool fill_blank : シフトが空の日にブランクのシフトを挿入する
+        """
+        days = [
+            start + dt.timedelta(days=count)
+            for count in range((end.date() - start.date()).days + 1)
+        ]
+        # 初日の開館時間から最終日の閉館時間までをまとめて取得する
+        search_range = (
+            self.calc_opening_hours(days[0], is_UTC=True)[0],
+            self.calc_opening_hours(days[-1], is_UTC=True)[1],
+        )
+
+        calendars = []
+        if not only_requested:
+            # 代行依頼のみの指定がなければ有効なシフトを取得する
+            calendars.append(CALENDARID_SHIFT)
+        if not only_active:
+            # 有効なシフトのみの指定がなければ代行依頼を取得する
+            calendars.append(CALENDARID_DAIKO)
+
+        works_by_calendar = [
+            self.convert_event_to_work(events or [])
+            for events in self.fetch_events(calendars, search_range)
+        ]
+
+        works_list = []
+        for day in days:
+            # その日の開館時間に重なるシフトだけを、カレンダーの順に集める
+            open_hour, close_hour = [
+                hour.astimezone() for hour in self.calc_opening_hours(day)
+            ]
+            works = [
+                work
+                for works in works_by_calendar
+                for work in works
+                if work.start < close_hour and open_hour < work.end
+            ]
+            works = self.narrow_down_works(
+                works, day, slackid=slackid, fill_blank=fill_blank
+            )
+
+            if grouping_by_week:
+                works_list.append(works)
+            else:
+                works_list += works
+
+        return works_list
+
     def get_week_shift(
         self,
         base_date: dt.datetime = None,
@@ -278,39 +491,89 @@ class ShiftController:
             # now = date
             pass
 
-        works_list = []
         # もっともらしい月曜日の日付を算出
         nearly_monday = self.calc_nearly_monday(base_date)
         del base_date
 
-        for count in range(5):
-            works = self.get_shift(
-                date=nearly_monday + dt.timedelta(days=count),
-                slackid=slackid,
-                only_active=only_active,
-                only_requested=only_requested,
-                fill_blank=fill_blank,
-            )
+        # 月曜日の開館から金曜日の閉館までを1度に取得する
+        return self.get_range_shift(
+            nearly_monday,
+            nearly_monday + dt.timedelta(days=4),
+            slackid=slackid,
+            only_active=only_active,
+            only_requested=only_requested,
+            grouping_by_week=grouping_by_week,
+            fill_blank=fill_blank,
+        )
 
-            if grouping_by_week:
-                works_list.append(works)
+    def generate_shiftimg_url(self, shift, filename: str = None) -> str:
+        """
+        現在のシフトの画像のurlを返す。同じ内容のシフトの画像をアップロード済みならそのurlを返す
+        SHIFT_IMAGE_BASE_URLが設定されていれば、Driveを使わず/shift-imgから配信するurlを返す。
+        再起動で保存した画像が消えても描き直せるよう、urlにはシフトの内容を載せる
+
+        :return dict : {"url": 画像のurl, "filename": 画像のファイル名}
+        """
+        key = make_shift_key(shift)
+        if self.image_store is not None:
+            filename = "{}.{}".format(key, SHIFT_IMAGE_EXTENSION)
+            if not self.image_store.contains(filename):
+                encoded = self.renderer.render(shift, SHIFT_IMAGE_FORMAT)
+                print("encoded {}: {} bytes".format(filename, encoded["size"]))
+                self.image_store.put(filename, encoded["data"])
+            image_url = "{}/shift-img/{}".format(
+                SHIFT_IMAGE_BASE_URL.rstrip("/"), filename
+            )
+            data = encode_shift(shift)
+            if len(data) <= SHIFT_DATA_MAX_LENGTH:
+                image_url += "?" + urlencode({"s": data})
             else:
-                works_list += works
+                print("shift of {} is too large to put in the url".format(filename))
+            return {"url": image_url, "filename": filename}
 
-        return works_list
+        uploaded = self.image_cache.get(key)
+        if uploaded is not None:
+            return uploaded
 
-    def generate_shiftimg_url(self, shift, filename: str = None) -> str:
+        encoded = self.renderer.render(shift, SHIFT_IMAGE_FORMAT)
+        filename = "{}.{}".format(
+            dt.datetime.now().strftime("%Y%m%d%H%M%S%f"), encoded["extension"]
+        )
+        print("encoded {}: {} bytes".format(filename, encoded["size"]))
+        image_url = self.drive.upload4share(
+            filename, None, encoded["mimetype"], encoded["data"]
+        )
+        uploaded = {"url": image_url, "filename": filename}
+        self.image_cache.put(key, uploaded)
+        return uploaded
+
+    def load_shiftimg(self, key: str, extension: str, data: str = None) -> bytes:
         """
-        現在のシフトの画像のurlを返す
+        /shift-imgで配信する画像を返す。保存した画像がなければ、urlに載せたシフトの内容から描き直す
 
-        :return str : 画像のurl
+        :param str key : make_shift_keyで作ったキー
+        :param str extension : 要求された拡張子。キーを作ったときの形式と一致しなければ返さない
+        :param str data : urlに載せたencode_shiftの結果
+        :return bytes : 画像。返せなければNone
+        :raises RenderBusyError : 描き直す画像の受け付けを待っても空きがなかったとき
         """
-        filename = "{}.jpg".format(dt.datetime.now().strftime("%Y%m%d%H%M%S%f"))
-        DrawShiftImg(shift, FONT).make_shiftimage().save(filename, quality=95)
-        image_url = self.drive.upload4share(filename, filename, self.drive.JPEGIMAGE)
-        print("delete file!")
-        os.remove(filename)
-        return {"url": image_url, "filename": filename}
+        if self.image_store is None:
+            return None
+        filename = "{}.{}".format(key, extension)
+        image = self.image_store.get(filename)
+        if image is not None or not data:
+            return image
+        try:
+            shift, image_format = decode_shift(key, data)
+        except ValueError as e:
+            print("can not redraw {}: {}".format(filename, e))
+            return None
+        if get_extension(image_format) != extension:
+            return None
+        encoded = self.renderer.render(shift, image_format)
+        print("redrew {}: {} bytes".format(filename, encoded["size"]))
+        self.image_store.put(filename, encoded["data"])
+        return encoded["data"]
 
     def generate_datefix_work(
         self,
@@ -357,7 +620,7 @@ class ShiftController:
         else:
             return self.DevPos.INCLUDE
 
-    def insert_shift(self, new_work: Work, recurrence=None):
+    def insert_shift(self, new_work: Work, recurrence=None, batch=None):
         """
 
         新規のシフトをGoogleCalendarに登録する
@@ -365,13 +628,15 @@ class ShiftController:
         Args:
             new_work (Work): 追加するシフト
             recurrence (str): 予定の繰り返しパターン文字列
+            batch (GoogleCalendar.Batch): 指定されていればbatchに積むだけで送信はしない
 
         Returns:
-            dict : 追加したシフトの情報
+            dict : 追加したシフトの情報。batch指定時はNone
 
         """
+        writer = self.calendar if batch is None else batch
         # 新規作成分をinsert
-        res = self.calendar.insert_event(
+        res = writer.insert_event(
             calendar=CALENDARID_DAIKO if new_work.requested else CALENDARID_SHIFT,
             summary=new_work.staff_name,
             start=new_work.start,
@@ -381,23 +646,45 @@ class ShiftController:
         )
         return res
 
-    def update_shift(self, new_work: Work):
+    def make_event_fields(self, work: Work) -> dict:
         """
-        既存シフトをnew_workの通り更新する
+        シフトをinsert_event/update_eventの引数の形にする
+
+        :return dict : {"summary", "start", "end", "description"}
         """
-        res = self.calendar.update_event(
-            calendar=CALENDARID_DAIKO if new_work.requested else CALENDARID_SHIFT,
-            eventid=new_work.eventid,
-            summary=new_work.staff_name,
-            start=new_work.start,
-            end=new_work.end,
-            description=new_work.slackid,
+        return {
+            "summary": work.staff_name,
+            "start": work.start,
+            "end": work.end,
+            "description": work.slackid,
+        }
+
+    def update_shift(self, new_work: Work, batch=None, original: Work = None):
+        """
+        既存シフトをnew_workの通り更新する
+
+        :param Work new_work : 更新後のシフト
+        :param GoogleCalendar.Batch batch : 指定されていればbatchに積むだけで送信はしない
+        :param Work original : 更新前のシフト。batchの一部が失敗したときに戻すのに使う
+        """
+        calendar = CALENDARID_DAIKO if new_work.requested else CALENDARID_SHIFT
+        fields = self.make_event_fields(new_work)
+        if batch is None:
+            return self.calendar.update_event(calendar, new_work.eventid, **fields)
+        return batch.update_event(
+            calendar,
+            new_work.eventid,
+            original=self.make_event_fields(original) if original else None,
+            **fields
         )
-        return res
 
-    def apply_changes_shift(self, base_work: Work, new_work: Work, pos: DevPos):
+    def apply_changes_shift(
+        self, base_work: Work, new_work: Work, pos: DevPos, batch=None
+    ):
         """
         元シフトと追加シフトを参照して元シフトの情報を更新する
+
+        :param GoogleCalendar.Batch batch : 指定されていればbatchに積むだけで送信はしない
         """
         if pos in (self.DevPos.BACK, self.DevPos.FRONT):
             res = self.update_shift(
@@ -405,29 +692,85 @@ class ShiftController:
                     base_work,
                     start=base_work.start if pos == self.DevPos.BACK else new_work.end,
                     end=new_work.start if pos == self.DevPos.BACK else base_work.end,
-                )
+                ),
+                batch=batch,
+                original=base_work,
             )
             return res
         elif pos == self.DevPos.MATCH:
-            res = self.calendar.delete_event(
-                calendar=CALENDARID_DAIKO if base_work.requested else CALENDARID_SHIFT,
-                eventid=base_work.eventid,
+            calendar = CALENDARID_DAIKO if base_work.requested else CALENDARID_SHIFT
+            if batch is None:
+                return self.calendar.delete_event(calendar, base_work.eventid)
+            return batch.delete_event(
+                calendar,
+                base_work.eventid,
+                original=self.make_event_fields(base_work),
             )
-            return res
         elif pos == self.DevPos.INCLUDE:
             res = []
-            res += self.update_shift(
-                self.generate_datefix_work(
-                    base_work, start=base_work.start, end=new_work.start
+            res.append(
+                self.update_shift(
+                    self.generate_datefix_work(
+                        base_work, start=base_work.start, end=new_work.start
+                    ),
+                    batch=batch,
+                    original=base_work,
                 )
             )
-            res += self.insert_shift(
-                self.generate_datefix_work(base_work, new_work.end, base_work.end)
+            res.append(
+                self.insert_shift(
+                    self.generate_datefix_work(base_work, new_work.end, base_work.end),
+                    batch=batch,
+                )
             )
             return res
         else:
             ValueError("Invalid Devide Position")
 
+    def execute_batch(self, batch) -> list:
+        """
+        batchに積んだ変更を送信する。一部の操作が失敗したら、成功した操作を取り消して例外を送出する
+
+        :param GoogleCalendar.Batch batch : 送信するbatch
+        :return list : 各操作の結果
+        :raises BatchWriteError : 失敗した操作があったとき
+        """
+        results = batch.execute()
+        failed = [
+            (index, result)
+            for index, result in enumerate(results)
+            if result["exception"] is not None
+        ]
+        unreverted = []
+        if failed:
+            for index, result in failed:
+                print(
+                    "batch {} #{} failed: {!r}".format(
+                        result["operation"], index, result["exception"]
+                    ),
+                    file=sys.stderr,
+                )
+            # 依頼の分だけ追加されて元のシフトが残る、といった中途半端な状態にしない
+            unreverted = batch.rollback()
+        if self.mirror is not None:
+            # 書き込んだ変更を次の読み込みに反映させる
+            self.mirror.mark_stale()
+        self.prerender.invalidate()
+        if not failed:
+            return results
+        message = "{} of {} operations failed, ".format(len(failed), len(results))
+        if unreverted:
+            message += "could not roll back {}".format(
+                [
+                    "{} #{}".format(results[index]["operation"], index)
+                    for index in unreverted
+                ]
+            )
+        else:
+            message += "rolled back the others"
+        print(message, file=sys.stderr)
+        raise BatchWriteError(message, results, unreverted)
+
     def request(self, eventid: str, start: dt.datetime, end: dt.datetime) -> Work:
         """
         シフトの代行を依頼する
@@ -447,10 +790,13 @@ class ShiftController:
         # 2つの時間帯の位置関係を確認
         relative_position = self.check_need_divide(target_work, requested_work)
 
-        res = self.insert_shift(requested_work)
-        print(res)
-
-        res = self.apply_changes_shift(target_work, requested_work, relative_position)
+        # 依頼分の追加と元シフトの変更を1回のバッチで送信する
+        batch = self.calendar.new_batch()
+        self.insert_shift(requested_work, batch=batch)
+        self.apply_changes_shift(
+            target_work, requested_work, relative_position, batch=batch
+        )
+        res = self.execute_batch(batch)
         print(res)
 
         del res
@@ -480,10 +826,13 @@ class ShiftController:
         # 2つの時間帯の位置関係を確認
         relative_position = self.check_need_divide(target_work, contract_work)
 
-        res = self.insert_shift(contract_work)
-        print(res)
-
-        res = self.apply_changes_shift(target_work, contract_work, relative_position)
+        # 請負分の追加と元シフトの変更を1回のバッチで送信する
+        batch = self.calendar.new_batch()
+        self.insert_shift(contract_work, batch=batch)
+        self.apply_changes_shift(
+            target_work, contract_work, relative_position, batch=batch
+        )
+        res = self.execute_batch(batch)
         print(res)
 
         del res
@@ -500,10 +849,19 @@ class ShiftController:
         :param Actions action : ユーザーが利用した機能
         """
         date = dt.datetime.now().astimezone(self.timezone).strftime("%Y/%m/%d  %X")
-        self.sheet.append(
-            [date, self.slackid2name(slackId), use_way.value, action.value],
-            self.sheet.LOG_SHEET_NAME,
-        )
+        # シートへの書き込みと名前の解決はUseLogWriterのスレッドで行う
+        self.use_log.record([date, slackId, use_way.value, action.value])
+
+    def make_use_log_row(self, row: list) -> list:
+        """
+        record_useで記録した行のslackidを名前に置き換える。引けなければslackidのまま残す
+        """
+        date, slackId, use_way, action = row
+        try:
+            name = self.slackid2name(slackId)
+        except Exception:
+            name = slackId
+        return [date, name, use_way, action]
 
     def check_space(self, date: dt.datetime):
         return self.calendar.check_freebusy(date)
@@ -517,7 +875,7 @@ class ShiftController:
             return_message = "<@{user}>さんが<@{origin}>さんのシフトの代行を引き受けました。\n日付 : {date}\n時間 : {start}~{end}\n> {message}".format(
                 user=slackid,
                 date=work.start.strftime("%m/%d"),
-                origin=self.sheet.get_slackId2name_dict(toName=False)[work.staff_name],
+                origin=self.name2slackid(work.staff_name),
                 start=start if type(start) is str else start.strftime("%H:%M"),
                 end=end if type(end) is str else end.strftime("%H:%M"),
                 message=message,
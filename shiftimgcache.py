@@ -0,0 +1,393 @@
+import base64
+import datetime as dt
+import fcntl
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+from workmanage import Work
+
+# 描画の仕方を変えたら上げる。古い描画の画像をキャッシュから返さないため
+RENDER_VERSION = 1
+# アップロード済みの画像を何件まで覚えておくか
+SHIFT_IMAGE_CACHE_SIZE = int(os.environ.get("SHIFT_IMAGE_CACHE_SIZE", 256))
+# キャッシュの索引の保存先。gunicornの各workerで共有する
+SHIFT_IMAGE_CACHE_INDEX = os.environ.get(
+    "SHIFT_IMAGE_CACHE_INDEX",
+    os.path.join(tempfile.gettempdir(), "daiko-shift-images.json"),
+)
+# シフト画像のエンコード形式 ("png"(減色したpng) / "webp"(可逆のwebp) / "jpeg")
+SHIFT_IMAGE_FORMAT = os.environ.get("SHIFT_IMAGE_FORMAT", "png")
+SHIFT_IMAGE_EXTENSION = "jpg" if SHIFT_IMAGE_FORMAT == "jpeg" else SHIFT_IMAGE_FORMAT
+# 配信する画像の拡張子とmimetype
+SHIFT_IMAGE_MIMETYPES = {"png": "image/png", "webp": "image/webp", "jpg": "image/jpeg"}
+# 設定されていれば、画像をDriveにアップロードせず"<このurl>/shift-img/<key>.<拡張子>"で配信する
+SHIFT_IMAGE_BASE_URL = os.environ.get("SHIFT_IMAGE_BASE_URL")
+# 配信する画像をメモリに何枚、ディスクに何枚まで置いておくか
+SHIFT_IMAGE_MEMORY_SIZE = int(os.environ.get("SHIFT_IMAGE_MEMORY_SIZE", 32))
+SHIFT_IMAGE_DISK_SIZE = int(os.environ.get("SHIFT_IMAGE_DISK_SIZE", 512))
+# 配信する画像を置くディレクトリ。gunicornの各workerで共有する
+SHIFT_IMAGE_DIR = os.environ.get(
+    "SHIFT_IMAGE_DIR", os.path.join(tempfile.gettempdir(), "daiko-shift-images")
+)
+# 配信する画像の名前(make_shift_keyで作ったキー.拡張子)の形
+SHIFT_IMAGE_NAME_PATTERN = re.compile(r"^[0-9a-f]{32}\.(png|webp|jpg)$")
+# 画像のurlに載せるシフトの内容の長さの上限。Slackのimage_urlは3000文字まで
+SHIFT_DATA_MAX_LENGTH = 2500
+# 受け取ったシフトの内容を展開したときの大きさの上限(bytes)
+SHIFT_DATA_MAX_SIZE = 64 * 1024
+
+
+def imgcache_error_out(text):
+    print(
+        "[{}]-ShiftImageCache {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+def get_render_mode(shift: list) -> str:
+    """
+    シフトの形から描画の種類を返す
+
+    :param list shift : 1日分のWorkのリストか、日ごとのWorkのリストのリスト
+    :return str : "day" もしくは "week"
+    """
+    return "week" if shift and isinstance(shift[0], list) else "day"
+
+
+def get_extension(image_format: str) -> str:
+    """
+    エンコード形式から配信するときの拡張子を返す
+    """
+    return "jpg" if image_format == "jpeg" else image_format
+
+
+def dump_shift_content(shift: list, mode: str, image_format: str) -> bytes:
+    """
+    シフトの内容のうち、描画に使うものを決まった順のjsonにする
+
+    担当者はslackidの代わりに登場順の番号で表す。描画ではスタッフごとにまとめるのにしか使わないため
+    """
+    slackids = []
+
+    def dump(work: Work) -> list:
+        if work.slackid not in slackids:
+            slackids.append(work.slackid)
+        return [
+            slackids.index(work.slackid),
+            work.staff_name,
+            work.start.isoformat(),
+            work.end.isoformat(),
+            bool(work.requested),
+        ]
+
+    days = shift if get_render_mode(shift) == "week" else [shift]
+    content = {
+        "version": RENDER_VERSION,
+        "mode": mode or get_render_mode(shift),
+        "format": image_format,
+        "works": [[dump(work) for work in day] for day in days],
+    }
+    return json.dumps(
+        content, ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    ).encode()
+
+
+def make_shift_key(
+    shift: list, mode: str = None, image_format: str = SHIFT_IMAGE_FORMAT
+) -> str:
+    """
+    シフトの内容と描画の種類から、同じ画像になるものが同じになるキーを作る
+
+    :param list shift : 1日分のWorkのリストか、日ごとのWorkのリストのリスト
+    :param str mode : 描画の種類。Noneならshiftの形から決める
+    :param str image_format : エンコード形式
+    :return str : キー
+    """
+    content = dump_shift_content(shift, mode, image_format)
+    return hashlib.sha256(content).hexdigest()[:32]
+
+
+def encode_shift(
+    shift: list, mode: str = None, image_format: str = SHIFT_IMAGE_FORMAT
+) -> str:
+    """
+    画像を描き直せるよう、シフトの内容を圧縮してurlに載せられる文字列にする
+
+    :return str : decode_shiftに渡す文字列
+    """
+    data = zlib.compress(dump_shift_content(shift, mode, image_format), 9)
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_shift(key: str, data: str) -> tuple:
+    """
+    encode_shiftの結果からシフトを作り直す
+
+    :param str key : 画像のキー。内容から作ったキーと一致しなければ受け付けない
+    :param str data : encode_shiftの結果
+    :return tuple : (1日分のWorkのリストか、日ごとのWorkのリストのリスト, エンコード形式)
+    :raises ValueError : 内容が壊れているか、キーと一致しないとき
+    """
+    if len(data) > SHIFT_DATA_MAX_LENGTH:
+        raise ValueError("shift data is too long")
+    try:
+        decompressor = zlib.decompressobj()
+        content = decompressor.decompress(
+            base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)),
+            SHIFT_DATA_MAX_SIZE,
+        )
+        if decompressor.unconsumed_tail:
+            raise ValueError("shift data is too large")
+        if not decompressor.eof:
+            raise ValueError("shift data is truncated")
+    except (zlib.error, TypeError) as e:
+        raise ValueError("broken shift data: {!r}".format(e))
+    if hashlib.sha256(content).hexdigest()[:32] != key:
+        raise ValueError("shift data does not match the key")
+
+    content = json.loads(content.decode())
+    days = [
+        [
+            Work(
+                staff_name=staff_name,
+                start=dt.datetime.fromisoformat(start),
+                end=dt.datetime.fromisoformat(end),
+                requested=requested,
+                eventid=None,
+                slackid=str(member),
+            )
+            for member, staff_name, start, end, requested in day
+        ]
+        for day in content["works"]
+    ]
+    shift = days if content["mode"] == "week" else days[0]
+    return shift, content["format"]
+
+
+class ShiftImageCache:
+    """
+    シフトのキーからアップロード済みの画像の情報を引くLRUキャッシュ
+
+    索引はファイルに保存し、他のworkerが保存した分と合わせて読み書きする。
+    """
+
+    def __init__(
+        self, path: str = SHIFT_IMAGE_CACHE_INDEX, size: int = SHIFT_IMAGE_CACHE_SIZE
+    ):
+        """
+        :param str path : 索引を保存するファイルのパス。Noneなら保存しない
+        :param int size : 覚えておく件数の上限
+        """
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        # key -> {"url", "filename"}。後ろほど最近使われたもの
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self.entries.update(self.read_index())
+            self.trim()
+
+    def read_index(self) -> list:
+        if self.path is None:
+            return []
+        try:
+            with open(self.path) as index:
+                return json.load(index)
+        except (OSError, ValueError):
+            return []
+
+    def trim(self):
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """
+        他のworkerの索引と合わせてファイルに保存する。lockを取得してから呼ぶこと
+        """
+        if self.path is None:
+            return
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                merged = OrderedDict(self.read_index())
+                for key, value in self.entries.items():
+                    merged.pop(key, None)
+                    merged[key] = value
+                self.entries = merged
+                self.trim()
+                temp_path = "{}.{}".format(self.path, os.getpid())
+                with open(temp_path, "w") as index:
+                    json.dump(list(self.entries.items()), index, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, key: str) -> dict:
+        """
+        :param str key : make_shift_keyで作ったキー
+        :return dict : {"url", "filename"}。なければNone
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                # 他のworkerがアップロードしたかもしれないので索引を読み直す
+                value = dict(self.read_index()).get(key)
+                if value is None:
+                    self.misses += 1
+                    return None
+                self.entries[key] = value
+                self.trim()
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return dict(value)
+
+    def put(self, key: str, value: dict):
+        """
+        :param str key : make_shift_keyで作ったキー
+        :param dict value : {"url", "filename"}
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = dict(value)
+            self.trim()
+            try:
+                self.save()
+            except OSError as e:
+                imgcache_error_out("failed to save index: {!r}".format(e))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+            }
+
+
+class ShiftImageStore:
+    """
+    "make_shift_keyのキー.拡張子"の名前で描画済みの画像を保持し、Flaskから配信できるようにするクラス
+
+    画像はメモリにmemory_size枚までLRUで置き、ディレクトリにもdisk_size枚まで保存する。
+    メモリから追い出された画像や、他のworkerが描画した画像はディレクトリから読む。
+    """
+
+    def __init__(
+        self,
+        directory: str = SHIFT_IMAGE_DIR,
+        memory_size: int = SHIFT_IMAGE_MEMORY_SIZE,
+        disk_size: int = SHIFT_IMAGE_DISK_SIZE,
+    ):
+        """
+        :param str directory : 画像を保存するディレクトリ。Noneならメモリにだけ置く
+        :param int memory_size : メモリに置く枚数の上限
+        :param int disk_size : ディレクトリに置く枚数の上限
+        """
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.lock = threading.Lock()
+        # key -> 画像のbytes。後ろほど最近使われたもの
+        self.images = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def remember(self, name: str, image: bytes):
+        """
+        メモリに置く。lockを取得してから呼ぶこと
+        """
+        self.images.pop(name, None)
+        self.images[name] = image
+        while len(self.images) > self.memory_size:
+            self.images.popitem(last=False)
+
+    def get(self, name: str) -> bytes:
+        """
+        :param str name : "make_shift_keyで作ったキー.拡張子"
+        :return bytes : 画像。なければ、もしくは名前の形が不正ならNone
+        """
+        if not SHIFT_IMAGE_NAME_PATTERN.match(name):
+            return None
+        with self.lock:
+            image = self.images.get(name)
+            if image is not None:
+                self.hits += 1
+                self.images.move_to_end(name)
+                return image
+        image = None
+        if self.directory is not None:
+            try:
+                with open(self.path(name), "rb") as file:
+                    image = file.read()
+            except OSError:
+                pass
+        with self.lock:
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.remember(name, image)
+            return image
+
+    def contains(self, name: str) -> bool:
+        with self.lock:
+            if name in self.images:
+                return True
+        return self.directory is not None and os.path.exists(self.path(name))
+
+    def put(self, name: str, image: bytes):
+        """
+        :param str name : "make_shift_keyで作ったキー.拡張子"
+        :param bytes image : 描画済みの画像
+        """
+        with self.lock:
+            self.remember(name, image)
+        if self.directory is None:
+            return
+        try:
+            temp_path = "{}.{}".format(self.path(name), os.getpid())
+            with open(temp_path, "wb") as file:
+                file.write(image)
+            os.replace(temp_path, self.path(name))
+            self.prune()
+        except OSError as e:
+            imgcache_error_out("failed to save image {}: {!r}".format(name, e))
+
+    def prune(self):
+        """
+        ディレクトリの画像がdisk_size枚を超えていたら古いものから消す
+        """
+        with os.scandir(self.directory) as entries:
+            files = [
+                entry for entry in entries if SHIFT_IMAGE_NAME_PATTERN.match(entry.name)
+            ]
+        if len(files) <= self.disk_size:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[: len(files) - self.disk_size]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory": len(self.images),
+            }
@@ -0,0 +1,205 @@
+import datetime as dt
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from deadline import limit_timeout
+
+# 描画済みのシフト画像のurlを何秒、何件まで覚えておくか
+SHIFT_PRERENDER_TTL = int(os.environ.get("SHIFT_PRERENDER_TTL", 5 * 60))
+SHIFT_PRERENDER_SIZE = int(os.environ.get("SHIFT_PRERENDER_SIZE", 64))
+
+
+def prerender_error_out(text):
+    print(
+        "[{}]-ShiftImagePrerenderer {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class ShiftImagePrerenderer:
+    """
+    シフト画像のurlを日付と日/週の別で覚えておき、もう一方の画像を先に描画しておくクラス
+
+    日の画像と週の画像は同じ週のシフトから作れるので、週のシフトを1度だけ取得し、
+    求められた方を描画して返したあと、もう一方を別スレッドで描画しておく。
+    "switch_type"で表示を切り替えたときは描画済みの画像をすぐに返せる。
+    覚えておいたurlは、カレンダーに変更があった週の分をinvalidateで捨てる。
+    """
+
+    def __init__(
+        self,
+        controller,
+        ttl: int = SHIFT_PRERENDER_TTL,
+        size: int = SHIFT_PRERENDER_SIZE,
+    ):
+        """
+        :param ShiftController controller : シフトの取得と画像の描画に使うShiftController
+        :param int ttl : urlを覚えておく時間(秒)
+        :param int size : urlを覚えておく件数の上限
+        """
+        self.controller = controller
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        # (日付, is_day) -> (urlとファイル名, 期限)。後ろほど最近使われたもの
+        self.entries = OrderedDict()
+        # 描画中の(日付, is_day) -> Future
+        self.pending = {}
+        # invalidateされるたびに増やす。描画中に捨てられた分を覚えないようにする
+        self.generation = 0
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, date, is_day: bool) -> tuple:
+        """
+        日の画像は日付、週の画像はその週の月曜日の日付をキーにする
+        """
+        if not is_day:
+            date = self.controller.calc_nearly_monday(date)
+        if isinstance(date, dt.datetime):
+            date = date.date()
+        return (date, is_day)
+
+    def lookup(self, key: tuple) -> dict:
+        """
+        覚えているurlを返す。lockを取得してから呼ぶこと
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        uploaded, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return uploaded
+
+    def store(self, key: tuple, uploaded: dict, generation: int):
+        with self.lock:
+            if generation != self.generation:
+                # 描画している間にカレンダーが変わった
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (uploaded, time.monotonic() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get(self, date: dt.datetime, is_day: bool) -> dict:
+        """
+        シフト画像のurlを返す。描画済みか描画中ならそれを使う
+
+        :param dt.datetime date : シフトの日付
+        :param bool is_day : Trueなら日の画像、Falseなら週の画像
+        :return dict : {"url": 画像のurl, "filename": 画像のファイル名}
+        """
+        key = self.make_key(date, is_day)
+        with self.lock:
+            uploaded = self.lookup(key)
+            future = self.pending.get(key)
+            if uploaded is not None or future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if uploaded is not None:
+            return uploaded
+        if future is not None:
+            try:
+                # interactionの処理中なら、その残りの時間までしか待たない
+                return future.result(timeout=limit_timeout(None))
+            except FutureTimeoutError:
+                raise
+            except Exception:
+                # 先に描画しておくのに失敗したので、改めて描画する
+                pass
+        return self.prepare(date, is_day)
+
+    def prepare(self, date: dt.datetime, is_day: bool) -> dict:
+        """
+        週のシフトを取得して求められた方の画像を描画し、もう一方の描画を予約する
+        """
+        generation = self.generation
+        week = self.controller.get_week_shift(
+            base_date=date, grouping_by_week=True, fill_blank=True
+        )
+        # 土日の日のシフトは週のシフトに含まれないので、別に取得する
+        day = week[date.weekday()] if date.weekday() < 5 else None
+
+        def get_day():
+            if day is not None:
+                return day
+            return self.controller.get_shift(date=date, fill_blank=True)
+
+        uploaded = self.controller.generate_shiftimg_url(
+            shift=get_day() if is_day else week
+        )
+        self.store(self.make_key(date, is_day), uploaded, generation)
+        self.schedule(
+            self.make_key(date, not is_day),
+            (lambda: week) if is_day else get_day,
+            generation,
+        )
+        return uploaded
+
+    def schedule(self, key: tuple, get_shift, generation: int):
+        """
+        まだなければ、別スレッドで画像を描画しておく
+
+        :param tuple key : 描画する画像のキー
+        :param function get_shift : 描画するシフトを返す関数
+        :param int generation : シフトを取得したときのgeneration
+        """
+        with self.lock:
+            if key in self.pending or self.lookup(key) is not None:
+                return
+
+            def render():
+                try:
+                    uploaded = self.controller.generate_shiftimg_url(shift=get_shift())
+                    self.store(key, uploaded, generation)
+                    return uploaded
+                except Exception as e:
+                    prerender_error_out("prerender of {} failed: {!r}".format(key, e))
+                    raise
+                finally:
+                    with self.lock:
+                        self.pending.pop(key, None)
+
+            self.pending[key] = self.executor.submit(render)
+
+    def invalidate(self, dates=None):
+        """
+        指定された日付を含む日と週の画像のurlを捨てる
+
+        :param set dates : 変更があった日付(dt.date)の集合。Noneなら全て捨てる
+        """
+        with self.lock:
+            self.generation += 1
+            if dates is None:
+                self.entries.clear()
+                return
+            mondays = {self.controller.calc_nearly_monday(date) for date in dates}
+            for key in list(self.entries):
+                date, is_day = key
+                if (date in dates) if is_day else (date in mondays):
+                    del self.entries[key]
+
+    def on_calendar_changed(self, calendar_id: str, dates: set):
+        """
+        CalendarMirrorのlistener
+        """
+        self.invalidate(dates)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "pending": len(self.pending),
+            }
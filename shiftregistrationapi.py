@@ -96,7 +96,7 @@ def generate_work(work_detail: dict, date: dt.datetime):
     slackid = (
         work_detail.get("slackid")
         if work_detail.get("slackid")
-        else sc.get_name2slackId(work_detail.get("name"))
+        else sc.name2slackid(work_detail.get("name"))
     )
     return Work(
         staff_name=work_detail.get("name"),
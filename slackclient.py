@@ -0,0 +1,269 @@
+import datetime as dt
+import os
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+SLACK_API_URL = "https://slack.com/api/"
+# Slackへの接続を何本まで使い回すか。gunicornのスレッド数以上にする
+SLACK_HTTP_POOL_SIZE = int(os.environ.get("SLACK_HTTP_POOL_SIZE", 10))
+# 1回のリクエストのタイムアウト(秒)
+SLACK_REQUEST_TIMEOUT = float(os.environ.get("SLACK_REQUEST_TIMEOUT", 10))
+# 429が返されたときに、Retry-Afterだけ待って送り直す回数の上限
+SLACK_MAX_RETRIES = int(os.environ.get("SLACK_MAX_RETRIES", 3))
+# 送信の枠が空くのを待つ時間と、Retry-Afterを待つ時間の合計の上限(秒)
+SLACK_RATE_WAIT = float(os.environ.get("SLACK_RATE_WAIT", 60))
+# trigger_idは3秒で期限が切れるので、dialog.openなどで枠を待つ時間はこれまでにする
+SLACK_TRIGGER_WAIT = 1
+
+# Slackのrate limitのTierごとの1秒あたりの回数
+# https://api.slack.com/docs/rate-limits
+SLACK_TIERS = {1: 1 / 60, 2: 20 / 60, 3: 50 / 60, 4: 100 / 60}
+# メソッドごとの(1秒あたりの回数, 連続して送れる回数)
+# chat.postMessageはTierではなく、1チャンネルにつき1秒に1回程度とされている
+SLACK_METHOD_RATES = {
+    "chat.postMessage": (1.0, 3),
+    "im.open": (SLACK_TIERS[3], 5),
+    "conversations.open": (SLACK_TIERS[3], 5),
+    "dialog.open": (SLACK_TIERS[4], 10),
+    # response_urlはメソッドではないが、まとめて送りすぎないように枠を設ける
+    "response_url": (SLACK_TIERS[4], 10),
+}
+# 表にないメソッドはTier3として扱う
+SLACK_DEFAULT_RATE = (SLACK_TIERS[3], 5)
+
+
+def slack_error_out(text):
+    print(
+        "[{}]-SlackClient {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class SlackRateLimitError(Exception):
+    """
+    送信の枠が空くのをSLACK_RATE_WAIT秒待っても送れなかったときの例外
+    """
+
+    pass
+
+
+class TokenBucket:
+    """
+    1秒あたりrate回、連続してcapacity回まで送れるようにするトークンバケット
+
+    429でRetry-Afterを返されたときはpauseで指定された時間まで全ての送信を止める。
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        :param float rate : 1秒あたりに補充するトークンの数
+        :param int capacity : 溜めておけるトークンの数
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        # Retry-Afterで止められている期限(time.monotonic)
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        トークンを1つ予約し、使えるようになるまでの時間を返す。lockを取得してから呼ぶこと
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def acquire(self, timeout: float) -> float:
+        """
+        トークンが使えるようになるまで待つ
+
+        :param float timeout : 待つ時間の上限(秒)
+        :return float : 待った時間(秒)
+        :raises SlackRateLimitError : timeout秒待っても使えるようにならないとき
+        """
+        with self.lock:
+            wait = self.reserve()
+            if wait > timeout:
+                # 予約を取り消す
+                self.tokens += 1
+                raise SlackRateLimitError("rate limited for {:.1f}s more".format(wait))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """
+        seconds秒の間、全ての送信を止める
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class SlackClient:
+    """
+    Slackへのリクエストを、接続を使い回しつつrate limitに収まるように送るクラス
+
+    Web APIはメソッドごとのトークンバケットで送る間隔を空け、バルク登録などで
+    通知がまとめて出てもrate limitにかからないようにする。
+    それでも429が返されたときは、Retry-Afterの間そのメソッドの送信を全て止めて送り直す。
+    """
+
+    def __init__(
+        self,
+        token: str = None,
+        pool_size: int = SLACK_HTTP_POOL_SIZE,
+        timeout: float = SLACK_REQUEST_TIMEOUT,
+        max_retries: int = SLACK_MAX_RETRIES,
+        rate_wait: float = SLACK_RATE_WAIT,
+    ):
+        """
+        :param str token : botのトークン。response_urlにしか送らないならNoneでよい
+        :param int pool_size : 使い回す接続の数
+        :param float timeout : 1回のリクエストのタイムアウト(秒)
+        :param int max_retries : 429のときに送り直す回数の上限
+        :param float rate_wait : 枠とRetry-Afterを待つ時間の合計の上限(秒)
+        """
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_wait = rate_wait
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.headers = {"Content-type": "application/json"}
+        if token:
+            self.headers["Authorization"] = "Bearer " + token
+        self.lock = threading.Lock()
+        # メソッド -> TokenBucket
+        self.buckets = {}
+        # メソッド -> {"calls", "throttled", "ratelimited", "wait_total", "wait_max"}
+        self.metrics = {}
+
+    def get_bucket(self, method: str) -> TokenBucket:
+        with self.lock:
+            bucket = self.buckets.get(method)
+            if bucket is None:
+                bucket = TokenBucket(
+                    *SLACK_METHOD_RATES.get(method, SLACK_DEFAULT_RATE)
+                )
+                self.buckets[method] = bucket
+            return bucket
+
+    def record(self, method: str, waited: float = 0.0, ratelimited: bool = False):
+        with self.lock:
+            metric = self.metrics.setdefault(
+                method,
+                {
+                    "calls": 0,
+                    "throttled": 0,
+                    "ratelimited": 0,
+                    "wait_total": 0.0,
+                    "wait_max": 0.0,
+                },
+            )
+            if ratelimited:
+                metric["ratelimited"] += 1
+                return
+            metric["calls"] += 1
+            if waited > 0:
+                metric["throttled"] += 1
+                metric["wait_total"] += waited
+                metric["wait_max"] = max(metric["wait_max"], waited)
+
+    def send(
+        self, method: str, url: str, body: dict, headers: dict, rate_wait: float = None
+    ):
+        """
+        枠が空くのを待ってurlにbodyを送る。429ならRetry-Afterだけ待って送り直す
+
+        :param float rate_wait : 枠とRetry-Afterを待つ時間の合計の上限(秒)。Noneならself.rate_wait
+        :return requests.Response : 最後に受け取った応答
+        :raises SlackRateLimitError : rate_wait秒待っても送れなかったとき
+        :raises requests.RequestException : 接続に失敗したとき
+        """
+        bucket = self.get_bucket(method)
+        deadline = time.monotonic() + (
+            self.rate_wait if rate_wait is None else rate_wait
+        )
+        attempt = 0
+        while True:
+            waited = bucket.acquire(max(deadline - time.monotonic(), 0.0))
+            self.record(method, waited=waited)
+            res = self.session.post(
+                url, json=body, headers=headers, timeout=self.timeout
+            )
+            if res.status_code != 429:
+                return res
+
+            attempt += 1
+            self.record(method, ratelimited=True)
+            retry_after = res.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else 1.0
+            bucket.pause(delay)
+            if attempt > self.max_retries or time.monotonic() + delay > deadline:
+                slack_error_out(
+                    "give up {} after {} attempts: 429".format(method, attempt)
+                )
+                return res
+            slack_error_out(
+                "{} is rate limited, retry in {}s ({}/{})".format(
+                    method, delay, attempt, self.max_retries
+                )
+            )
+
+    def api(self, method: str, body: dict, rate_wait: float = None) -> dict:
+        """
+        Web APIのメソッドを呼び出す
+
+        :param str method : "chat.postMessage"などのメソッド名
+        :param dict body : 送るjson
+        :param float rate_wait : 枠とRetry-Afterを待つ時間の合計の上限(秒)。Noneならself.rate_wait
+        :return dict : Slackからの返答
+        """
+        res = self.send(method, SLACK_API_URL + method, body, self.headers, rate_wait)
+        return res.json()
+
+    def respond(self, response_url: str, message: dict) -> requests.Response:
+        """
+        slash commandやinteractive messageのresponse_urlにメッセージを送る
+
+        :param str response_url : Slackから渡されたresponse_url
+        :param dict message : 送るメッセージ
+        :return requests.Response : Slackからの応答
+        """
+        return self.send(
+            "response_url",
+            response_url,
+            message,
+            {"Content-type": "application/json"},
+        )
+
+    def stats(self) -> dict:
+        """
+        :return dict : メソッドごとの呼び出し回数、枠を待った回数、429を返された回数、
+            枠を待った時間の平均と最大(秒)
+        """
+        with self.lock:
+            return {
+                method: {
+                    "calls": metric["calls"],
+                    "throttled": metric["throttled"],
+                    "ratelimited": metric["ratelimited"],
+                    "wait_avg": (
+                        metric["wait_total"] / metric["calls"]
+                        if metric["calls"]
+                        else 0.0
+                    ),
+                    "wait_max": metric["wait_max"],
+                }
+                for method, metric in self.metrics.items()
+            }
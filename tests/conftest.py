@@ -0,0 +1,18 @@
+import os
+import sys
+
+# テストはGoogleやSlackに接続しないが、importするだけで読まれる設定があるので仮の値を入れておく
+for name, value in {
+    "CLIENT_SECRET_JSON": '{"installed": {"client_id": "id", "client_secret": "secret",'
+    ' "token_uri": "https://oauth2.googleapis.com/token"}}',
+    "REFRESH_TOKEN": "refresh-token",
+    "DATABASE_SHEET": "database-sheet",
+    "CALENDARID_SHIFT": "shift@group.calendar.google.com",
+    "CALENDARID_DAIKO": "daiko@group.calendar.google.com",
+    "CALENDARID_OPEN": "open@group.calendar.google.com",
+    "SLACK_BOT_TOKEN": "xoxb-test",
+    "NOTICE_CHANNEL": "notice",
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,175 @@
+import datetime as dt
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from calendarmirror import CalendarMirror
+
+JST = dt.timezone(dt.timedelta(hours=9), name="JST")
+CALENDAR = "shift@group.calendar.google.com"
+
+
+def to_utc(value: dt.datetime) -> str:
+    return value.astimezone(dt.timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def make_event(eventid, start, end, status="confirmed"):
+    return {
+        "id": eventid,
+        "status": status,
+        "start": {"dateTime": start.isoformat()},
+        "end": {"dateTime": end.isoformat()},
+    }
+
+
+class FakeCalendar:
+    """
+    GoogleCalendar.list_events_for_syncの代わりに、用意した応答を順に返して呼ばれ方を記録する
+    """
+
+    def __init__(self):
+        self.full = []
+        self.changes = []
+        self.calls = []
+        self.gone = False
+
+    def list_events_for_sync(
+        self, calendar, sync_token=None, time_min=None, time_max=None
+    ):
+        self.calls.append((sync_token, time_min, time_max))
+        if sync_token is None:
+            return list(self.full), "token-{}".format(len(self.calls))
+        if self.gone:
+            self.gone = False
+            raise HttpError(httplib2.Response({"status": 410}), b"gone")
+        changes, self.changes = self.changes, []
+        return changes, "token-{}".format(len(self.calls))
+
+
+@pytest.fixture
+def calendar():
+    return FakeCalendar()
+
+
+@pytest.fixture
+def mirror(calendar):
+    return CalendarMirror(calendar, [CALENDAR], JST, sync_interval=60, weeks=2)
+
+
+@pytest.fixture
+def monday(mirror):
+    return mirror.calc_window()[0]
+
+
+def day_range(day: dt.datetime) -> tuple:
+    return (
+        to_utc(day.replace(hour=8)),
+        to_utc(day.replace(hour=19)),
+    )
+
+
+def ids(events):
+    return [event["id"] for event in events]
+
+
+def test_full_sync_is_bounded_to_window(mirror, calendar, monday):
+    mirror.sync(CALENDAR)
+
+    assert calendar.calls == [
+        (None, to_utc(monday), to_utc(monday + dt.timedelta(weeks=2)))
+    ]
+
+
+def test_events_are_served_by_day(mirror, calendar, monday):
+    calendar.full = [
+        make_event("b", monday.replace(hour=13), monday.replace(hour=15)),
+        make_event("a", monday.replace(hour=9), monday.replace(hour=12)),
+        make_event(
+            "c",
+            monday.replace(hour=9) + dt.timedelta(days=1),
+            monday.replace(hour=12) + dt.timedelta(days=1),
+        ),
+    ]
+    mirror.sync(CALENDAR)
+
+    assert ids(mirror.get_events_in_day(CALENDAR, day_range(monday))) == ["a", "b"]
+    assert mirror.get_event(CALENDAR, "c")["id"] == "c"
+    # 複製から返せる範囲の外は問い合わせさせる
+    assert (
+        mirror.get_events_in_day(
+            CALENDAR, day_range(monday + dt.timedelta(weeks=2, days=1))
+        )
+        is None
+    )
+
+
+def test_incremental_sync_applies_changes(mirror, calendar, monday):
+    calendar.full = [
+        make_event("a", monday.replace(hour=9), monday.replace(hour=12)),
+        make_event("b", monday.replace(hour=13), monday.replace(hour=15)),
+    ]
+    mirror.sync(CALENDAR)
+    tuesday = monday + dt.timedelta(days=1)
+    calendar.changes = [
+        make_event("a", tuesday.replace(hour=9), tuesday.replace(hour=12)),
+        make_event("b", monday, monday, status="cancelled"),
+    ]
+
+    changed = mirror.sync(CALENDAR)
+
+    assert calendar.calls[-1] == ("token-1", None, None)
+    assert changed == {monday.date(), tuesday.date()}
+    assert mirror.get_events_in_day(CALENDAR, day_range(monday)) == []
+    assert ids(mirror.get_events_in_day(CALENDAR, day_range(tuesday))) == ["a"]
+
+
+def test_changes_outside_window_are_dropped(mirror, calendar, monday):
+    mirror.sync(CALENDAR)
+    far = monday + dt.timedelta(weeks=10)
+    calendar.changes = [make_event("far", far.replace(hour=9), far.replace(hour=12))]
+
+    assert mirror.sync(CALENDAR) == set()
+    assert mirror.events[CALENDAR] == {}
+
+
+def test_gone_sync_token_resyncs_everything(mirror, calendar, monday):
+    mirror.sync(CALENDAR)
+    calendar.gone = True
+    calendar.full = [make_event("a", monday.replace(hour=9), monday.replace(hour=12))]
+
+    assert mirror.sync(CALENDAR) == {monday.date()}
+    assert [call[0] for call in calendar.calls] == [None, "token-1", None]
+    assert ids(mirror.get_events_in_day(CALENDAR, day_range(monday))) == ["a"]
+
+
+def test_new_week_resyncs_everything(mirror, calendar, monday, monkeypatch):
+    calendar.full = [make_event("a", monday.replace(hour=9), monday.replace(hour=12))]
+    mirror.sync(CALENDAR)
+    next_monday = monday + dt.timedelta(weeks=1)
+    monkeypatch.setattr(
+        mirror,
+        "calc_window",
+        lambda: (next_monday, next_monday + dt.timedelta(weeks=2)),
+    )
+    calendar.full = []
+
+    assert mirror.sync(CALENDAR) == {monday.date()}
+    assert calendar.calls[-1] == (
+        None,
+        to_utc(next_monday),
+        to_utc(next_monday + dt.timedelta(weeks=2)),
+    )
+    assert mirror.window_start[CALENDAR] == next_monday
+
+
+def test_stale_mirror_syncs_before_read(mirror, calendar, monday):
+    mirror.sync(CALENDAR)
+    calendar.changes = [
+        make_event("a", monday.replace(hour=9), monday.replace(hour=12))
+    ]
+
+    # 同期したばかりなので複製をそのまま返す
+    assert mirror.get_events_in_day(CALENDAR, day_range(monday)) == []
+    mirror.mark_stale(CALENDAR)
+    assert ids(mirror.get_events_in_day(CALENDAR, day_range(monday))) == ["a"]
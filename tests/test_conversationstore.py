@@ -0,0 +1,97 @@
+import types
+
+import pytest
+
+import conversationstore
+from conversationstore import (
+    ConversationStore,
+    MemoryConversationStore,
+    SQLiteConversationStore,
+)
+
+STATE = {
+    "append_date": "2019-10-17 10:00:00",
+    "action": "REQUEST",
+    "dates": "2019-10-17",
+    "time": "None",
+    "works": "[]",
+    "text": "代行お願いします",
+}
+
+
+class FakeWriteBehind:
+    def __init__(self):
+        self.written = []
+
+    def write(self, slackid, values):
+        self.written.append((slackid, values))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(
+        conversationstore, "time", types.SimpleNamespace(time=lambda: clock.now)
+    )
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path, clock):
+    def make_store(**kwargs):
+        if request.param == "memory":
+            return MemoryConversationStore(ttl=600, **kwargs)
+        return SQLiteConversationStore(
+            str(tmp_path / "conversations.sqlite3"), ttl=600, **kwargs
+        )
+
+    return make_store
+
+
+def test_set_and_get(make_store):
+    store = make_store()
+    store.set("U1", dict(STATE, unknown="ignored"))
+
+    assert store.get("U1") == STATE
+    assert store.get("U2") is None
+
+
+def test_state_expires_after_ttl(make_store, clock):
+    store = make_store()
+    store.set("U1", STATE)
+
+    clock.now += 599
+    assert store.get("U1") == STATE
+    # 保存し直すと期限が延びる
+    store.set("U1", STATE)
+    clock.now += 599
+    assert store.get("U1") == STATE
+    clock.now += 1
+    assert store.get("U1") is None
+
+
+def test_delete(make_store):
+    store = make_store()
+    store.set("U1", STATE)
+    store.delete("U1")
+
+    assert store.get("U1") is None
+
+
+def test_write_behind_mirrors_changes(make_store):
+    write_behind = FakeWriteBehind()
+    store = make_store(write_behind=write_behind)
+    store.set("U1", STATE)
+    store.delete("U1")
+
+    assert write_behind.written == [
+        ("U1", [STATE[field] for field in ConversationStore.FIELDS]),
+        ("U1", ["None"] * len(ConversationStore.FIELDS)),
+    ]
+
+
+def test_sqlite_store_is_shared_between_workers(tmp_path, clock):
+    path = str(tmp_path / "conversations.sqlite3")
+    SQLiteConversationStore(path, ttl=600).set("U1", STATE)
+
+    assert SQLiteConversationStore(path, ttl=600).get("U1") == STATE
@@ -0,0 +1,109 @@
+import types
+
+import pytest
+
+import idempotencystore
+from idempotencystore import (
+    IDEMPOTENCY_PENDING_TTL,
+    MemoryIdempotencyStore,
+    SQLiteIdempotencyStore,
+    make_idempotency_key,
+)
+
+RESPONSE = {
+    "status": 200,
+    "body": '{"text": "受け付けました"}',
+    "mimetype": "text/json",
+}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(
+        idempotencystore, "time", types.SimpleNamespace(time=lambda: clock.now)
+    )
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path, clock):
+    if request.param == "memory":
+        return MemoryIdempotencyStore(ttl=600)
+    return SQLiteIdempotencyStore(str(tmp_path / "idempotency.sqlite3"), ttl=600)
+
+
+def test_duplicate_while_in_progress(store):
+    assert store.begin("command:1") == (True, None)
+    assert store.begin("command:1") == (False, None)
+    assert store.begin("command:2") == (True, None)
+    assert store.stats() == {"duplicates": 1}
+
+
+def test_completed_response_is_replayed_until_ttl(store, clock):
+    store.begin("command:1")
+    store.complete("command:1", RESPONSE)
+
+    clock.now += 599
+    assert store.begin("command:1") == (False, RESPONSE)
+    clock.now += 1
+    assert store.begin("command:1") == (True, None)
+
+
+def test_pending_key_expires(store, clock):
+    # 処理していたworkerが応答を保存する前に落ちた
+    store.begin("command:1")
+
+    clock.now += IDEMPOTENCY_PENDING_TTL - 1
+    assert store.begin("command:1") == (False, None)
+    clock.now += 1
+    assert store.begin("command:1") == (True, None)
+
+
+def test_released_key_can_be_retried(store):
+    store.begin("command:1")
+    store.release("command:1")
+
+    assert store.begin("command:1") == (True, None)
+
+
+def test_sqlite_store_is_shared_between_workers(tmp_path, clock):
+    path = str(tmp_path / "idempotency.sqlite3")
+    first = SQLiteIdempotencyStore(path, ttl=600)
+    second = SQLiteIdempotencyStore(path, ttl=600)
+
+    assert first.begin("event:Ev1") == (True, None)
+    assert second.begin("event:Ev1") == (False, None)
+    first.complete("event:Ev1", RESPONSE)
+    assert second.begin("event:Ev1") == (False, RESPONSE)
+
+
+def test_memory_store_forgets_oldest_keys(clock):
+    store = MemoryIdempotencyStore(ttl=600, size=2)
+    for key in ("command:1", "command:2", "command:3"):
+        store.begin(key)
+
+    assert store.begin("command:1") == (True, None)
+    assert store.begin("command:3") == (False, None)
+
+
+@pytest.mark.parametrize(
+    "kind, data, key",
+    [
+        ("event", {"event_id": "Ev1", "event": {}}, "event:Ev1"),
+        ("command", {"trigger_id": "123.456", "command": "/d"}, "command:123.456"),
+        (
+            "interaction",
+            {"type": "dialog_submission", "action_ts": "1571300000.1"},
+            "interaction:1571300000.1",
+        ),
+        (
+            "interaction",
+            {"type": "block_actions", "actions": [{"action_ts": "1571300000.2"}]},
+            "interaction:1571300000.2",
+        ),
+        ("interaction", {"type": "block_actions"}, None),
+    ],
+)
+def test_make_idempotency_key(kind, data, key):
+    assert make_idempotency_key(kind, data) == key
@@ -0,0 +1,161 @@
+import pytest
+
+from jobqueue import JobQueue, JobQueueFullError
+
+
+class Recorder:
+    """
+    handlerとon_give_upの呼ばれ方を記録する。failuresの回数だけ失敗する
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.handled = []
+        self.given_up = []
+
+    def handle(self, payload):
+        self.handled.append(payload)
+        if len(self.handled) <= self.failures:
+            raise ConnectionError("attempt {}".format(len(self.handled)))
+
+    def give_up(self, payload, error):
+        self.given_up.append((payload, error))
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    def make_queue(**kwargs):
+        kwargs.setdefault("base_delay", 0)
+        return JobQueue(str(tmp_path / "jobs.sqlite3"), workers=1, **kwargs)
+
+    return make_queue
+
+
+def run_next(queue):
+    job = queue.claim()
+    assert job is not None
+    job_id, kind, payload, attempt, _, reclaimed = job
+    queue.run(job_id, kind, payload, attempt, reclaimed)
+    return job
+
+
+def statuses(queue):
+    return [job["status"] for job in queue.list_jobs()]
+
+
+def test_job_runs_once(make_queue):
+    queue = make_queue()
+    recorder = Recorder()
+    queue.register("/d", recorder.handle, on_give_up=recorder.give_up)
+    queue.enqueue("/d", {"text": "ls"})
+
+    run_next(queue)
+
+    assert recorder.handled == [{"text": "ls"}]
+    assert queue.claim() is None
+    assert statuses(queue) == [JobQueue.DONE]
+
+
+def test_enqueue_rejects_when_full(make_queue):
+    queue = make_queue(limit=2)
+    queue.enqueue("/d", {"text": "ls"})
+    queue.enqueue("/d", {"text": "img"})
+
+    with pytest.raises(JobQueueFullError):
+        queue.enqueue("/d", {"text": "help"})
+    assert queue.stats()["rejected"] == 1
+
+
+def test_retryable_job_is_retried_then_given_up(make_queue):
+    queue = make_queue(max_attempts=3)
+    recorder = Recorder(failures=5)
+    queue.register(
+        "/d", recorder.handle, on_give_up=recorder.give_up, retryable=lambda _: True
+    )
+    queue.enqueue("/d", {"text": "ls"})
+
+    for attempt in range(1, 4):
+        assert run_next(queue)[3] == attempt
+
+    assert queue.claim() is None
+    assert len(recorder.handled) == 3
+    assert [str(error) for _, error in recorder.given_up] == ["attempt 3"]
+    assert statuses(queue) == [JobQueue.FAILED]
+
+
+def test_retryable_job_succeeds_on_retry(make_queue):
+    queue = make_queue(max_attempts=3)
+    recorder = Recorder(failures=1)
+    queue.register(
+        "/d", recorder.handle, on_give_up=recorder.give_up, retryable=lambda _: True
+    )
+    queue.enqueue("/d", {"text": "ls"})
+
+    run_next(queue)
+    run_next(queue)
+
+    assert len(recorder.handled) == 2
+    assert recorder.given_up == []
+    assert statuses(queue) == [JobQueue.DONE]
+
+
+def test_write_job_is_not_retried(make_queue):
+    queue = make_queue(max_attempts=3)
+    recorder = Recorder(failures=1)
+    queue.register(
+        "/d", recorder.handle, on_give_up=recorder.give_up, retryable=lambda _: False
+    )
+    queue.enqueue("/d", {"text": "req"})
+
+    run_next(queue)
+
+    assert queue.claim() is None
+    assert len(recorder.handled) == 1
+    assert len(recorder.given_up) == 1
+
+
+def test_expired_lease_is_reclaimed(make_queue):
+    # 処理したworkerが落ちて期限を延ばせなかった
+    queue = make_queue(visibility_timeout=0)
+    recorder = Recorder()
+    queue.register("/d", recorder.handle, retryable=lambda payload: True)
+    queue.enqueue("/d", {"text": "ls"})
+    job_id, _, _, attempt, _, reclaimed = queue.claim()
+    assert (attempt, reclaimed) == (1, False)
+
+    job = run_next(queue)
+
+    assert job[0] == job_id
+    assert (job[3], job[5]) == (2, True)
+    assert recorder.handled == [{"text": "ls"}]
+    # 落ちたworkerの結果は他に渡った後なので捨てる
+    assert not queue.finish(job_id, attempt, JobQueue.DONE)
+    assert queue.stats()["lost"] == 1
+
+
+def test_reclaimed_write_job_is_given_up(make_queue):
+    queue = make_queue(visibility_timeout=0)
+    recorder = Recorder()
+    queue.register(
+        "/d", recorder.handle, on_give_up=recorder.give_up, retryable=lambda _: False
+    )
+    queue.enqueue("/d", {"text": "req"})
+    queue.claim()
+
+    run_next(queue)
+
+    # 書き込みが済んだかわからないので処理し直さない
+    assert recorder.handled == []
+    assert isinstance(recorder.given_up[0][1], TimeoutError)
+    assert statuses(queue) == [JobQueue.FAILED]
+
+
+def test_jobs_survive_restart(make_queue):
+    make_queue().enqueue("/d", {"text": "ls"})
+    queue = make_queue()
+    recorder = Recorder()
+    queue.register("/d", recorder.handle)
+
+    run_next(queue)
+
+    assert recorder.handled == [{"text": "ls"}]
@@ -0,0 +1,90 @@
+import types
+
+import pytest
+
+import memberdirectory
+from memberdirectory import MEMBER_DIRECTORY_MIN_RELOAD, MemberDirectory
+
+
+class FakeSheet:
+    """
+    GoogleSpreadSheetのうち、メンバー一覧の読み書きだけを真似る
+    """
+
+    USERID_SHEET_NAME = "name-id"
+
+    def __init__(self, members):
+        self.members = list(members)
+        self.reads = 0
+
+    def get(self, sheet_name):
+        assert sheet_name == self.USERID_SHEET_NAME
+        self.reads += 1
+        return [
+            [slackid for slackid, _ in self.members],
+            [name for _, name in self.members],
+        ]
+
+    def append(self, values, sheet_name):
+        assert sheet_name == self.USERID_SHEET_NAME
+        self.members.append(tuple(values))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(
+        memberdirectory, "time", types.SimpleNamespace(monotonic=lambda: clock.now)
+    )
+    return clock
+
+
+@pytest.fixture
+def sheet():
+    return FakeSheet([("U1", "山田"), ("U2", "佐藤")])
+
+
+@pytest.fixture
+def directory(sheet, clock):
+    return MemberDirectory(sheet, ttl=600)
+
+
+def test_lookup_reads_sheet_once_within_ttl(directory, sheet, clock):
+    assert directory.slackid2name("U1") == "山田"
+    clock.now += 599
+    assert directory.name2slackid("佐藤") == "U2"
+    assert directory.get_slackId2name_dict() == {"U1": "山田", "U2": "佐藤"}
+
+    assert sheet.reads == 1
+    assert directory.stats() == {"hits": 2, "misses": 1, "members": 2}
+
+
+def test_lookup_reloads_after_ttl(directory, sheet, clock):
+    directory.slackid2name("U1")
+    sheet.members[0] = ("U1", "山田太郎")
+    clock.now += 600
+
+    assert directory.slackid2name("U1") == "山田太郎"
+    assert sheet.reads == 2
+
+
+def test_unknown_key_reloads_at_most_once_per_interval(directory, sheet, clock):
+    directory.slackid2name("U1")
+    sheet.members.append(("U3", "鈴木"))
+
+    # 読み込んだばかりなら読み直さない
+    with pytest.raises(KeyError):
+        directory.slackid2name("U3")
+    assert sheet.reads == 1
+
+    clock.now += MEMBER_DIRECTORY_MIN_RELOAD + 1
+    assert directory.slackid2name("U3") == "鈴木"
+    assert sheet.reads == 2
+
+
+def test_add_writes_sheet_and_reloads(directory, sheet):
+    directory.slackid2name("U1")
+    directory.add("U3", "鈴木")
+
+    assert directory.name2slackid("鈴木") == "U3"
+    assert sheet.reads == 2
@@ -0,0 +1,113 @@
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from renderexecutor import RenderBusyError, RenderExecutor
+
+IMAGE = {"data": b"image"}
+
+
+class FakeExecutor:
+    """
+    ProcessPoolExecutorの代わりに、描画せずにFutureを返す
+
+    outcomeがNoneなら結果はテストから渡し、例外なら失敗させ、それ以外ならすぐにそれを結果にする
+    """
+
+    def __init__(self, outcome=None):
+        self.outcome = outcome
+        self.broken = False
+        self.futures = []
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        if self.broken:
+            raise BrokenProcessPool("the pool is broken")
+        future = Future()
+        future.set_running_or_notify_cancel()
+        if isinstance(self.outcome, Exception):
+            future.set_exception(self.outcome)
+        elif self.outcome is not None:
+            future.set_result(self.outcome)
+        self.futures.append(future)
+        return future
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+@pytest.fixture
+def executors():
+    return []
+
+
+@pytest.fixture
+def renderer(executors, monkeypatch):
+    renderer = RenderExecutor("font.ttf", workers=1, queue_depth=1, timeout=0.05)
+
+    def get_executor():
+        # 作り直されたプロセスはすぐに描画を終える
+        if renderer.executor is None:
+            renderer.executor = FakeExecutor(IMAGE if executors else None)
+            executors.append(renderer.executor)
+        return renderer.executor
+
+    monkeypatch.setattr(renderer, "get_executor", get_executor)
+    return renderer
+
+
+def test_render_returns_result(renderer, executors):
+    renderer.get_executor().outcome = IMAGE
+
+    assert renderer.render([], "png") == IMAGE
+    assert renderer.stats()["rendered"] == 1
+
+
+def test_timed_out_render_keeps_slot_until_done(renderer, executors):
+    with pytest.raises(FutureTimeoutError):
+        renderer.render([], "png")
+    # 待つのをやめても、描画が終わるまでは枠を返さない
+    with pytest.raises(RenderBusyError):
+        renderer.render([], "png")
+
+    executors[0].futures[0].set_result({"data": b"late"})
+    executors[0].outcome = IMAGE
+    assert renderer.render([], "png") == IMAGE
+    assert renderer.stats()["timeouts"] == 1
+    assert renderer.stats()["busy"] == 1
+
+
+def test_failed_render_releases_slot(renderer, executors):
+    renderer.get_executor().outcome = ValueError("broken image")
+    with pytest.raises(ValueError):
+        renderer.render([], "png")
+
+    executors[0].outcome = IMAGE
+    assert renderer.render([], "png") == IMAGE
+
+
+def test_submit_error_releases_slot(renderer, executors):
+    executor = renderer.get_executor()
+
+    def submit(fn, *args):
+        raise OSError("can not start a process")
+
+    executor.submit = submit
+    with pytest.raises(OSError):
+        renderer.render([], "png")
+
+    del executor.submit
+    executor.outcome = IMAGE
+    assert renderer.render([], "png") == IMAGE
+
+
+def test_broken_pool_is_restarted(renderer, executors):
+    renderer.get_executor().broken = True
+
+    assert renderer.render([], "png") == IMAGE
+    assert executors[0].shut_down
+    assert renderer.executor is executors[1]
+    # 作り直した後も枠は1つだけ使って返している
+    assert renderer.render([], "png") == IMAGE
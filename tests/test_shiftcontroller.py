@@ -0,0 +1,250 @@
+import datetime as dt
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import shiftcontroller
+from shiftcontroller import CALENDARID_DAIKO, CALENDARID_SHIFT, ShiftController
+from shiftimgcache import ShiftImageStore, make_shift_key
+from workmanage import Work
+
+JST = dt.timezone(dt.timedelta(hours=9), name="JST")
+# 2019-10-14は月曜日
+MONDAY = dt.datetime(2019, 10, 14, 12, 0, tzinfo=JST)
+
+
+def make_event(calendar, eventid, slackid, name, start, end):
+    return {
+        "id": eventid,
+        "summary": name,
+        "description": slackid,
+        "organizer": {"email": calendar},
+        "start": {"dateTime": start.isoformat()},
+        "end": {"dateTime": end.isoformat()},
+    }
+
+
+def at(days, hour, minute=0):
+    return (MONDAY + dt.timedelta(days=days)).replace(hour=hour, minute=minute)
+
+
+class FakeCalendar:
+    """
+    GoogleCalendar.get_events_concurrentlyと同じ条件でEventを返し、問い合わせを記録する
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.queries = []
+
+    def get_events_concurrently(self, calendars, search_range):
+        self.queries.append((tuple(calendars), search_range))
+        start, end = [
+            dt.datetime.fromisoformat(value.replace("Z", "+00:00"))
+            for value in search_range
+        ]
+        return [
+            sorted(
+                [
+                    event
+                    for event in self.events
+                    if event["organizer"]["email"] == calendar
+                    and dt.datetime.fromisoformat(event["start"]["dateTime"]) < end
+                    and start < dt.datetime.fromisoformat(event["end"]["dateTime"])
+                ],
+                key=lambda event: event["start"]["dateTime"],
+            )
+            for calendar in calendars
+        ]
+
+
+EVENTS = [
+    make_event(CALENDARID_SHIFT, "s1", "U1", "山田", at(0, 9), at(0, 12)),
+    make_event(CALENDARID_SHIFT, "s2", "U2", "佐藤", at(0, 12), at(0, 17)),
+    # 開館前から始まり開館時間に掛かる
+    make_event(CALENDARID_SHIFT, "s3", "U1", "山田", at(1, 7), at(1, 9)),
+    # 閉館後だけのシフトはどの日にも入らない
+    make_event(CALENDARID_SHIFT, "s4", "U2", "佐藤", at(1, 19, 30), at(1, 20)),
+    make_event(CALENDARID_SHIFT, "s5", "U3", "鈴木", at(3, 13), at(3, 18)),
+    make_event(CALENDARID_DAIKO, "d1", "U2", "佐藤", at(0, 10), at(0, 11)),
+    make_event(CALENDARID_DAIKO, "d2", "U3", "鈴木", at(3, 8), at(3, 10)),
+    make_event(CALENDARID_DAIKO, "d3", "U1", "山田", at(4, 18), at(4, 19)),
+    # 土曜日のシフトは週に入らない
+    make_event(CALENDARID_SHIFT, "s6", "U1", "山田", at(5, 10), at(5, 12)),
+]
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    # 本物の初期化はGoogleとSlackに接続するので、get_range_shiftが使うものだけを用意する
+    monkeypatch.setattr(shiftcontroller, "pprint", lambda *args, **kwargs: None)
+    controller = ShiftController.__new__(ShiftController)
+    controller.timezone = JST
+    controller.mirror = None
+    controller.calendar = FakeCalendar(EVENTS)
+    return controller
+
+
+def get_week_shift_by_day(controller, base_date, grouping_by_week=False, **kwargs):
+    """
+    1日ずつget_shiftで取得していた以前のget_week_shift
+    """
+    works_list = []
+    nearly_monday = controller.calc_nearly_monday(base_date)
+    for count in range(5):
+        works = controller.get_shift(
+            date=nearly_monday + dt.timedelta(days=count), **kwargs
+        )
+        if grouping_by_week:
+            works_list.append(works)
+        else:
+            works_list += works
+    return works_list
+
+
+def dump(works_list):
+    return [
+        (
+            [work.to_dict() for work in works]
+            if isinstance(works, list)
+            else works.to_dict()
+        )
+        for works in works_list
+    ]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"grouping_by_week": True},
+        {"grouping_by_week": True, "fill_blank": True},
+        {"only_requested": True, "grouping_by_week": True, "fill_blank": True},
+        {"only_active": True},
+        {"slackid": "U1"},
+        {"slackid": "U2", "grouping_by_week": True, "fill_blank": True},
+    ],
+)
+def test_get_week_shift_matches_per_day_query(controller, kwargs):
+    expected = dump(get_week_shift_by_day(controller, MONDAY, **kwargs))
+    controller.calendar.queries.clear()
+
+    assert dump(controller.get_week_shift(MONDAY, **kwargs)) == expected
+
+
+def test_get_week_shift_queries_once(controller):
+    controller.get_week_shift(MONDAY + dt.timedelta(days=2), grouping_by_week=True)
+
+    assert controller.calendar.queries == [
+        (
+            (CALENDARID_SHIFT, CALENDARID_DAIKO),
+            (
+                controller.calc_opening_hours(MONDAY, is_UTC=True)[0],
+                controller.calc_opening_hours(
+                    MONDAY + dt.timedelta(days=4), is_UTC=True
+                )[1],
+            ),
+        )
+    ]
+
+
+def test_get_range_shift_splits_by_day(controller):
+    week = controller.get_range_shift(
+        MONDAY, MONDAY + dt.timedelta(days=4), grouping_by_week=True
+    )
+
+    assert [[work.eventid for work in day] for day in week] == [
+        ["s1", "s2", "d1"],
+        ["s3"],
+        [],
+        ["s5", "d2"],
+        ["d3"],
+    ]
+
+
+class FakeRenderer:
+    """
+    RenderExecutor.renderの代わりに、描画する内容から作ったキーを画像として返す
+    """
+
+    def __init__(self):
+        self.rendered = []
+
+    def render(self, shift, image_format):
+        self.rendered.append(shift)
+        data = make_shift_key(shift, image_format=image_format).encode()
+        return {"data": data, "size": len(data)}
+
+
+@pytest.fixture
+def image_controller(monkeypatch, tmp_path):
+    monkeypatch.setattr(shiftcontroller, "SHIFT_IMAGE_BASE_URL", "https://daiko.test/")
+    controller = ShiftController.__new__(ShiftController)
+    controller.image_store = ShiftImageStore(str(tmp_path / "shift-images"))
+    controller.renderer = FakeRenderer()
+    return controller
+
+
+def make_week():
+    return [
+        [
+            Work(
+                staff_name=event["summary"],
+                start=dt.datetime.fromisoformat(event["start"]["dateTime"]),
+                end=dt.datetime.fromisoformat(event["end"]["dateTime"]),
+                requested=event["organizer"]["email"] == CALENDARID_DAIKO,
+                eventid=event["id"],
+                slackid=event["description"],
+            )
+            for event in EVENTS
+            if event["start"]["dateTime"].startswith(day)
+        ]
+        for day in ("2019-10-14", "2019-10-15", "2019-10-16", "2019-10-17")
+    ]
+
+
+def parse_image_url(url):
+    url = urlsplit(url)
+    key, extension = url.path.rsplit("/", 1)[1].split(".")
+    return key, extension, parse_qs(url.query)["s"][0]
+
+
+def test_shiftimg_url_serves_stored_image(image_controller):
+    week = make_week()
+    uploaded = image_controller.generate_shiftimg_url(week)
+    key, extension, _ = parse_image_url(uploaded["url"])
+
+    assert uploaded["url"].startswith("https://daiko.test/shift-img/")
+    assert key == make_shift_key(week)
+    assert image_controller.load_shiftimg(key, extension) == key.encode()
+    assert len(image_controller.renderer.rendered) == 1
+
+
+def test_missing_shiftimg_is_redrawn_from_url(image_controller, tmp_path):
+    week = make_week()
+    key, extension, data = parse_image_url(
+        image_controller.generate_shiftimg_url(week)["url"]
+    )
+    # 再起動で保存した画像が消えた
+    image_controller.image_store = ShiftImageStore(str(tmp_path / "restarted"))
+
+    assert image_controller.load_shiftimg(key, extension) is None
+    assert image_controller.load_shiftimg(key, extension, data) == key.encode()
+    assert image_controller.load_shiftimg(key, extension) == key.encode()
+    assert len(image_controller.renderer.rendered) == 2
+
+
+def test_shiftimg_is_not_redrawn_for_other_requests(image_controller, tmp_path):
+    key, extension, data = parse_image_url(
+        image_controller.generate_shiftimg_url(make_week())["url"]
+    )
+    other_key, _, _ = parse_image_url(
+        image_controller.generate_shiftimg_url(make_week()[:2])["url"]
+    )
+    image_controller.image_store = ShiftImageStore(str(tmp_path / "restarted"))
+
+    # 形式の違う拡張子や、他のシフトのキーでは描き直さない
+    assert image_controller.load_shiftimg(key, "webp", data) is None
+    assert image_controller.load_shiftimg(other_key, extension, data) is None
+    assert image_controller.load_shiftimg(key, extension, data[:-8]) is None
+    assert len(image_controller.renderer.rendered) == 2
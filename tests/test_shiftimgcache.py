@@ -0,0 +1,196 @@
+import base64
+import datetime as dt
+import os
+import zlib
+
+import pytest
+
+from shiftimgcache import (
+    SHIFT_DATA_MAX_LENGTH,
+    SHIFT_DATA_MAX_SIZE,
+    SHIFT_IMAGE_FORMAT,
+    ShiftImageCache,
+    ShiftImageStore,
+    decode_shift,
+    encode_shift,
+    make_shift_key,
+)
+from workmanage import Work
+
+JST = dt.timezone(dt.timedelta(hours=9), name="JST")
+
+
+def make_work(slackid, name, day, start, end, requested=False, eventid=None):
+    date = dt.datetime(2019, 10, 14 + day, tzinfo=JST)
+    return Work(
+        staff_name=name,
+        start=date.replace(hour=start),
+        end=date.replace(hour=end),
+        requested=requested,
+        eventid=eventid or "{}-{}-{}".format(slackid, day, start),
+        slackid=slackid,
+    )
+
+
+def make_day(**kwargs):
+    return [
+        make_work("U1", "山田", 0, 9, 12, **kwargs),
+        make_work("U2", "佐藤", 0, 12, 17),
+        make_work("U1", "山田", 0, 17, 19),
+    ]
+
+
+def make_week():
+    return [make_day(), [], [make_work("U3", "鈴木", 2, 13, 18, requested=True)]]
+
+
+def test_shift_key_depends_only_on_what_is_drawn():
+    key = make_shift_key(make_day())
+
+    assert make_shift_key(make_day()) == key
+    # eventidは描画に使わない
+    assert make_shift_key(make_day(eventid="other")) == key
+    assert make_shift_key(make_day(requested=True)) != key
+    assert make_shift_key(make_day(), image_format="webp") != key
+    assert make_shift_key(make_week()) != key
+    assert make_shift_key([make_day()], mode="week") != key
+
+
+def test_shift_key_does_not_use_slackid():
+    renamed = make_day()
+    for work in renamed:
+        work.slackid = {"U1": "W9", "U2": "W8"}[work.slackid]
+
+    assert make_shift_key(renamed) == make_shift_key(make_day())
+
+
+def test_shift_key_keeps_members_apart():
+    merged = make_day()
+    merged[1].slackid = "U1"
+
+    assert make_shift_key(merged) != make_shift_key(make_day())
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / "shift-images.json")
+
+
+def test_cache_evicts_least_recently_used(index_path):
+    cache = ShiftImageCache(index_path, size=2)
+    cache.put("a", {"url": "url-a", "filename": "a.png"})
+    cache.put("b", {"url": "url-b", "filename": "b.png"})
+    assert cache.get("a") == {"url": "url-a", "filename": "a.png"}
+    cache.put("c", {"url": "url-c", "filename": "c.png"})
+
+    assert cache.get("b") is None
+    assert cache.get("a")["url"] == "url-a"
+    assert cache.get("c")["url"] == "url-c"
+    assert cache.stats() == {"hits": 3, "misses": 1, "entries": 2}
+
+
+def test_cache_is_shared_between_workers(index_path):
+    first = ShiftImageCache(index_path, size=4)
+    second = ShiftImageCache(index_path, size=4)
+    first.put("a", {"url": "url-a", "filename": "a.png"})
+    second.put("b", {"url": "url-b", "filename": "b.png"})
+
+    # 後から保存したworkerも、先に保存された分を消さない
+    assert ShiftImageCache(index_path, size=4).get("a")["url"] == "url-a"
+    assert first.get("b")["url"] == "url-b"
+
+
+def test_cache_without_index_file():
+    cache = ShiftImageCache(None, size=1)
+    cache.put("a", {"url": "url-a", "filename": "a.png"})
+
+    assert cache.get("a")["url"] == "url-a"
+
+
+def test_encoded_shift_is_decoded_to_the_same_key():
+    for shift in (make_day(), make_week()):
+        key = make_shift_key(shift)
+        decoded, image_format = decode_shift(key, encode_shift(shift))
+
+        assert image_format == SHIFT_IMAGE_FORMAT
+        assert make_shift_key(decoded) == key
+
+
+def test_decode_keeps_days_and_members():
+    week = make_week()
+    decoded, _ = decode_shift(make_shift_key(week), encode_shift(week))
+
+    assert [len(day) for day in decoded] == [3, 0, 1]
+    assert [work.staff_name for work in decoded[0]] == ["山田", "佐藤", "山田"]
+    assert decoded[0][0].slackid == decoded[0][2].slackid != decoded[0][1].slackid
+    assert decoded[2][0].requested
+    assert decoded[2][0].start == week[2][0].start
+
+
+def test_decode_rejects_broken_data():
+    shift = make_day()
+    key = make_shift_key(shift)
+    data = encode_shift(shift)
+
+    for broken in (
+        data[:-4],
+        data[:10],
+        "!" + data,
+        "A" * (SHIFT_DATA_MAX_LENGTH + 1),
+    ):
+        with pytest.raises(ValueError):
+            decode_shift(key, broken)
+    # 他のシフトの内容では描き直させない
+    with pytest.raises(ValueError):
+        decode_shift(make_shift_key(make_week()), data)
+
+
+def test_decode_rejects_large_content():
+    bomb = base64.urlsafe_b64encode(zlib.compress(b" " * (SHIFT_DATA_MAX_SIZE + 1)))
+
+    with pytest.raises(ValueError):
+        decode_shift("0" * 32, bomb.decode().rstrip("="))
+
+
+def image_name(key, extension="png"):
+    return "{}.{}".format(key, extension)
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    return str(tmp_path / "shift-images")
+
+
+def test_store_rejects_unexpected_names(image_dir):
+    store = ShiftImageStore(image_dir)
+    store.put(image_name("a" * 32), b"image")
+
+    assert store.get(image_name("a" * 32)) == b"image"
+    assert store.get(image_name("a" * 32, "gif")) is None
+    assert store.get("../" + image_name("a" * 32)) is None
+    assert store.get(image_name("A" * 32)) is None
+
+
+def test_store_reads_evicted_images_from_disk(image_dir):
+    store = ShiftImageStore(image_dir, memory_size=1, disk_size=8)
+    store.put(image_name("a" * 32), b"image-a")
+    store.put(image_name("b" * 32), b"image-b")
+
+    assert list(store.images) == [image_name("b" * 32)]
+    assert store.get(image_name("a" * 32)) == b"image-a"
+    # 他のworkerが描画した画像も読める
+    assert ShiftImageStore(image_dir).get(image_name("b" * 32)) == b"image-b"
+
+
+def test_store_prunes_oldest_images(image_dir):
+    store = ShiftImageStore(image_dir, memory_size=0, disk_size=2)
+    for index, key in enumerate(("a" * 32, "b" * 32, "c" * 32)):
+        store.put(image_name(key), key.encode())
+        os.utime(store.path(image_name(key)), (index, index))
+    store.prune()
+
+    assert sorted(os.listdir(image_dir)) == [
+        image_name("b" * 32),
+        image_name("c" * 32),
+    ]
+    assert not store.contains(image_name("a" * 32))
@@ -0,0 +1,154 @@
+import atexit
+import datetime as dt
+import fcntl
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+# 何件溜まったら、もしくは最初の1件から何秒経ったら利用記録をまとめて書き込むか
+USE_LOG_BATCH_SIZE = int(os.environ.get("USE_LOG_BATCH_SIZE", 20))
+USE_LOG_FLUSH_INTERVAL = float(os.environ.get("USE_LOG_FLUSH_INTERVAL", 30))
+# シートに書き込めなかった利用記録を退避しておくファイル
+USE_LOG_SPILL_FILE = os.environ.get(
+    "USE_LOG_SPILL_FILE", os.path.join(tempfile.gettempdir(), "daiko-use-logs.jsonl")
+)
+
+
+def uselog_error_out(text):
+    print(
+        "[{}]-UseLogWriter {}".format(dt.datetime.now().isoformat(), text),
+        file=sys.stderr,
+    )
+
+
+class UseLogWriter:
+    """
+    利用記録をキューに溜めて、別スレッドから複数行まとめてシートに追記するクラス
+
+    batch_size件溜まるか、最初の1件からflush_interval秒経つと書き込む。
+    書き込みに失敗した行はspill_pathのファイルに退避し、次の書き込みで一緒に送る。
+    プロセスの終了時には溜まっている行を書き込んでから終わる。
+    """
+
+    # スレッドを止めるためにキューに入れる印
+    STOP = object()
+
+    def __init__(
+        self,
+        sheet,
+        sheet_name: str,
+        convert=None,
+        batch_size: int = USE_LOG_BATCH_SIZE,
+        flush_interval: float = USE_LOG_FLUSH_INTERVAL,
+        spill_path: str = USE_LOG_SPILL_FILE,
+    ):
+        """
+        :param GoogleSpreadSheet sheet : 書き込み先のGoogleSpreadSheet
+        :param str sheet_name : 書き込み先のシート名
+        :param function convert : 書き込む直前に各行に適用する関数。名前の解決などに使う
+        :param int batch_size : まとめて書き込む行数
+        :param float flush_interval : 最初の1件から書き込むまでの最長の時間(秒)
+        :param str spill_path : 書き込めなかった行を退避するファイルのパス
+        """
+        self.sheet = sheet
+        self.sheet_name = sheet_name
+        self.convert = convert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def record(self, row: list):
+        """
+        行をキューに入れる。書き込みは待たない
+
+        :param list row : 書き込む1行
+        """
+        self.queue.put(row)
+
+    def flush(self, rows: list) -> bool:
+        """
+        退避してあった行と合わせてシートに追記する。失敗したら退避する
+
+        :param list rows : 書き込む行のリスト
+        :return bool : 書き込めたか
+        """
+        if self.convert is not None:
+            rows = [self.convert(row) for row in rows]
+        try:
+            # 他のworkerと退避ファイルを取り合わないようにロックする
+            with open(self.spill_path, "a+") as spill:
+                fcntl.flock(spill, fcntl.LOCK_EX)
+                try:
+                    spill.seek(0)
+                    spilled = [json.loads(line) for line in spill if line.strip()]
+                    if not spilled and not rows:
+                        return True
+                    try:
+                        self.sheet.append_rows(spilled + rows, self.sheet_name)
+                    except Exception as e:
+                        uselog_error_out(
+                            "failed to append {} rows, spill to {}: {!r}".format(
+                                len(rows), self.spill_path, e
+                            )
+                        )
+                        for row in rows:
+                            spill.write(json.dumps(row, ensure_ascii=False) + "\n")
+                        return False
+                    spill.truncate(0)
+                    return True
+                finally:
+                    fcntl.flock(spill, fcntl.LOCK_UN)
+        except OSError as e:
+            # 退避ファイルも使えなければ諦めてログに残す
+            uselog_error_out("failed to write use logs {}: {!r}".format(rows, e))
+            return False
+
+    def run(self):
+        rows = []
+        deadline = None
+        while True:
+            timeout = None if not rows else max(deadline - time.monotonic(), 0)
+            try:
+                row = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                row = None
+
+            if row is self.STOP:
+                if rows:
+                    self.flush(rows)
+                return
+            if row is not None:
+                if not rows:
+                    deadline = time.monotonic() + self.flush_interval
+                rows.append(row)
+            if rows and (len(rows) >= self.batch_size or time.monotonic() >= deadline):
+                self.flush(rows)
+                rows = []
+
+    def start(self):
+        """
+        書き込み用のスレッドを開始し、プロセスの終了時に書き込みきるようにする
+        """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def close(self, timeout: float = 10):
+        """
+        溜まっている行を書き込んでスレッドを止める
+
+        :param float timeout : 書き込みを待つ最長の時間(秒)
+        """
+        if self.thread is None:
+            return
+        self.queue.put(self.STOP)
+        self.thread.join(timeout)
+        self.thread = None
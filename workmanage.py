@@ -1,11 +1,74 @@
 import datetime
+import io
 import json
+import threading
+from collections import OrderedDict
 from enum import Enum
+from functools import lru_cache
 
 from PIL import Image, ImageDraw, ImageFont
 from pytz import timezone
 
 
+@lru_cache(maxsize=None)
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    フォントを読み込む。同じパスと大きさのフォントはプロセス内で使い回す
+
+    :param str path : フォントファイルのパス
+    :param int size : フォントの大きさ
+    :return ImageFont.FreeTypeFont
+    """
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=4096)
+def text_size(font: ImageFont.FreeTypeFont, text: str) -> tuple:
+    """
+    font.getsize(text)の結果を覚えておき、同じ名前や時刻の文字列を測り直さない
+
+    :param ImageFont.FreeTypeFont font : load_fontで読み込んだフォント
+    :param str text : 測る文字列
+    :return tuple : (幅, 高さ)
+    """
+    return font.getsize(text)
+
+
+@lru_cache(maxsize=128)
+def rotated_text(
+    font: ImageFont.FreeTypeFont,
+    text: str,
+    angle: int,
+    scale: float,
+    color: tuple,
+    mode: str,
+) -> Image.Image:
+    """
+    文字列を描いて回転・縮小した画像を作る。同じ文字列の画像は描き直さない
+    返した画像は使い回すので、pasteなどで読むだけにすること
+
+    :param str mode : "RGBA"なら背景を透明に、"RGB"なら白にする
+    :return Image.Image
+    """
+    background = (255, 255, 255, 0) if mode == "RGBA" else (255, 255, 255)
+    img = Image.new(mode, text_size(font, text), background)
+    ImageDraw.Draw(img).text((0, 0), text, color, font=font)
+    img = img.rotate(angle, expand=True)
+    return img.resize((int(img.size[0] * scale), int(img.size[1] * scale)))
+
+
+class RecordedLines:
+    """
+    ImageDraw.line()の呼び出しを描画せずに覚えておく。DrawShiftImgの罫線の座標を使い回すために使う
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def line(self, xy, fill=None, width=0):
+        self.lines.append((list(xy), fill, width))
+
+
 class Work:
     def __init__(
         self,
@@ -32,15 +95,38 @@ class Work:
         self.slackid = slackid
 
     def __repr__(self):
-        return str(
-            {
-                "staff_name": self.staff_name,
-                "start": self.start.isoformat(),
-                "end": self.end.isoformat(),
-                "requested": self.requested,
-                "eventid": self.eventid,
-                "slackid": self.slackid,
-            }
+        return str(self.to_dict())
+
+    def to_dict(self) -> dict:
+        """
+        jsonやpickleで他のプロセスに渡せる形にする
+
+        :return dict : 時刻をisoformatの文字列にした各項目
+        """
+        return {
+            "staff_name": self.staff_name,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "requested": self.requested,
+            "eventid": self.eventid,
+            "slackid": self.slackid,
+        }
+
+    @staticmethod
+    def from_dict(work_dict: dict):
+        """
+        to_dictの結果からWorkを作り直す
+
+        :param dict work_dict : to_dictの結果
+        :return Work
+        """
+        return Work(
+            staff_name=work_dict["staff_name"],
+            start=datetime.datetime.fromisoformat(work_dict["start"]),
+            end=datetime.datetime.fromisoformat(work_dict["end"]),
+            requested=work_dict["requested"],
+            eventid=work_dict["eventid"],
+            slackid=work_dict["slackid"],
         )
 
     def count_worktime_rect(self, columnCount=False):
@@ -426,6 +512,39 @@ class ShiftImageDirection(Enum):
     VERTICAL = 2
 
 
+def encode_image(image: Image.Image, image_format: str = "png") -> dict:
+    """
+    画像をファイルに書かずにメモリ上でエンコードする
+
+    シフト画像は少ない色の図なので、既定では256色のパレットに減色したpngにする
+    (週の画像で、品質95のjpegの1/8ほどの大きさになる)。減色は速さを優先してFASTOCTREEを使う
+
+    :param Image.Image image : エンコードする画像
+    :param str image_format : "png"(減色したpng), "webp"(可逆のwebp), "jpeg" のどれか
+    :return dict : {"data": bytes, "mimetype": str, "extension": str, "size": バイト数}
+    :raises ValueError : image_formatが不正なとき
+    """
+    buffer = io.BytesIO()
+    if image_format == "png":
+        image.quantize(colors=256, method=Image.FASTOCTREE).save(buffer, "PNG")
+        mimetype, extension = "image/png", "png"
+    elif image_format == "webp":
+        image.save(buffer, "WEBP", lossless=True)
+        mimetype, extension = "image/webp", "webp"
+    elif image_format == "jpeg":
+        image.save(buffer, "JPEG", quality=95)
+        mimetype, extension = "image/jpeg", "jpg"
+    else:
+        raise ValueError("Invalid image format: {}".format(image_format))
+    data = buffer.getvalue()
+    return {
+        "data": data,
+        "mimetype": mimetype,
+        "extension": extension,
+        "size": len(data),
+    }
+
+
 class DrawShiftImg:
     # 週のときの画像の高さ
     HEIGHT = 1026
@@ -456,6 +575,11 @@ class DrawShiftImg:
     gridLineWeight = 1
     boldLineWeight = 3
 
+    # 時刻の目盛りを描いた背景と罫線の座標を、形ごとに何個まで覚えておくか
+    LAYER_CACHE_SIZE = 8
+    layer_cache = OrderedDict()
+    layer_lock = threading.Lock()
+
     def dsi_error(self, text):
         print(
             "[{}]-DrawShiftImg {}".format(dt.datetime.now().isoformat(), text),
@@ -493,10 +617,10 @@ class DrawShiftImg:
         self.shift_direction = ShiftImageDirection.VERTICAL
         self.shift += [self.grouping_by_member(works) for works in shift]
         try:
-            self.font = ImageFont.truetype(str(fontPath), 25)
-            self.smallFont = ImageFont.truetype(str(fontPath), 15)
-            self.kanjiFont = ImageFont.truetype(str(kanjiFontPath), 25)
-            self.kanjBoldFont = ImageFont.truetype(str(kanjiBoldFontPath), 25)
+            self.font = load_font(str(fontPath), 25)
+            self.smallFont = load_font(str(fontPath), 15)
+            self.kanjiFont = load_font(str(kanjiFontPath), 25)
+            self.kanjBoldFont = load_font(str(kanjiBoldFontPath), 25)
         except (IOError, OSError):
             raise ValueError("Invalid Font file path")
 
@@ -516,10 +640,10 @@ class DrawShiftImg:
     def initialize_for_day(self, shift, kanjiFontPath, fontPath):
         self.shift_direction = ShiftImageDirection.HORIZONAL
         try:
-            self.font = ImageFont.truetype(str(fontPath), 100)
-            self.kanjiFont = ImageFont.truetype(str(kanjiFontPath), 25)
-            self.mediumFont = ImageFont.truetype(str(kanjiFontPath), 35)
-            self.smallFont = ImageFont.truetype(str(kanjiFontPath), 15)
+            self.font = load_font(str(fontPath), 100)
+            self.kanjiFont = load_font(str(kanjiFontPath), 25)
+            self.mediumFont = load_font(str(kanjiFontPath), 35)
+            self.smallFont = load_font(str(kanjiFontPath), 15)
         except (IOError, OSError):
             raise ValueError("Invalid Font file path")
 
@@ -557,7 +681,8 @@ class DrawShiftImg:
             raise TypeError("This shift is not day Shift")
 
         grouped = []
-        slackid_list = list(set([work.slackid for work in day_shift]))
+        # setの順はプロセスごとに変わるので、同じシフトが同じ画像になるよう登場順に並べる
+        slackid_list = list(dict.fromkeys(work.slackid for work in day_shift))
         for slackid in slackid_list:
             grouped.append([w for w in day_shift if w.slackid == slackid])
         return sorted(grouped, key=lambda x: (x[0].start, x[0].end))
@@ -606,33 +731,37 @@ class DrawShiftImg:
         need_cell, start_cell = work.count_worktime_rect(columnCount=True)
         if start_cell != 0:
             base_pos = rectApex[0]
+            start_str = work.start.strftime("%H:%M")
+            start_size = text_size(font, start_str)
 
             self.drawObj.text(
                 (
                     base_pos[0]
                     if direction == ShiftImageDirection.VERTICAL
-                    else base_pos[0] - font.getsize(work.start.strftime("%H:%M"))[0],
-                    base_pos[1] - font.getsize(work.start.strftime("%H:%M"))[1]
+                    else base_pos[0] - start_size[0],
+                    base_pos[1] - start_size[1]
                     if direction == ShiftImageDirection.VERTICAL
                     else base_pos[1],
                 ),
-                work.start.strftime("%H:%M"),
+                start_str,
                 self.LIGHT_GRAY,
                 font=font,
             )
         if start_cell + need_cell < self.NEED_COLUMNS:
             base_pos = rectApex[2]
+            end_str = work.end.strftime("%H:%M")
+            end_size = text_size(font, end_str)
 
             self.drawObj.text(
                 (
-                    base_pos[0] - font.getsize(work.end.strftime("%H:%M"))[0]
+                    base_pos[0] - end_size[0]
                     if direction == ShiftImageDirection.VERTICAL
                     else base_pos[0] + 1,
                     base_pos[1] - 3
                     if direction == ShiftImageDirection.VERTICAL
-                    else base_pos[1] - font.getsize(work.end.strftime("%H:%M"))[1],
+                    else base_pos[1] - end_size[1],
                 ),
-                work.end.strftime("%H:%M"),
+                end_str,
                 self.LIGHT_GRAY,
                 font=font,
             )
@@ -706,10 +835,10 @@ class DrawShiftImg:
         printPosition = {"x": coor["x"], "y": coor["y"]}
         for character in range(len(reversedList)):
             printPosition["x"] = (
-                coor["x"] - font.getsize(str(reversedList[character]))[0] / 2
+                coor["x"] - text_size(font, str(reversedList[character]))[0] / 2
             )
             printPosition["y"] = (
-                printPosition["y"] - font.getsize(str(reversedList[character]))[1]
+                printPosition["y"] - text_size(font, str(reversedList[character]))[1]
             )
             self.drawObj.text(
                 [(printPosition["x"]), (printPosition["y"])],
@@ -762,13 +891,14 @@ class DrawShiftImg:
     def print_weekseparateline(
         self, font=None, boldFont=None, lineWeight=boldLineWeight, color=BLACK
     ):
-        if font is None:
-            font = self.kanjiFont
-        if boldFont is None:
-            boldFont = self.kanjBoldFont
+        self.print_weekseparator(lineWeight, color)
+        self.print_weekday_labels(font, boldFont, color)
 
+    def print_weekseparator(self, lineWeight=boldLineWeight, color=BLACK):
+        """
+        表の左端と曜日の区切り線を描画する。1日ごとの人数だけで決まるので使い回す
+        """
         tmpCountRow = self.SIDE_MARGIN_LINES  # 両サイド2列分開いてるからoffset
-        weekdayList = Shift.WORKDAYS_JP
 
         self.drawObj.line(
             [
@@ -779,14 +909,7 @@ class DrawShiftImg:
             lineWeight,
         )
 
-        for (day, day_workers) in enumerate([len(workers) for workers in self.shift]):
-            weekdayLabelPoint = (
-                self.rowWidth * (tmpCountRow + day_workers / 2)
-                - font.getsize(weekdayList[day])[0] / 2,
-                (self.columnHeight - font.getsize(weekdayList[day])[1]) / 2,
-            )
-            self.drawObj.text(weekdayLabelPoint, weekdayList[day], color, font)
-
+        for day_workers in [len(workers) for workers in self.shift]:
             tmpCountRow += day_workers
 
             # 曜日の区切り線を入れる
@@ -799,11 +922,33 @@ class DrawShiftImg:
                 lineWeight,
             )
 
+    def print_weekday_labels(self, font=None, boldFont=None, color=BLACK):
+        """
+        曜日と日付を描画する
+        """
+        if font is None:
+            font = self.kanjiFont
+        if boldFont is None:
+            boldFont = self.kanjBoldFont
+
+        tmpCountRow = self.SIDE_MARGIN_LINES  # 両サイド2列分開いてるからoffset
+        weekdayList = Shift.WORKDAYS_JP
+
+        for (day, day_workers) in enumerate([len(workers) for workers in self.shift]):
+            weekdayLabelPoint = (
+                self.rowWidth * (tmpCountRow + day_workers / 2)
+                - text_size(font, weekdayList[day])[0] / 2,
+                (self.columnHeight - text_size(font, weekdayList[day])[1]) / 2,
+            )
+            self.drawObj.text(weekdayLabelPoint, weekdayList[day], color, font)
+
+            tmpCountRow += day_workers
+
             self.drawObj.text(
                 (
                     self.rowWidth * (tmpCountRow)
-                    - font.getsize(self.shift[day][0][0].start.strftime("%m/%d"))[0]
-                    - (font.getsize(" ")[0]) / 2,
+                    - text_size(font, self.shift[day][0][0].start.strftime("%m/%d"))[0]
+                    - (text_size(font, " ")[0]) / 2,
                     self.columnHeight * (self.NEED_COLUMNS + 2 * self.OVER_UNDER_MARGIN)
                     + self.heightOffset,
                 ),
@@ -837,11 +982,11 @@ class DrawShiftImg:
                 self.drawObj.text(
                     (
                         self.width * 0.12
-                        - font.getsize(self.shift[count][0].staff_name)[0],
+                        - text_size(font, self.shift[count][0].staff_name)[0],
                         DrawShiftImg.FOR_HEIGHT_RATIO
                         * (DrawShiftImg.TOP_MARGIN_LINES + count)
                         + DrawShiftImg.FOR_HEIGHT_RATIO * 0.5
-                        - font.getsize(self.shift[count][0].staff_name)[1] / 2,
+                        - text_size(font, self.shift[count][0].staff_name)[1] / 2,
                     ),
                     self.shift[count][0].staff_name,
                     DrawShiftImg.BLACK,
@@ -891,7 +1036,7 @@ class DrawShiftImg:
                     self.drawObj.text(
                         (
                             rectApex[2][0]
-                            - font.getsize(str(worktimePerDay))[0]
+                            - text_size(font, str(worktimePerDay))[0]
                             - worktimeTextOffset,
                             rectApex[2][1],
                         ),
@@ -904,11 +1049,11 @@ class DrawShiftImg:
                     self.drawObj.text(
                         (
                             rectApex[2][0]
-                            - font.getsize(str(worktimePerDay))[0]
+                            - text_size(font, str(worktimePerDay))[0]
                             - worktimeTextOffset,
                             2 * self.columnHeight
                             + self.heightOffset
-                            - font.getsize(str(worktimePerDay))[1]
+                            - text_size(font, str(worktimePerDay))[1]
                             - worktimeTextOffset,
                         ),
                         str(worktimePerDay),
@@ -920,7 +1065,7 @@ class DrawShiftImg:
                     self.drawObj.text(
                         (
                             rectApex[2][0]
-                            - font.getsize(str(worktimePerDay))[0]
+                            - text_size(font, str(worktimePerDay))[0]
                             - worktimeTextOffset,
                             self.heightOffset
                             + self.columnHeight * 22,  # self.needColumns
@@ -942,12 +1087,12 @@ class DrawShiftImg:
                 print_y = (
                     self.heightOffset
                     + self.columnHeight * (column + 2)
-                    - font.getsize(timeToPrint.strftime("%H:%M"))[1] / 2
+                    - text_size(font, timeToPrint.strftime("%H:%M"))[1] / 2
                 )
 
                 print_x = {
                     "right": self.rowWidth * 2
-                    - font.getsize(timeToPrint.strftime("%H:%M"))[0]
+                    - text_size(font, timeToPrint.strftime("%H:%M"))[0]
                     - timesOffset,
                     "left": self.rowWidth * (self.needRows - 2) + timesOffset,
                 }
@@ -969,11 +1114,7 @@ class DrawShiftImg:
             for time in range(11):
                 now_str = "{:2}:00".format(time + 9)
 
-                img = Image.new("RGBA", font.getsize(now_str), (255, 255, 255, 0))
-                text_img = ImageDraw.Draw(img)
-                text_img.text((0, 0), now_str, DrawShiftImg.BLACK, font=font)
-                img = img.rotate(60, expand=True)
-                img = img.resize((int(img.size[0] * 0.25), int(img.size[1] * 0.25)))
+                img = rotated_text(font, now_str, 60, 0.25, DrawShiftImg.BLACK, "RGBA")
                 tx, ty = img.size
                 self.image.paste(
                     img,
@@ -987,8 +1128,6 @@ class DrawShiftImg:
                     ),
                     mask=img,
                 )
-            del text_img
-            del img
 
     def print_date(self):
         if self.shift_direction != ShiftImageDirection.HORIZONAL:
@@ -998,8 +1137,8 @@ class DrawShiftImg:
         font = self.mediumFont
         self.drawObj.text(
             (
-                0.06 * self.width - font.getsize(str_date)[0] / 2,
-                self.FOR_HEIGHT_RATIO - (font.getsize(str_date)[1] / 2),
+                0.06 * self.width - text_size(font, str_date)[0] / 2,
+                self.FOR_HEIGHT_RATIO - (text_size(font, str_date)[1] / 2),
             ),
             str_date,
             self.BLACK,
@@ -1012,19 +1151,70 @@ class DrawShiftImg:
         now = datetime.datetime.now().astimezone(timezone("Asia/Tokyo"))
         now_str = now.strftime("generated at %Y/%m/%d %H:%M")
 
-        img = Image.new("RGB", font.getsize(now_str), DrawShiftImg.WHITE)
-        text_img = ImageDraw.Draw(img)
-        text_img.text((0, 0), now_str, color, font=font)
-        img = img.rotate(90, expand=True)
-        img = img.resize((int(img.size[0] * 0.5), int(img.size[1] * 0.5)))
+        img = rotated_text(font, now_str, 90, 0.5, color, "RGB")
         tx, ty = img.size
         self.image.paste(img, (self.width - tx, 0))
-        del text_img
-        del img
+
+    def layer_key(self) -> tuple:
+        """
+        背景を使い回せるかを決めるキー。描画の向き、1日ごとの人数、時刻のフォント
+        """
+        if self.shift_direction == ShiftImageDirection.VERTICAL:
+            counts = tuple(len(workers) for workers in self.shift)
+        else:
+            counts = (self.needRows,)
+        return (self.shift_direction, counts, self.font)
+
+    def make_layers(self) -> tuple:
+        """
+        シフトの内容によらない部分を作る
+
+        :return tuple : (時刻の目盛りを描いた背景の画像, 罫線と区切り線のline()の引数のリスト)
+        """
+        base = Image.new("RGB", (int(self.width), int(self.height)), DrawShiftImg.WHITE)
+        lines = RecordedLines()
+        image, drawObj = self.image, self.drawObj
+        try:
+            self.image, self.drawObj = base, ImageDraw.Draw(base)
+            self.print_time()
+            # 罫線はシフトの四角の上に引くので、座標だけ覚えておく
+            self.drawObj = lines
+            if self.shift_direction == ShiftImageDirection.VERTICAL:
+                self.print_grid_for_week_shift()
+                self.print_weekseparator()
+            else:
+                self.print_grid_for_day_shift()
+        finally:
+            self.image, self.drawObj = image, drawObj
+        return base, lines.lines
+
+    def get_layers(self) -> tuple:
+        """
+        背景と罫線の座標をキャッシュから返す。なければ作ってLAYER_CACHE_SIZE個まで覚えておく
+        """
+        key = self.layer_key()
+        with DrawShiftImg.layer_lock:
+            layers = DrawShiftImg.layer_cache.get(key)
+            if layers is not None:
+                DrawShiftImg.layer_cache.move_to_end(key)
+                return layers
+        layers = self.make_layers()
+        with DrawShiftImg.layer_lock:
+            DrawShiftImg.layer_cache[key] = layers
+            while len(DrawShiftImg.layer_cache) > DrawShiftImg.LAYER_CACHE_SIZE:
+                DrawShiftImg.layer_cache.popitem(last=False)
+        return layers
+
+    def print_lines(self, lines: list):
+        for xy, fill, width in lines:
+            self.drawObj.line(xy, fill, width)
 
     def make_shiftimage(self, empday=None, timepos="None"):
+        # 時刻の目盛りはキャッシュした背景を複製して使い、罫線は覚えておいた座標に引くだけにする
+        base, lines = self.get_layers()
+        self.image = base.copy()
+        self.drawObj = ImageDraw.Draw(self.image)
         self.print_names()
-        self.print_time()
         if self.shift_direction == ShiftImageDirection.VERTICAL:
             counter = 0
             for shift_a_day in self.shift:
@@ -1034,17 +1224,26 @@ class DrawShiftImg:
                     counter_offset=counter,
                     font=self.smallFont,
                 )
-            self.print_grid_for_week_shift()
-            self.print_weekseparateline()
+            self.print_lines(lines)
+            self.print_weekday_labels()
             self.print_generatedate()
         elif self.shift_direction == ShiftImageDirection.HORIZONAL:
             self.print_worktimerect(self.shift, font=self.smallFont)
-            self.print_grid_for_day_shift()
+            self.print_lines(lines)
             self.print_date()
             # self.print_generatedate()
 
         return self.image
 
+    def encode(self, image_format: str = "png") -> dict:
+        """
+        シフト画像を描画してメモリ上でエンコードする
+
+        :param str image_format : "png"(減色したpng), "webp"(可逆のwebp), "jpeg" のどれか
+        :return dict : encode_imageの結果
+        """
+        return encode_image(self.make_shiftimage(), image_format)
+
 
 if __name__ == "__main__":
     shift = Shift.parse_json("./now.json")